@@ -0,0 +1,8 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+在本机上对 sample 中的服务器做压力测试, 结果以 JSON 格式输出.
+
+使用方法 (在仓库根目录下运行):
+    python -m benchmark.run --processes 1 --tasklets 10 --output result.json
+'''
@@ -0,0 +1,260 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+多进程的压力生成器.
+
+每个客户端进程持有一个连接, 发出请求后等待响应再发下一个 (闭环),
+并发数等于进程数. 每个请求的耗时由客户端记录, 最后汇总成分位数.
+'''
+import multiprocessing
+import socket
+import time
+
+# 每次 recv 的大小
+RECV_SIZE = 64 * 1024
+
+
+class Scenario(object):
+    '''一种压测场景
+
+    参数:
+        name: 场景名称
+        kind: 服务器类型, http 或 tcp
+        path: 请求的 URI
+        keep_alive: 是否复用连接
+        pipeline: 每次连续发送的请求数, 全部响应返回后算作完成
+        slow_clients: 同时存在的慢客户端数, 它们每隔 slow_interval 秒
+                      发送请求的一个字节, 只占用连接, 不计入结果
+        slow_interval: 慢客户端发送每个字节的间隔 (s)
+    '''
+
+    def __init__(self, name, kind='http', path='/test', keep_alive=True,
+                 pipeline=1, slow_clients=0, slow_interval=0.5):
+        self.name = name
+        self.kind = kind
+        self.path = path
+        self.keep_alive = keep_alive
+        self.pipeline = pipeline
+        self.slow_clients = slow_clients
+        self.slow_interval = slow_interval
+
+    def request(self):
+        '''一次发送的数据
+        '''
+        if self.kind == 'tcp':
+            return b'ping'
+        connection = 'keep-alive' if self.keep_alive else 'close'
+        request = 'GET {} HTTP/1.1\r\nHost: localhost\r\n' \
+                  'Connection: {}\r\n\r\n'.format(self.path, connection)
+        return request.encode('ascii') * self.pipeline
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+# 默认运行的场景
+SCENARIOS = (
+    Scenario('keep_alive_small'),
+    Scenario('close_small', keep_alive=False),
+    Scenario('keep_alive_large', path='/big?size=1048576'),
+    Scenario('close_large', path='/big?size=1048576', keep_alive=False),
+    Scenario('pipeline_16', pipeline=16),
+    Scenario('slow_clients_64', slow_clients=64),
+    Scenario('tcp_close', kind='tcp', keep_alive=False),
+)
+
+
+class ResponseReader(object):
+    '''从 socket 中读取 HTTP 响应, 支持 pipelining 时一次收到多个响应
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buff = bytearray()
+        self.bytes = 0  # 收到的总字节数
+
+    def __fill(self):
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            raise socket.error("connection closed by server")
+        self.bytes += len(data)
+        self.buff += data
+
+    def read_response(self):
+        '''读取一个完整的响应, 返回状态码
+        '''
+        while 1:
+            end = self.buff.find(b'\r\n\r\n')
+            if end >= 0:
+                break
+            self.__fill()
+
+        head = self.buff[:end].decode('latin-1')
+        length = 0
+        for line in head.split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        total = end + 4 + length
+        while len(self.buff) < total:
+            self.__fill()
+        del self.buff[:total]
+        return int(head[9:12])
+
+    def read_until_close(self):
+        '''读取直到服务器关闭连接 (TCP 场景)
+        '''
+        while 1:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return
+            self.bytes += len(data)
+
+
+def _connect(address):
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _client(address, scenario, deadline, result_queue):
+    '''客户端进程: 在 deadline 之前不停发送请求
+
+    参数:
+        address: 服务器地址
+        scenario: 压测场景
+        deadline: 结束时间
+        result_queue: 返回 (耗时列表, 错误数, 字节数)
+    '''
+    latencies = []
+    errors = 0
+    received = 0
+    request = scenario.request()
+    sock = reader = None
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            if sock is None:
+                sock = _connect(address)
+                reader = ResponseReader(sock)
+            sock.sendall(request)
+            if scenario.kind == 'tcp':
+                reader.read_until_close()
+            else:
+                for i in range(scenario.pipeline):
+                    if reader.read_response() >= 400:
+                        errors += 1
+            latencies.append(time.time() - start)
+        except (socket.error, ValueError):
+            errors += 1
+            if sock is not None:
+                sock.close()
+            sock = None
+        if sock is not None and not scenario.keep_alive:
+            received += reader.bytes
+            sock.close()
+            sock = None
+    if sock is not None:
+        received += reader.bytes
+        sock.close()
+    result_queue.put((latencies, errors, received))
+
+
+def _slow_client(address, scenario, deadline):
+    '''慢客户端进程: 每隔一段时间发送一个字节, 一直占用连接
+
+    参数:
+        address: 服务器地址
+        scenario: 压测场景
+        deadline: 结束时间
+    '''
+    socks = []
+    try:
+        for i in range(scenario.slow_clients):
+            socks.append(_connect(address))
+    except socket.error:
+        pass
+    request = Scenario('slow').request()
+    index = 0
+    while time.time() < deadline:
+        for sock in socks:
+            try:
+                sock.send(request[index % len(request):][:1])
+            except socket.error:
+                pass
+        index += 1
+        time.sleep(scenario.slow_interval)
+    for sock in socks:
+        sock.close()
+
+
+def percentile(sorted_values, ratio):
+    '''计算分位数
+
+    参数:
+        sorted_values: 排好序的值
+        ratio: 0 到 1 之间的比例
+    '''
+    if not sorted_values:
+        return None
+    index = int(round(ratio * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run(address, scenario, concurrency, duration):
+    '''运行一个场景, 返回结果字典
+
+    参数:
+        address: 服务器地址
+        scenario: 压测场景
+        concurrency: 客户端进程数
+        duration: 持续时长 (s)
+    '''
+    result_queue = multiprocessing.Queue()
+    begin = time.time()
+    deadline = begin + duration
+    processes = []
+    if scenario.slow_clients:
+        processes.append(multiprocessing.Process(
+            target=_slow_client, args=(address, scenario, deadline)))
+    for i in range(concurrency):
+        processes.append(multiprocessing.Process(
+            target=_client, args=(address, scenario, deadline, result_queue)))
+    for process in processes:
+        process.start()
+
+    latencies = []
+    errors = received = 0
+    for i in range(concurrency):
+        part, part_errors, part_received = result_queue.get()
+        latencies.extend(part)
+        errors += part_errors
+        received += part_received
+    for process in processes:
+        process.join()
+    elapsed = time.time() - begin
+
+    latencies.sort()
+    count = len(latencies)
+    # 每次往返包含 pipeline 个请求
+    requests = count * scenario.pipeline
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'scenario': scenario.to_dict(),
+        'concurrency': concurrency,
+        'duration': round(elapsed, 3),
+        'requests': requests,
+        'errors': errors,
+        'requests_per_second': round(requests / elapsed, 1),
+        'megabytes_per_second': round(received / elapsed / 1048576, 3),
+        'latency_ms': {
+            'mean': ms(sum(latencies) / count if count else None),
+            'p50': ms(percentile(latencies, 0.5)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'p999': ms(percentile(latencies, 0.999)),
+            'max': ms(latencies[-1] if count else None),
+        },
+    }
@@ -0,0 +1,182 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+压测入口: 依次启动服务器, 运行各个场景, 输出 JSON 格式的结果.
+
+    python -m benchmark.run [--server-python stackless] [--processes 4]
+        [--tasklets 100] [--edge-triggered] [--concurrency 16]
+        [--duration 10] [--scenarios keep_alive_small,pipeline_16]
+        [--backend stackless|asyncio|both] [--asyncio-python python3]
+        [--output result.json]
+
+服务器在单独的进程中运行, 使用 --server-python 指定的解释器启动,
+所以可以用同一个压力生成器比较不同的版本或者设置.
+--backend both 时每个场景依次压测两个运行时, asyncio 运行时的服务器使用
+--asyncio-python 指定的解释器启动, 结果中的 comparison 是各个运行时的吞吐量.
+'''
+import argparse
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from benchmark import loadgen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 等待服务器启动的最长时长 (s)
+START_TIMEOUT = 10
+# 等待服务器退出的最长时长 (s)
+STOP_TIMEOUT = 10
+# 可以压测的运行时, 见 sparrowlet/__init__.py
+BACKENDS = ('stackless', 'asyncio')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='sparrowlet benchmark')
+    parser.add_argument('--server-python', default=sys.executable,
+                        help='启动服务器使用的解释器')
+    parser.add_argument('--port', type=int, default=18888)
+    parser.add_argument('--processes', type=int, default=1,
+                        help='服务器的进程数')
+    parser.add_argument('--tasklets', type=int, default=10,
+                        help='服务器每个进程的微线程数')
+    parser.add_argument('--edge-triggered', action='store_true',
+                        help='服务器使用 epoll 的边缘触发模式')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='客户端进程数')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='每个场景的持续时长 (s)')
+    parser.add_argument('--scenarios', default=None,
+                        help='逗号分隔的场景名称, 默认运行全部: ' +
+                        ','.join(x.name for x in loadgen.SCENARIOS))
+    parser.add_argument('--backend', default='stackless',
+                        choices=BACKENDS + ('both', ),
+                        help='服务器使用的运行时, both 表示依次压测并比较')
+    parser.add_argument('--asyncio-python', default='python3',
+                        help='启动 asyncio 运行时的服务器使用的解释器')
+    parser.add_argument('--output', default=None,
+                        help='结果文件, 默认输出到标准输出')
+    return parser.parse_args(argv)
+
+
+def wait_port(port, timeout):
+    '''等待端口可以连接
+
+    参数:
+        port: 端口
+        timeout: 最长等待时长 (s)
+    '''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start on port {}".format(port))
+
+
+def start_server(args, kind, backend):
+    '''启动服务器进程
+
+    参数:
+        args: 命令行参数
+        kind: 服务器类型, http 或 tcp
+        backend: 服务器的运行时, stackless 或 asyncio
+    '''
+    python = args.asyncio_python if backend == 'asyncio' \
+        else args.server_python
+    command = [python, '-m', 'benchmark.server', kind,
+               str(args.port), str(args.processes), str(args.tasklets)]
+    if args.edge_triggered:
+        command.append('et')
+    python_path = os.environ.get('PYTHONPATH')
+    python_path = ROOT + os.pathsep + python_path if python_path else ROOT
+    # 服务器的日志写到 benchmark/log 目录下
+    process = subprocess.Popen(command, cwd=os.path.join(ROOT, 'benchmark'),
+                               env=dict(os.environ, PYTHONPATH=python_path,
+                                        SPARROWLET_BACKEND=backend))
+    try:
+        wait_port(args.port, START_TIMEOUT)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def stop_server(process):
+    '''通知服务器优雅退出, 超时后强制结束
+
+    参数:
+        process: 服务器进程
+    '''
+    process.send_signal(signal.SIGTERM)
+    deadline = time.time() + STOP_TIMEOUT
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def main(argv):
+    args = parse_args(argv)
+    scenarios = loadgen.SCENARIOS
+    if args.scenarios:
+        names = args.scenarios.split(',')
+        scenarios = [x for x in scenarios if x.name in names]
+
+    backends = BACKENDS if args.backend == 'both' else (args.backend, )
+
+    results = []
+    # 场景名称 -> {运行时: 吞吐量}
+    comparison = {}
+    for scenario in scenarios:
+        for backend in backends:
+            server = start_server(args, scenario.kind, backend)
+            try:
+                result = loadgen.run(('127.0.0.1', args.port), scenario,
+                                     args.concurrency, args.duration)
+            finally:
+                stop_server(server)
+            result['backend'] = backend
+            sys.stderr.write(
+                '{name} [{backend}]: {rps} req/s, p99 {p99} ms\n'.format(
+                    name=scenario.name, backend=backend,
+                    rps=result['requests_per_second'],
+                    p99=result['latency_ms']['p99']))
+            results.append(result)
+            comparison.setdefault(scenario.name, {})[backend] = \
+                result['requests_per_second']
+
+    report = {
+        'timestamp': int(time.time()),
+        'host': platform.node(),
+        'cpu_count': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'settings': {
+            'server_python': args.server_python,
+            'asyncio_python': args.asyncio_python,
+            'backends': list(backends),
+            'processes': args.processes,
+            'tasklets': args.tasklets,
+            'edge_triggered': args.edge_triggered,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+        },
+        'results': results,
+        'comparison': comparison,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,52 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+压测使用的服务器, 直接使用 sample 中的处理类, 另外加上返回大正文的 URI.
+运行时由环境变量 SPARROWLET_BACKEND 决定, asyncio 运行时忽略 tasklet_num 和 et.
+
+    python -m benchmark.server http|tcp port process_num tasklet_num [et]
+'''
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'sample')]
+
+import sparrowlet  # noqa: E402
+from http_sample import Test  # noqa: E402
+from tcp_sample import Svr  # noqa: E402
+
+# 服务器的超时时长 (s), 需要大于慢客户端发送请求的时长
+TIMEOUT = 60
+
+
+class Big(sparrowlet.UriInterface):
+    '''返回指定大小的正文, 大小由 GET 参数 size 指定
+    '''
+    # 大小 -> 正文, 避免每次请求都生成
+    bodies = {}
+
+    def get(self):
+        size = int(self.http_data.get_params.get('size', 1024 * 1024))
+        body = self.bodies.get(size)
+        if body is None:
+            body = self.bodies[size] = 'x' * size
+        return body
+
+
+def main(argv):
+    kind, port, process_num, tasklet_num = argv[:4]
+    edge_triggered = len(argv) > 4 and argv[4] == 'et'
+    if kind == 'http':
+        svr = sparrowlet.HttpServer(int(port), TIMEOUT, int(tasklet_num),
+                                    edge_triggered=edge_triggered,
+                                    max_keep_alive_requests=0)
+        svr.register({'/test': Test, '/big': Big})
+    else:
+        svr = Svr(int(port), TIMEOUT, int(tasklet_num),
+                  edge_triggered=edge_triggered)
+    svr.run(int(process_num))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,16 +2,14 @@
 # -*- encoding:utf-8 -*-
 import sparrowlet
 
-fd_manager = sparrowlet.FdManager()
-
 
 class Svr(sparrowlet.TcpServer):
 
     def on_receive(self, fd):
-        fd_manager.send(fd, "hello world!")
+        self.fd_manager.send(fd, "hello world!")
 
     def on_send(self, fd):
-        fd_manager.remove(fd)
+        self.fd_manager.remove(fd)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,31 @@
 #!/user/bin/env python
 # -*- encoding:utf-8 -*-
-from fd import FdManager
-from loop import Loop
-from tcp_server import TcpServer
-from http_server import HttpServer
-from uri_interface import UriInterface
+'''
+运行时通过环境变量 SPARROWLET_BACKEND 选择:
+    stackless: 基于 stackless 微线程和 epoll 的 Loop (默认, 只支持 Python 2)
+    asyncio: 基于 asyncio/uvloop, 见 aio.py (只支持 Python 3)
+没有设置时, 可以导入 stackless 则使用 stackless, 否则使用 asyncio.
+两者的 TcpServer, HttpServer, UriInterface 接口相同.
+'''
+import os
+
+from .compat import stackless
+from .uri_interface import UriInterface
+from .static import StaticFiles
+
+BACKEND_STACKLESS = 'stackless'
+BACKEND_ASYNCIO = 'asyncio'
+
+BACKEND = os.environ.get('SPARROWLET_BACKEND') or \
+    (BACKEND_STACKLESS if stackless is not None else BACKEND_ASYNCIO)
+
+if BACKEND == BACKEND_STACKLESS:
+    from .fd import FdManager
+    from .loop import Loop
+    from .tcp_server import TcpServer
+    from .http_server import HttpServer
+    from .client import HttpClient, ConnectionPool
+elif BACKEND == BACKEND_ASYNCIO:
+    from .aio import FdManager, Loop, TcpServer, HttpServer
+else:
+    raise ImportError("unknown SPARROWLET_BACKEND {!r}".format(BACKEND))
@@ -0,0 +1,1303 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+asyncio 运行时.
+
+提供与 stackless 运行时 (tcp_server.py, http_server.py) 接口相同的 TcpServer 和
+HttpServer, 运行在 Python 3 的 asyncio 上, 安装了 uvloop 时使用 uvloop 的事件循环.
+通过环境变量 SPARROWLET_BACKEND=asyncio 选择, 见 __init__.py.
+
+与 stackless 运行时的区别:
+    1. 每个连接是一个 asyncio.Protocol, 收发由 transport 完成, 不再需要微线程池
+    2. on_receive, on_send 和 UriInterface 的处理函数可以是协程 (async def).
+       返回协程时在事件循环中调度, 结束之前同一连接的其他回调排队等待;
+       普通函数直接在事件循环中调用, 不能阻塞
+    3. self.loop 的 run_in_thread, run_in_process, sleep 和 fd_manager.wait_drain
+       返回 Future, 需要在协程中 await
+    4. stream_body 的处理类在正文全部接收后才调用, 大正文依旧按 spool_size 写入临时文件
+    5. 发送缓冲区超过 high_water_mark 后暂停读取, 全部发送完毕后恢复
+
+本模块不使用 async/await 语法, 以便和其他模块一起在 Python 2 下编译.
+'''
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import inspect
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from . import buff
+from . import codec as codec_module
+from . import fd
+from . import http_common
+from . import http_parser
+from . import log
+from . import master
+from . import metrics
+from . import offload
+from . import timer
+from .compat import text_type
+from .http_common import OFFLOAD_THREAD, OFFLOAD_PROCESS
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# 时间轮每个格子的最大时长 (s)
+TIMER_TICK = 1.0
+# 输出接收连接数的间隔 (s)
+ACCEPT_REPORT_INTERVAL = 60
+# 优雅退出时检查剩余连接的间隔 (s)
+STOP_CHECK_INTERVAL = 1.0
+# 监听 socket 的 backlog
+BACKLOG = 1024
+# Python 3 的 socket 模块才有这个常量, 没有时使用 Linux 上的值
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+logger = log.get_logger()
+stats = metrics.get_metrics()
+
+# 当前进程正在运行的 Loop, 见 current
+_current = [None]
+
+
+def current():
+    '''返回当前进程正在运行的 Loop, 还没有运行时返回 None
+    '''
+    return _current[0]
+
+
+def new_event_loop():
+    '''创建事件循环, 安装了 uvloop 时使用 uvloop
+    '''
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def _then(future, func):
+    '''future 完成后以 func(结果) 完成返回的 Future, 异常直接传递.
+    func 返回 Future 时以它的结果完成
+
+    参数:
+        future: asyncio.Future
+        func: 处理结果的函数
+    '''
+    result = future.get_loop().create_future()
+
+    def settle(done):
+        if done.cancelled():
+            result.cancel()
+            return
+        exc = done.exception()
+        if exc is not None:
+            result.set_exception(exc)
+            return
+        result.set_result(done.result())
+
+    def callback(done):
+        if done.cancelled() or done.exception() is not None:
+            settle(done)
+            return
+        try:
+            value = func(done.result())
+        except Exception as e:
+            result.set_exception(e)
+            return
+        if isinstance(value, asyncio.Future):
+            value.add_done_callback(settle)
+        else:
+            result.set_result(value)
+    future.add_done_callback(callback)
+    return result
+
+
+def _recover(future, func):
+    '''future 出错时以 func(异常) 完成返回的 Future, 否则以原来的结果完成
+
+    参数:
+        future: asyncio.Future
+        func: 处理异常的函数, 参数为 (类型, 实例, traceback)
+    '''
+    result = future.get_loop().create_future()
+
+    def callback(done):
+        if done.cancelled():
+            result.cancel()
+            return
+        exc = done.exception()
+        if exc is None:
+            result.set_result(done.result())
+            return
+        try:
+            result.set_result(func((type(exc), exc, exc.__traceback__)))
+        except Exception as e:
+            result.set_exception(e)
+    future.add_done_callback(callback)
+    return result
+
+
+class PeriodicHandle(object):
+    '''call_every 的定时器, 错过的次数不会补上. 与 timer.TimerHandle 一样用 cancel 取消
+    '''
+
+    def __init__(self, aio_loop, interval, callback, args):
+        '''初始化
+
+        参数:
+            aio_loop: asyncio 的事件循环
+            interval: 执行的间隔 (s)
+            callback: 回调函数
+            args: 回调函数的参数
+        '''
+        self.interval = interval
+        self.deadline = time.time() + interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.__loop = aio_loop
+        self.__handle = aio_loop.call_later(interval, self.__run)
+
+    def __run(self):
+        now = time.time()
+        self.deadline += self.interval
+        if self.deadline <= now:
+            self.deadline = now + self.interval
+        self.__handle = self.__loop.call_later(self.deadline - now, self.__run)
+        try:
+            self.callback(*self.args)
+        except Exception:
+            logger.exception("timer callback failed")
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.callback = self.args = None
+        self.__handle.cancel()
+
+
+class Connection(asyncio.Protocol):
+    '''一个客户端连接, 同时保存连接的状态, 相当于 stackless 运行时的 FdInfo.
+    事件都交给所属的 Loop 处理
+    '''
+
+    def __init__(self, loop_obj):
+        '''初始化
+
+        参数:
+            loop_obj: 所属的 Loop
+        '''
+        self.loop = loop_obj
+        self.fd = None
+        self.address = None
+        self.transport = None
+        self.received_data = buff.RecvBuff()
+        # 还没有交给 transport 的分片, 可以是字符串, FileBody 或 producer
+        self.pending = collections.deque()
+        self.pending_size = 0  # pending 中字符串和文件的字节数
+        self.parser = None
+        self.timestamp = time.time()  # 上一次收发数据的时间
+        self.closed = False
+        self.paused = False  # 发送缓冲区超过高水位, 暂停读取
+        self.idle = False  # 空闲的长连接, 使用 keep_alive_timeout
+        self.eof = False  # 对端已经关闭写方向
+        self.running = False  # 有返回协程的回调还没有结束
+        self.ready = False  # 有新数据还没有交给 on_receive
+        self.deferred = collections.deque()  # 协程结束后依次执行的回调
+        self.send_notify = False  # 数据全部发送后通知 on_send
+        self.send_start = 0
+        self.drain_waiters = []  # wait_drain 返回的 Future
+
+    @property
+    def received_size(self):
+        return len(self.received_data)
+
+    @property
+    def send_size(self):
+        '''尚未发送的字节数, 不包含 producer 还没有生成的数据
+        '''
+        return self.transport.get_write_buffer_size() + self.pending_size
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # 每次写入后都检查缓冲区: 没能立即发送完时 pause_writing,
+        # 全部发送完毕时 resume_writing, 用来通知 on_send
+        transport.set_write_buffer_limits(0)
+        self.fd = transport.get_extra_info('socket').fileno()
+        self.address = transport.get_extra_info('peername')
+        self.loop.event_new(self)
+
+    def data_received(self, data):
+        self.loop.event_receive(self, data)
+
+    def eof_received(self):
+        return self.loop.event_eof(self)
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        self.loop.event_drained(self)
+
+    def connection_lost(self, exc):
+        self.loop.event_lost(self, exc)
+
+    def queue(self, data):
+        '''把数据放进待发送队列
+
+        参数:
+            data: 字符串, 字符串的列表, 列表的最后一项可以是 producer
+        '''
+        if not self.send_notify:
+            self.send_notify = True
+            self.send_start = time.time()
+        if isinstance(data, (list, tuple)):
+            for item in data:
+                self.__append(item)
+        else:
+            self.__append(data)
+
+    def __append(self, data):
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        if not buff.is_producer(data):
+            if not data:
+                if isinstance(data, buff.FileBody):
+                    data.close()
+                return
+            self.pending_size += len(data)
+        self.pending.append(data)
+
+    def pump(self):
+        '''把待发送的分片交给 transport, transport 的缓冲区达到
+        fd.PRODUCE_SIZE 时停止, 发送完后由 resume_writing 继续.
+        producer 抛出的异常会直接抛出, 由调用者关闭连接
+
+        返回数据是否已经全部发送完毕
+        '''
+        pending = self.pending
+        transport = self.transport
+        while pending and \
+                transport.get_write_buffer_size() < fd.PRODUCE_SIZE:
+            head = pending[0]
+            if isinstance(head, buff.FileBody):
+                data = head.read(buff.FILE_CHUNK_SIZE)
+                self.pending_size -= len(data)
+                if len(head) == 0:
+                    head.close()
+                    pending.popleft()
+            elif buff.is_producer(head):
+                try:
+                    data = next(head)
+                except StopIteration:
+                    pending.popleft()
+                    continue
+                if isinstance(data, text_type):
+                    data = data.encode('utf-8')
+            else:
+                # 开头连续的内存分片 (例如 HTTP 头和正文) 一次交给 transport,
+                # 避免分成多个小包
+                data = self.__gather()
+                self.pending_size -= len(data)
+            if data:
+                transport.write(data)
+                stats.incr('bytes_out', len(data))
+        return not pending and transport.get_write_buffer_size() == 0
+
+    def __gather(self):
+        '''取出开头的内存分片, 之后的小分片合并进来, 合并后不超过
+        buff.COALESCE_SIZE, 大分片不复制
+        '''
+        pending = self.pending
+        data = pending.popleft()
+        size = len(data)
+        buffers = [data]
+        while pending and isinstance(pending[0], bytes) and \
+                size + len(pending[0]) <= buff.COALESCE_SIZE:
+            data = pending.popleft()
+            size += len(data)
+            buffers.append(data)
+        if len(buffers) == 1:
+            return buffers[0]
+        return b''.join(buffers)
+
+    def close(self):
+        '''关闭连接, 丢弃还没有交给 transport 的数据
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        for data in self.pending:
+            close = getattr(data, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    logger.error(str(e))
+        self.pending.clear()
+        self.pending_size = 0
+        self.wake_drain(False)
+        self.transport.close()
+
+    def wake_drain(self, alive=True):
+        '''唤醒 wait_drain 的等待者
+
+        参数:
+            alive: 连接是否仍然可用
+        '''
+        waiters, self.drain_waiters = self.drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(alive)
+
+
+class FdManager(object):
+    '''连接表, 接口与 stackless 运行时的 fd.FdManager 相同:
+    1. 删除指定 fd: remove
+    2. 指定 fd 发送数据: send, queue
+    3. 等待指定 fd 的发送缓冲区清空: wait_drain, 返回 Future
+    4. 弹出接收到的数据: pop_received_data
+    5. 查询: get, fd in fd_manager, fd_manager[fd], len, items, keys
+    '''
+
+    def __init__(self, loop_obj, high_water=fd.HIGH_WATER_MARK):
+        '''初始化
+
+        参数:
+            loop_obj: 所属的 Loop
+            high_water: 超过该字节数后暂停读取连接, None 表示不限制
+        '''
+        self.__loop = loop_obj
+        self.__table = {}
+        self.__high_water = high_water
+
+    def get(self, fd, default=None):
+        return self.__table.get(fd, default)
+
+    def __getitem__(self, fd):
+        return self.__table[fd]
+
+    def __contains__(self, fd):
+        return fd in self.__table
+
+    def __len__(self):
+        return len(self.__table)
+
+    def items(self):
+        return list(self.__table.items())
+
+    def keys(self):
+        return list(self.__table)
+
+    def new(self, conn):
+        '''加入新的连接
+
+        参数:
+            conn: Connection 实例
+        '''
+        self.__table[conn.fd] = conn
+        stats.incr('connections')
+
+    def remove(self, fd):
+        '''关闭并删除连接, 不存在时自动忽略
+
+        参数:
+            fd: 文件描述子
+        '''
+        conn = self.__table.pop(fd, None)
+        if conn is None:
+            return
+        stats.incr('connections', -1)
+        conn.close()
+
+    def receive(self, fd):
+        '''数据由 transport 推送, 不需要主动接收. 返回对端是否已经关闭写方向
+
+        参数:
+            fd: 文件描述子
+        '''
+        conn = self.get(fd)
+        return conn is not None and conn.eof
+
+    def pop_received_data(self, fd):
+        '''返回并清空接收到的数据
+
+        参数:
+            fd: 文件描述子
+        '''
+        conn = self.get(fd)
+        if conn is None:
+            logger.error("Invalid fd {fd}".format(fd=fd))
+            return b''
+        return conn.received_data.pop_str()
+
+    def queue(self, fd, data):
+        '''把数据放进发送队列, 之后调用 send 一起发送
+
+        参数:
+            fd: 指定文件描述子
+            data: 待传送数据
+
+        返回发送队列是否超过高水位, 此时应该先调用 send
+        '''
+        conn = self.get(fd)
+        if conn is None:
+            logger.error("Invalid fd {fd}".format(fd=fd))
+            return False
+        conn.queue(data)
+        return self.__high_water is not None and \
+            conn.send_size > self.__high_water
+
+    def send(self, fd, data=None):
+        '''指定 fd 传送数据
+
+        参数:
+            fd: 指定文件描述子
+            data: 新的待传送数据, 格式见 fd.FdInfo.send
+
+        返回待传送数据是否已经全部发送完毕.
+        发送出错 (包括 producer 抛出异常) 时关闭连接并返回 False
+        '''
+        conn = self.get(fd)
+        if conn is None:
+            logger.error("Invalid fd {fd}".format(fd=fd))
+            return
+        conn.timestamp = time.time()
+        if data is not None:
+            conn.queue(data)
+        return self.flush(conn)
+
+    def flush(self, conn):
+        '''把发送队列交给 transport, 更新暂停状态
+
+        参数:
+            conn: Connection 实例
+        '''
+        try:
+            finished = conn.pump()
+        except Exception as e:
+            logger.exception("{fd} send failed: {e}".format(fd=conn.fd, e=e))
+            self.remove(conn.fd)
+            return False
+
+        if finished and conn.send_notify:
+            conn.send_notify = False
+            stats.observe('send', time.time() - conn.send_start)
+            self.__loop.notify_send(conn)
+
+        if self.__high_water is not None:
+            if not conn.paused and conn.send_size > self.__high_water:
+                conn.paused = True
+                conn.transport.pause_reading()
+                stats.incr('read_pauses')
+            elif conn.paused and finished:
+                conn.paused = False
+                conn.transport.resume_reading()
+                self.__loop.notify_resume(conn)
+        return finished
+
+    def wait_drain(self, fd):
+        '''返回 Future, 连接暂停读取时在发送缓冲区清空后完成, 结果为连接是否仍然可用
+
+        参数:
+            fd: 指定文件描述子
+        '''
+        conn = self.get(fd)
+        waiter = self.__loop.aio_loop.create_future()
+        if conn is None:
+            waiter.set_result(False)
+        elif not conn.paused:
+            waiter.set_result(True)
+        else:
+            conn.drain_waiters.append(waiter)
+        return waiter
+
+
+class Loop(object):
+    '''asyncio 事件循环的封装, 接口与 stackless 运行时的 loop.Loop 相同.
+    负责把连接的事件交给 on_receive/on_send, 以及超时和优雅退出
+    '''
+
+    def __init__(self, listen_fd, timeout, handlers, read_timeout=None,
+                 write_timeout=None, keep_alive_timeout=None,
+                 high_water_mark=fd.HIGH_WATER_MARK,
+                 offload_threads=offload.THREAD_NUM, offload_processes=0,
+                 aio_loop=None):
+        '''初始化
+
+        参数:
+            listen_fd: 监听的 socket
+            timeout: 超时时长 (s)
+            handlers: (on_receive, on_send)
+            read_timeout: 等待请求数据的超时时长, None 表示与 timeout 相同
+            write_timeout: 有数据待发送时的超时时长, None 表示与 timeout 相同
+            keep_alive_timeout: 空闲长连接的超时时长, None 表示与 timeout 相同
+            high_water_mark: 连接的发送缓冲区超过该字节数后暂停读取
+            offload_threads: 执行阻塞调用的线程数
+            offload_processes: 执行 CPU 密集调用的进程池大小, 0 表示与 CPU 核数相同
+            aio_loop: asyncio 的事件循环, None 表示新建
+        '''
+        self.listen_fd = listen_fd
+        self.on_receive, self.on_send = handlers
+        self.aio_loop = aio_loop or new_event_loop()
+        self.fd_manager = FdManager(self, high_water_mark)
+        self.read_timeout = timeout if read_timeout is None else read_timeout
+        self.write_timeout = timeout if write_timeout is None \
+            else write_timeout
+        self.keep_alive_timeout = timeout if keep_alive_timeout is None \
+            else keep_alive_timeout
+        self.tick = min(TIMER_TICK, self.read_timeout, self.write_timeout,
+                        self.keep_alive_timeout)
+        self.__wheel = timer.TimerWheel(time.time(), self.tick)
+        self.__offload_threads = offload_threads
+        self.__offload_processes = offload_processes or None
+        self.__thread_pool = None
+        self.__process_pool = None
+        self.__server = None
+        # 数据已经全部发送完毕, 等待通知 on_send 的连接
+        self.__flushed = []
+        # 发送缓冲区已经清空, 等待恢复处理的连接
+        self.__resumed = []
+        self.__notify_scheduled = False
+        self.__stop_deadline = None
+        self.accept_count = 0
+
+    def call_at(self, when, callback, *args):
+        '''在时间戳 when 执行 callback(*args), 返回可以 cancel 的句柄
+        '''
+        return self.aio_loop.call_later(max(0.0, when - time.time()),
+                                        callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        '''delay 秒后执行 callback(*args), 返回可以 cancel 的句柄
+        '''
+        return self.aio_loop.call_later(delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        '''每隔 interval 秒执行 callback(*args), 返回可以 cancel 的句柄
+        '''
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        return PeriodicHandle(self.aio_loop, interval, callback, args)
+
+    def sleep(self, seconds):
+        '''返回 seconds 秒后完成的 Future
+        '''
+        return asyncio.ensure_future(asyncio.sleep(seconds),
+                                     loop=self.aio_loop)
+
+    def run_in_thread(self, func, *args, **kargs):
+        '''在线程池中调用阻塞的函数, 返回结果的 Future
+
+        参数:
+            func: 调用的函数
+            args: 位置参数
+            kargs: 关键字参数
+        '''
+        if self.__thread_pool is None:
+            self.__thread_pool = concurrent.futures.ThreadPoolExecutor(
+                self.__offload_threads)
+        return self.aio_loop.run_in_executor(
+            self.__thread_pool, functools.partial(func, *args, **kargs))
+
+    def run_in_process(self, func, *args, **kargs):
+        '''在进程池中调用占用 CPU 的函数, 返回结果的 Future.
+        func 需要是模块级的函数, 参数和返回值都需要能被 pickle.
+        参数不能 pickle 时直接抛出异常, 返回值不能 pickle 时 Future 的异常为
+        offload.OffloadError, 见 offload.py
+
+        参数:
+            func: 调用的函数
+            args: 位置参数
+            kargs: 关键字参数
+        '''
+        if self.__process_pool is None:
+            self.__process_pool = concurrent.futures.ProcessPoolExecutor(
+                self.__offload_processes, initializer=self.__close_inherited)
+        payload = offload.pack_call(func, args, kargs)
+        return _then(self.aio_loop.run_in_executor(
+            self.__process_pool, offload.call_packed, payload),
+            offload.unpack_result)
+
+    def __close_inherited(self):
+        '''在进程池的子进程中关闭从 Loop 继承的 socket,
+        否则 Loop 关闭连接后对端仍然收不到 FIN
+        '''
+        fds = self.fd_manager.keys()
+        fds.append(self.listen_fd.fileno())
+        for fileno in fds:
+            try:
+                os.close(fileno)
+            except OSError:
+                pass
+
+    def event_new(self, conn):
+        '''新连接
+        '''
+        self.fd_manager.new(conn)
+        self.accept_count += 1
+        stats.incr('accepts')
+        self.__schedule(conn)
+
+    def event_receive(self, conn, data):
+        '''收到数据, 交给 on_receive
+        '''
+        stats.incr('bytes_in', len(data))
+        conn.received_data.append(data)
+        conn.timestamp = time.time()
+        conn.ready = True
+        self.__schedule(conn)
+        self.__dispatch(conn, self.on_receive)
+
+    def event_eof(self, conn):
+        '''对端关闭写方向. 没有未处理的数据时关闭连接,
+        否则保留写方向, 等处理完后由 __notify 关闭
+        '''
+        conn.eof = True
+        if conn.received_size == 0 and not conn.running and \
+                conn.send_size == 0:
+            self.fd_manager.remove(conn.fd)
+            return False
+        return True
+
+    def event_drained(self, conn):
+        '''transport 的发送缓冲区已经清空
+        '''
+        if not conn.closed:
+            conn.timestamp = time.time()
+            self.fd_manager.flush(conn)
+
+    def event_lost(self, conn, exc):
+        '''连接已经关闭
+        '''
+        if exc is not None:
+            logger.error("{fd} {e}".format(fd=conn.fd, e=exc))
+        if self.fd_manager.get(conn.fd) is conn:
+            self.fd_manager.remove(conn.fd)
+        self.__wheel.remove(conn.fd)
+
+    def notify_send(self, conn):
+        '''数据已经全部发送, 在回调返回后通知 on_send
+        '''
+        self.__flushed.append(conn)
+        self.__schedule_notify()
+
+    def notify_resume(self, conn):
+        '''发送缓冲区已经清空, 在回调返回后恢复处理已经收到的数据
+        '''
+        self.__resumed.append(conn)
+        self.__schedule_notify()
+
+    def __schedule_notify(self):
+        if not self.__notify_scheduled:
+            self.__notify_scheduled = True
+            self.aio_loop.call_soon(self.__notify)
+
+    def __notify(self):
+        '''通知 on_send, 恢复暂停的连接. 与 stackless 运行时一样在当前回调返回后执行,
+        处理函数中调用 send 时不会重入 on_send
+        '''
+        self.__notify_scheduled = False
+        fd_manager = self.fd_manager
+        flushed, self.__flushed = self.__flushed, []
+        for conn in flushed:
+            if fd_manager.get(conn.fd) is not conn:
+                continue
+            self.__dispatch(conn, self.on_send)
+            self.__schedule(conn)
+            # 对端已经关闭写方向, 处理完后关闭连接
+            if conn.eof and not conn.running and conn.received_size == 0 \
+                    and conn.send_size == 0:
+                fd_manager.remove(conn.fd)
+
+        resumed, self.__resumed = self.__resumed, []
+        for conn in resumed:
+            conn.wake_drain()
+            if fd_manager.get(conn.fd) is conn and conn.received_size > 0:
+                conn.ready = True
+                self.__dispatch(conn, self.on_receive)
+
+    def __dispatch(self, conn, callback):
+        '''调用 on_receive/on_send. 返回协程或 Future 时在事件循环中等待,
+        结束之前该连接的其他回调排队, 保证同一连接的回调按顺序执行
+
+        参数:
+            conn: Connection 实例
+            callback: on_receive 或 on_send
+        '''
+        if conn.running:
+            if callback not in conn.deferred:
+                conn.deferred.append(callback)
+            return
+        while 1:
+            if callback is self.on_receive:
+                conn.ready = False
+            try:
+                result = callback(conn.fd)
+            except Exception:
+                logger.exception("{} handler failed".format(conn.fd))
+                self.fd_manager.remove(conn.fd)
+                return
+            if result is not None and inspect.isawaitable(result):
+                conn.running = True
+                future = asyncio.ensure_future(result, loop=self.aio_loop)
+                future.add_done_callback(
+                    functools.partial(self.__finish, conn))
+                return
+            if conn.closed or not conn.deferred:
+                return
+            callback = conn.deferred.popleft()
+
+    def __finish(self, conn, future):
+        '''协程回调结束, 执行排队的回调
+
+        参数:
+            conn: Connection 实例
+            future: 回调的 Future
+        '''
+        conn.running = False
+        if future.cancelled():
+            self.fd_manager.remove(conn.fd)
+            return
+        exc = future.exception()
+        if exc is not None:
+            logger.error("{} handler failed".format(conn.fd),
+                         exc_info=(type(exc), exc, exc.__traceback__))
+            self.fd_manager.remove(conn.fd)
+            return
+        if self.fd_manager.get(conn.fd) is not conn:
+            return
+        # 协程执行期间收到了新数据, 或者还有没有处理完的请求
+        if conn.ready and not conn.paused and \
+                self.on_receive not in conn.deferred:
+            conn.deferred.append(self.on_receive)
+        if conn.deferred:
+            self.__dispatch(conn, conn.deferred.popleft())
+
+    def __get_timeout(self, conn):
+        '''依据连接的状态选择超时时长
+        '''
+        if conn.send_size > 0 or conn.pending:
+            return self.write_timeout
+        if conn.idle:
+            return self.keep_alive_timeout
+        return self.read_timeout
+
+    def __schedule(self, conn):
+        '''依据上一次操作的时间更新连接在时间轮中的截止时间
+        '''
+        self.__wheel.add(conn.fd, conn.timestamp + self.__get_timeout(conn))
+
+    def __check_timeout(self):
+        '''淘汰到达截止时间的连接, 到期后会重新计算截止时间
+        '''
+        now = time.time()
+        for fileno in self.__wheel.expire(now):
+            conn = self.fd_manager.get(fileno)
+            if conn is None:
+                continue
+            deadline = conn.timestamp + self.__get_timeout(conn)
+            if deadline <= now:
+                logger.info("{fd} timeout".format(fd=fileno))
+                self.fd_manager.remove(fileno)
+                stats.incr('timeouts')
+            else:
+                self.__wheel.add(fileno, deadline)
+
+    def stop(self, timeout):
+        '''优雅退出: 停止接收新连接, 关闭空闲的长连接,
+        等待其余连接处理完毕后 run 返回, 最多等待 timeout 秒
+
+        参数:
+            timeout: 最长等待时长 (s)
+        '''
+        if self.__stop_deadline is not None:
+            return
+        self.__stop_deadline = time.time() + timeout
+        if self.__server is not None:
+            self.__server.close()
+        logger.info("pid {} stop listening, {} connections left".format(
+            os.getpid(), len(self.fd_manager)))
+        self.__check_stop()
+
+    @property
+    def stopping(self):
+        '''是否正在优雅退出
+        '''
+        return self.__stop_deadline is not None
+
+    def __check_stop(self):
+        '''优雅退出时关闭空闲的连接, 全部关闭或者超时后结束事件循环
+        '''
+        fd_manager = self.fd_manager
+        for fileno, conn in fd_manager.items():
+            if conn.idle and not conn.running and conn.send_size == 0:
+                fd_manager.remove(fileno)
+
+        if len(fd_manager) > 0:
+            if time.time() < self.__stop_deadline:
+                self.aio_loop.call_later(STOP_CHECK_INTERVAL,
+                                         self.__check_stop)
+                return
+            logger.error("pid {} force close {} connections".format(
+                os.getpid(), len(fd_manager)))
+            for fileno in fd_manager.keys():
+                fd_manager.remove(fileno)
+        self.aio_loop.stop()
+
+    def __report(self):
+        '''定期输出该进程接收的连接数, 用来观察各个进程之间的负载是否均衡
+        '''
+        logger.info("pid {} accepted {} connections, {} active".format(
+            os.getpid(), self.accept_count, len(self.fd_manager)))
+
+    def run(self):
+        '''运行事件循环, 优雅退出后返回
+        '''
+        _current[0] = self
+        aio_loop = self.aio_loop
+        asyncio.set_event_loop(aio_loop)
+        self.__server = aio_loop.run_until_complete(aio_loop.create_server(
+            lambda: Connection(self), sock=self.listen_fd, backlog=BACKLOG))
+        self.call_every(self.tick, self.__check_timeout)
+        self.call_every(ACCEPT_REPORT_INTERVAL, self.__report)
+        logger.info("pid {} running on {}".format(
+            os.getpid(), type(aio_loop).__module__))
+        try:
+            aio_loop.run_forever()
+        finally:
+            for pool in (self.__thread_pool, self.__process_pool):
+                if pool is not None:
+                    pool.shutdown()
+            aio_loop.close()
+            logger.info("pid {} loop exited".format(os.getpid()))
+
+
+class TcpServer(object):
+    '''基于 asyncio 的 TCP 服务器, 接口与 stackless 运行时的 TcpServer 相同.
+
+    on_receive 和 on_send 可以是普通函数, 也可以是协程:
+
+        class Svr(TcpServer):
+
+            async def on_receive(self, fd):
+                data = self.fd_manager.pop_received_data(fd)
+                result = await self.loop.run_in_thread(query, data)
+                self.fd_manager.send(fd, result)
+
+    设置 codec 后按消息处理, on_message 同样可以是协程,
+    返回协程时等待它结束后才处理下一条消息.
+    '''
+
+    def __init__(self, port, timeout, tasklet_num=0, read_timeout=None,
+                 write_timeout=None, keep_alive_timeout=None,
+                 edge_triggered=False, batch_size=-1, reuse_port=False,
+                 exclusive_accept=False, graceful_timeout=30,
+                 high_water_mark=fd.HIGH_WATER_MARK,
+                 low_water_mark=fd.LOW_WATER_MARK, max_tasklet_num=None,
+                 offload_threads=offload.THREAD_NUM, offload_processes=0,
+                 codec=None):
+        '''初始化, 参数见 tcp_server.TcpServer.
+        tasklet_num, max_tasklet_num, edge_triggered, batch_size,
+        exclusive_accept 和 low_water_mark 只对 stackless 运行时有效, 这里会被忽略
+        '''
+        self.__port = port
+        self.__timeout = timeout
+        self.__read_timeout = read_timeout
+        self.__write_timeout = write_timeout
+        self.__keep_alive_timeout = keep_alive_timeout
+        self.__reuse_port = reuse_port
+        self.__graceful_timeout = graceful_timeout
+        self.__high_water_mark = high_water_mark
+        self.__offload_threads = offload_threads
+        self.__offload_processes = offload_processes
+        self.codec = codec
+        # 当前进程的 Loop 和它的连接表, 进程启动后才会创建
+        self.loop = None
+        self.fd_manager = None
+
+        self.__listen_fd = None
+        if not reuse_port:
+            self.__listen_fd = self.__init_listener(port)
+
+    def __init_listener(self, port, reuse_port=False):
+        '''初始化监听 socket
+
+        参数:
+            port: 监听端口
+            reuse_port: 是否设置 SO_REUSEPORT
+        '''
+        listen_fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        listen_fd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            listen_fd.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        listen_fd.bind(('', port))
+        listen_fd.listen(BACKLOG)
+        listen_fd.setblocking(0)
+        logger.info("initialize listener finished, port={}".format(port))
+        return listen_fd
+
+    def __on_stop(self, signum):
+        '''收到 SIGTERM/SIGINT 后停止接收新连接, 处理完已有连接后退出
+        '''
+        logger.info("signal {} received, stopping".format(signum))
+        self.loop.stop(self.__graceful_timeout)
+
+    def __single_process_run(self, index=0):
+        '''单进程启动
+
+        参数:
+            index: 多进程模式下 worker 的编号
+        '''
+        listen_fd = self.__listen_fd
+        if self.__reuse_port:
+            listen_fd = self.__init_listener(self.__port, reuse_port=True)
+
+        loop_obj = Loop(listen_fd, self.__timeout,
+                        (self.on_receive, self.on_send),
+                        read_timeout=self.__read_timeout,
+                        write_timeout=self.__write_timeout,
+                        keep_alive_timeout=self.__keep_alive_timeout,
+                        high_water_mark=self.__high_water_mark,
+                        offload_threads=self.__offload_threads,
+                        offload_processes=self.__offload_processes)
+        self.loop = loop_obj
+        self.fd_manager = loop_obj.fd_manager
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop_obj.aio_loop.add_signal_handler(signum, self.__on_stop,
+                                                 signum)
+        loop_obj.run()
+
+    def run(self, process_num=1, cpu_affinity=False):
+        '''支持多进程和单进程启动, 见 tcp_server.TcpServer.run
+
+        参数:
+            process_num: 进程数, 默认为1, 如果设置为0则依据 CPU 核数决定
+            cpu_affinity: 多进程时是否把每个 worker 绑定到不同的 CPU
+        '''
+        if process_num == 0:
+            process_num = multiprocessing.cpu_count()
+
+        if process_num > 1:
+            # 统计数据的共享内存需要在 fork 之前创建
+            metrics.get_metrics().init(process_num)
+            master_obj = master.Master(
+                self.__single_process_run, process_num,
+                cpu_affinity=cpu_affinity,
+                graceful_timeout=self.__graceful_timeout)
+            master_obj.run()
+        else:
+            self.__single_process_run()
+
+    def __decoder(self, conn):
+        '''返回连接的消息解码器, 第一次使用时创建
+
+        参数:
+            conn: Connection 实例
+        '''
+        decoder = conn.parser
+        if decoder is None:
+            decoder = conn.parser = self.codec()
+        return decoder
+
+    def on_receive(self, fd):
+        '''接收完毕后的操作, 可以是协程.
+        设置了 codec 时一次取出所有完整的消息, 依次交给 on_message,
+        消息格式错误或者超过长度限制时关闭连接
+        '''
+        if self.codec is None:
+            return
+        conn = self.fd_manager.get(fd)
+        if conn is None:
+            return
+
+        try:
+            frames = self.__decoder(conn).decode(conn.received_data)
+        except codec_module.FrameError as e:
+            logger.error("{fd} frame error: {e}".format(fd=fd, e=e))
+            self.fd_manager.remove(fd)
+            return
+        if not frames:
+            return
+        stats.incr('messages', len(frames))
+        return self.__deliver(conn, iter(frames))
+
+    def __deliver(self, conn, frames, done=None):
+        '''依次把消息交给 on_message. on_message 返回协程时返回 Future,
+        协程结束后继续处理剩余的消息, 全部处理完时 Future 完成
+
+        参数:
+            conn: Connection 实例
+            frames: 剩余消息的迭代器
+            done: 已经返回给 Loop 的 Future, 第一次调用时为 None
+        '''
+        for frame in frames:
+            try:
+                result = self.on_message(conn.fd, frame)
+            except Exception as e:
+                if done is None:
+                    raise
+                done.set_exception(e)
+                return done
+            # 处理消息时连接可能已经关闭
+            if conn.closed:
+                break
+            if result is not None and inspect.isawaitable(result):
+                aio_loop = self.loop.aio_loop
+                if done is None:
+                    done = aio_loop.create_future()
+                future = asyncio.ensure_future(result, loop=aio_loop)
+                future.add_done_callback(
+                    functools.partial(self.__resume, conn, frames, done))
+                return done
+        if done is not None:
+            done.set_result(None)
+        return done
+
+    def __resume(self, conn, frames, done, future):
+        '''on_message 返回的协程结束, 继续处理剩余的消息
+
+        参数:
+            conn: Connection 实例
+            frames: 剩余消息的迭代器
+            done: 返回给 Loop 的 Future
+            future: 结束的协程
+        '''
+        if future.cancelled():
+            done.cancel()
+        elif future.exception() is not None:
+            done.set_exception(future.exception())
+        else:
+            self.__deliver(conn, frames, done)
+
+    def on_message(self, fd, frame):
+        '''设置了 codec 时, 收到一条完整消息后的操作, 可以是协程
+
+        参数:
+            fd: 文件描述子
+            frame: 消息内容 (bytes), 不包含长度前缀或者分隔符
+        '''
+        pass
+
+    def send_message(self, fd, frame):
+        '''使用该连接的解码器编码一条消息并发送, 返回值同 fd_manager.send
+
+        参数:
+            fd: 文件描述子
+            frame: 消息内容
+        '''
+        conn = self.fd_manager.get(fd)
+        if conn is None:
+            logger.error("Invalid fd {fd}".format(fd=fd))
+            return False
+        return self.fd_manager.send(fd, self.__decoder(conn).encode(frame))
+
+    def on_send(self, fd):
+        '''发送完毕后的操作, 可以是协程
+        '''
+        pass
+
+
+class HttpServer(http_common.HttpServerMixin, TcpServer):
+    '''基于 asyncio 的 HTTP 服务器, 接口与 stackless 运行时的 HttpServer 相同.
+    UriInterface 的处理函数可以是协程:
+
+        class User(UriInterface):
+
+            async def get(self):
+                return await load_user(self.http_data.get_params['id'])
+    '''
+
+    def __init__(self, port, timeout, tasklet_num=0, keep_alive_timeout=None,
+                 max_keep_alive_requests=100, cache_max_bytes=64 * 1024 * 1024,
+                 stats_path=None, max_body_size=http_parser.MAX_BODY_SIZE,
+                 spool_size=http_parser.SPOOL_SIZE, **kargs):
+        '''初始化, 参数见 http_server.HttpServer
+        '''
+        TcpServer.__init__(self, port, timeout, tasklet_num,
+                           keep_alive_timeout=keep_alive_timeout, **kargs)
+        self._init_http(max_keep_alive_requests, cache_max_bytes, stats_path,
+                        max_body_size, spool_size)
+
+    def __call(self, uri_cls, uri_obj, method):
+        '''调用处理函数. 结果是协程或者交给了线程池/进程池时返回 Future
+
+        参数:
+            uri_cls: 处理类
+            uri_obj: 处理类的实例
+            method: 处理函数名, 例如 get
+        '''
+        offload = getattr(uri_cls, 'offload', None)
+        if offload is None:
+            content = getattr(uri_obj, method)()
+            if inspect.isawaitable(content):
+                return asyncio.ensure_future(content,
+                                             loop=self.loop.aio_loop)
+            return content
+        if offload == OFFLOAD_THREAD:
+            return self.loop.run_in_thread(getattr(uri_obj, method))
+        if offload == OFFLOAD_PROCESS:
+            def unpack(result):
+                content, uri_obj.status, uri_obj.headers = result
+                return content
+            return _then(self.loop.run_in_process(
+                http_common.call_in_process, uri_cls, method,
+                uri_obj.http_data), unpack)
+        raise ValueError("unknown offload {!r} of {}".format(
+            offload, uri_cls.__name__))
+
+    def _produce(self, uri_cls, uri_obj, method, keep_alive):
+        '''调用处理函数并格式化结果, 返回响应分片或者响应分片的 Future.
+        处理函数 (包括协程) 抛出异常时返回 500, 与 stackless 的运行时相同
+
+        参数:
+            uri_cls: 处理类
+            uri_obj: 处理类的实例
+            method: 处理函数名, 例如 get
+            keep_alive: 是否保持连接
+        '''
+        def failed(exc_info):
+            return self._handler_failed(uri_cls, uri_obj, exc_info)
+
+        try:
+            content = self.__call(uri_cls, uri_obj, method)
+        except Exception:
+            content = failed(sys.exc_info())
+        if isinstance(content, asyncio.Future):
+            return _then(_recover(content, failed), lambda data: self._respond(
+                uri_obj, data, keep_alive))
+        return self._respond(uri_obj, content, keep_alive)
+
+    def _fetch(self, key, ttl, producer):
+        '''从响应缓存获取, 未命中时调用 producer 生成并缓存, 见 cache.ResponseCache.
+        同一个 key 同时只会生成一次, 其余请求等待一个 Future:
+        响应缓存了才以它完成, 否则以 None 完成, 等待的请求各自重新生成
+
+        参数:
+            key: 缓存的 key
+            ttl: 有效时长 (s)
+            producer: 返回响应分片或者 Future 的函数
+        '''
+        response_cache = self.response_cache
+        data = response_cache.lookup(key)
+        if data is not None:
+            return data
+        pending = response_cache.waiter(key)
+        if pending is not None:
+            return _then(pending, lambda data: producer() if data is None
+                         else data)
+
+        shared = self.loop.aio_loop.create_future()
+        response_cache.begin(key, shared)
+        try:
+            data = producer()
+        except Exception:
+            shared.set_result(response_cache.finish(key, None, ttl))
+            raise
+        if not isinstance(data, asyncio.Future):
+            shared.set_result(response_cache.finish(key, data, ttl))
+            return data
+
+        def done(future):
+            result = None
+            if not future.cancelled() and future.exception() is None:
+                result = future.result()
+            shared.set_result(response_cache.finish(key, result, ttl))
+        data.add_done_callback(done)
+        return data
+
+    def __send_later(self, fd, pending, handle_start):
+        '''处理函数的结果返回后发送, 返回发送完成的 Future.
+        已经收到的后续请求由 Loop 在 Future 完成后交给 on_receive
+
+        参数:
+            fd: 文件描述子
+            pending: 响应分片的 Future
+            handle_start: 开始处理的时间
+        '''
+        def send(send_data):
+            stats.observe('handler', time.time() - handle_start)
+            conn = self.fd_manager.get(fd)
+            if conn is None or not send_data:
+                return
+            stats.count_status(http_common.response_status(send_data))
+            self.fd_manager.send(fd, send_data)
+            # 流式响应发送完之前不处理后续的请求, 由 on_send 继续
+            if conn.received_size > 0 and \
+                    not buff.is_producer(send_data[-1]):
+                conn.ready = True
+        return _then(pending, send)
+
+    def on_receive(self, fd):
+        '''接收到数据后的操作, 见 http_server.HttpServer.on_receive.
+        处理函数是协程或者交给了线程池/进程池时, 返回发送完成的 Future,
+        该连接的后续请求在它完成后继续处理
+        '''
+        fd_manager = self.fd_manager
+        conn = fd_manager.get(fd)
+        if conn is None:
+            return
+        if conn.parser is None:
+            conn.parser = http_parser.HttpParser(self.max_body_size,
+                                                 self.spool_size)
+        conn.idle = False
+
+        parser = conn.parser
+        queued = False
+        while parser.keep_alive and not conn.paused:
+            start = time.time()
+            http_data, error = self._parse(fd, parser, conn.received_data)
+            if error is not None:
+                fd_manager.queue(fd, error)
+                queued = True
+                break
+
+            if http_data is None:
+                break
+
+            handle_start = time.time()
+            stats.observe('parse', handle_start - start)
+            parser.keep_alive = self._keep_alive(http_data, parser)
+            send_data = self._handle(fd, http_data, parser.keep_alive)
+            if isinstance(send_data, asyncio.Future):
+                if queued:
+                    fd_manager.send(fd)
+                return self.__send_later(fd, send_data, handle_start)
+            stats.observe('handler', time.time() - handle_start)
+            if send_data:
+                stats.count_status(http_common.response_status(send_data))
+                queued = True
+                if fd_manager.queue(fd, send_data):
+                    queued = False
+                    fd_manager.send(fd)
+                    if conn.closed:
+                        return
+                if buff.is_producer(send_data[-1]):
+                    break
+
+        if queued:
+            fd_manager.send(fd)
+
+    def on_send(self, fd):
+        '''发送完后的操作
+        长连接保留 fd 等待下一个请求, 否则关闭连接.
+        流式响应期间收到的后续请求在这里继续处理
+        '''
+        conn = self.fd_manager.get(fd)
+        if conn is None:
+            return
+
+        parser = conn.parser
+        if parser is None or not parser.keep_alive:
+            self.fd_manager.remove(fd)
+        elif conn.received_size > 0:
+            return self.on_receive(fd)
+        elif parser.is_idle():
+            conn.idle = True
@@ -1,5 +1,64 @@
 #!/user/bin/env python
 # -*- encoding:utf-8 -*-
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+
+from .compat import text_type
+
+# 一次 sendmsg 最多携带的分片数, 与 Linux 的 IOV_MAX 一致
+IOV_MAX = 1024
+# 不支持 sendmsg 时 (Python 2), 小于该大小的分片先合并再发送,
+# 避免头和正文分成两个小包, 在 Nagle 和延迟确认的作用下等待约 40ms
+COALESCE_SIZE = 64 * 1024
+# 单次 recv_into 读取大小的范围, 会依据上一次读取的结果在其中调整
+MIN_RECV_SIZE = 1024
+MAX_RECV_SIZE = 256 * 1024
+# 不支持 sendfile 时每次读取文件的大小
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def _load_sendfile():
+    '''Python 2 没有 os.sendfile, 通过 ctypes 调用 libc 的 sendfile.
+    都不可用时返回 None
+    '''
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_sendfile = libc.sendfile
+    except (OSError, AttributeError, TypeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_longlong),
+                              ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_longlong(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise socket.error(err, os.strerror(err))
+        return sent
+    return sendfile
+
+
+sendfile = _load_sendfile()
+
+
+def is_producer(data):
+    '''判断待发送数据是否是按需生成分片的迭代器, 例如生成器
+
+    参数:
+        data: 待发送数据
+    '''
+    return hasattr(data, '__iter__') and \
+        (hasattr(data, 'next') or hasattr(data, '__next__'))
 
 
 class Buff(list):
@@ -28,7 +87,7 @@ class Buff(list):
         '''返回数据结果, 因为数据拼接效率很低, 所以需要使用时才会拼接
         注意, 调用过该函数后数据会清空
         '''
-        data = ''.join(self)
+        data = b''.join(self)
         self.clean()
         return data
 
@@ -36,3 +95,310 @@ class Buff(list):
         '''清空数组
         '''
         del self[:]
+
+
+class FileBody(object):
+    '''需要发送的文件区间, 放进 SendBuff 后会通过 sendfile 直接从文件发送到 socket,
+    数据不会经过 Python. 发送完毕或者连接关闭时关闭文件.
+    '''
+
+    def __init__(self, file_obj, offset, count):
+        '''初始化
+
+        参数:
+            file_obj: 以二进制方式打开的文件对象
+            offset: 起始位置
+            count: 发送的字节数
+        '''
+        self.file = file_obj
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def send_to(self, sock):
+        '''发送一次数据, 返回发送的字节数. socket 的异常会直接抛出
+
+        参数:
+            sock: 非阻塞的 socket
+        '''
+        if sendfile is not None:
+            sent = sendfile(sock.fileno(), self.file.fileno(), self.offset,
+                            self.count)
+        else:
+            self.file.seek(self.offset)
+            sent = sock.send(self.file.read(min(self.count, FILE_CHUNK_SIZE)))
+        if sent == 0 and self.count > 0:
+            # 文件在发送过程中被截断了
+            raise socket.error(errno.EIO, "file truncated")
+        self.offset += sent
+        self.count -= sent
+        return sent
+
+    def read(self, size):
+        '''读取下一段数据, 用于不能直接使用 sendfile 的发送方式, 例如 asyncio
+
+        参数:
+            size: 最多读取的字节数
+        '''
+        self.file.seek(self.offset)
+        data = self.file.read(min(self.count, size))
+        if not data and self.count > 0:
+            raise IOError(errno.EIO, "file truncated")
+        self.offset += len(data)
+        self.count -= len(data)
+        return data
+
+    def close(self):
+        try:
+            self.file.close()
+        except (IOError, OSError):
+            pass
+
+
+class SendBuff(object):
+    '''待发送数据的缓冲队列
+
+    数据以分片的形式保存, 发送前不会拼接成一个字符串.
+    部分发送时只把第一个分片替换为它未发送部分的 memoryview, 不会复制数据.
+    socket 支持 sendmsg 时多个分片 (例如 HTTP 头和正文) 通过一次系统调用发送.
+    分片也可以是 FileBody, 这时使用 sendfile 发送.
+    '''
+
+    def __init__(self):
+        self.__segments = collections.deque()
+        self.size = 0  # 尚未发送的字节数
+
+    def __len__(self):
+        '''尚未发送的分片个数
+        '''
+        return len(self.__segments)
+
+    def append(self, data):
+        '''追加一个分片, unicode 会先编码为 utf-8
+
+        参数:
+            data: 待发送的数据
+        '''
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        if not data:
+            if isinstance(data, FileBody):
+                data.close()
+            return
+        if not isinstance(data, FileBody):
+            data = memoryview(data)
+        self.__segments.append(data)
+        self.size += len(data)
+
+    def extend(self, data_list):
+        '''追加多个分片
+
+        参数:
+            data_list: 待发送的数据列表
+        '''
+        for data in data_list:
+            self.append(data)
+
+    def send_to(self, sock):
+        '''通过 sock 发送一次数据, 返回发送的字节数.
+        socket 的异常 (包括 EAGAIN) 会直接抛出.
+
+        参数:
+            sock: 非阻塞的 socket
+        '''
+        segments = self.__segments
+        head = segments[0]
+        if isinstance(head, FileBody):
+            sent = head.send_to(sock)
+            self.size -= sent
+            if len(head) == 0:
+                head.close()
+                segments.popleft()
+            return sent
+
+        if len(segments) > 1 and hasattr(sock, 'sendmsg'):
+            sent = sock.sendmsg(self.__gather())
+        elif len(segments) > 1 and len(head) < COALESCE_SIZE:
+            sent = sock.send(self.__coalesce())
+        else:
+            sent = sock.send(head)
+        self.__consume(sent)
+        return sent
+
+    def __gather(self):
+        '''取出开头连续的内存分片, 最多 IOV_MAX 个
+        '''
+        buffers = []
+        for segment in self.__segments:
+            if isinstance(segment, FileBody) or len(buffers) >= IOV_MAX:
+                break
+            buffers.append(segment)
+        return buffers
+
+    def __coalesce(self):
+        '''把开头连续的内存分片合并成最多 COALESCE_SIZE 字节, 大分片只复制开头
+        '''
+        data = bytearray()
+        for segment in self.__segments:
+            if isinstance(segment, FileBody) or len(data) >= COALESCE_SIZE:
+                break
+            data += segment[:COALESCE_SIZE - len(data)]
+        return data
+
+    def __consume(self, size):
+        '''丢弃已经发送的数据, 只保留未发送的部分
+
+        参数:
+            size: 已经发送的字节数
+        '''
+        self.size -= size
+        segments = self.__segments
+        while size > 0:
+            head = segments[0]
+            if size >= len(head):
+                segments.popleft()
+                size -= len(head)
+            else:
+                segments[0] = head[size:]
+                size = 0
+
+    def clean(self):
+        '''清空队列, 关闭尚未发送完的文件
+        '''
+        for segment in self.__segments:
+            if isinstance(segment, FileBody):
+                segment.close()
+        self.__segments.clear()
+        self.size = 0
+
+
+class RecvBuff(object):
+    '''接收数据的缓冲区
+
+    数据通过 recv_into 直接读进一个可增长的 bytearray, 不会为每次读取创建字符串.
+    已接收但尚未消费的数据位于 data[start:end], 上层可以通过 view 获得这一段的
+    memoryview, 或者用 find/read 直接在缓冲区上解析.
+    每次读取的大小依据上一次读取的结果自适应调整.
+
+    注意: 存在 memoryview 引用时 bytearray 无法扩容, 所以不要长期持有 view 的结果.
+    '''
+
+    def __init__(self, size=MIN_RECV_SIZE):
+        '''初始化
+
+        参数:
+            size: 缓冲区的初始大小
+        '''
+        self.data = bytearray(size)
+        self.start = 0  # 未消费数据的起始位置
+        self.end = 0  # 已填充数据的结束位置
+        self.__read_size = MIN_RECV_SIZE  # 下一次读取的大小
+
+    def __len__(self):
+        '''尚未消费的字节数
+        '''
+        return self.end - self.start
+
+    def view(self):
+        '''返回尚未消费数据的 memoryview, 不会复制数据
+        '''
+        return memoryview(self.data)[self.start: self.end]
+
+    def recv_from(self, sock):
+        '''通过 sock 读取一次数据, 返回读取的字节数, 0 表示对端关闭.
+        socket 的异常 (包括 EAGAIN) 会直接抛出.
+
+        参数:
+            sock: 非阻塞的 socket
+        '''
+        read_size = self.__read_size
+        self.__reserve(read_size)
+        size = sock.recv_into(memoryview(self.data)[self.end:], read_size)
+        self.end += size
+
+        # 读满说明可能还有大量数据, 下次多读一些; 读得很少则缩小
+        if size == read_size:
+            self.__read_size = min(read_size * 2, MAX_RECV_SIZE)
+        elif size < read_size // 4:
+            self.__read_size = max(read_size // 2, MIN_RECV_SIZE)
+        return size
+
+    def append(self, data):
+        '''追加数据到尾部
+
+        参数:
+            data: 字符串数据
+        '''
+        size = len(data)
+        if size == 0:
+            return
+        self.__reserve(size)
+        self.data[self.end: self.end + size] = data
+        self.end += size
+
+    def find(self, sub, offset=0):
+        '''在尚未消费的数据中查找 sub, 返回相对于 start 的位置, 找不到返回 -1
+
+        参数:
+            sub: 需要查找的字符串
+            offset: 相对于 start 的查找起始位置
+        '''
+        index = self.data.find(sub, self.start + offset, self.end)
+        if index < 0:
+            return index
+        return index - self.start
+
+    def read(self, size):
+        '''读取并消费头部 size 个字节, 返回字符串
+
+        参数:
+            size: 读取的字节数, 不能超过 len(self)
+        '''
+        data = memoryview(self.data)[self.start: self.start + size].tobytes()
+        self.consume(size)
+        return data
+
+    def consume(self, size):
+        '''丢弃头部 size 个字节
+
+        参数:
+            size: 丢弃的字节数
+        '''
+        self.start += size
+        if self.start >= self.end:
+            self.start = self.end = 0
+            # 处理完大数据后释放多余的内存
+            if len(self.data) > MAX_RECV_SIZE:
+                self.data = bytearray(self.__read_size)
+
+    def pop_str(self):
+        '''返回并清空所有尚未消费的数据
+        '''
+        return self.read(len(self))
+
+    def clean(self):
+        '''清空缓冲区
+        '''
+        self.consume(len(self))
+
+    def __reserve(self, size):
+        '''保证尾部至少有 size 字节的空闲空间.
+        优先把未消费的数据移到头部, 空间依旧不够时再扩容.
+
+        参数:
+            size: 需要的空闲字节数
+        '''
+        if len(self.data) - self.end >= size:
+            return
+
+        if self.start > 0:
+            del self.data[:self.start]
+            self.end -= self.start
+            self.start = 0
+
+        free = len(self.data) - self.end
+        if free < size:
+            grow = max(len(self.data), size - free)
+            self.data.extend(bytearray(grow))
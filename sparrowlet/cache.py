@@ -0,0 +1,228 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+进程内的响应缓存
+'''
+import collections
+import time
+
+from . import compat
+from . import metrics
+from . import response
+from .compat import stackless
+
+# 可以缓存的状态码, 错误响应不缓存, 避免一次失败在整个有效期内返回给所有请求
+CACHEABLE_STATUS = frozenset((200, ))
+
+stats = metrics.get_metrics()
+
+
+def make_key(http_data, header_names=(), *extra):
+    '''生成缓存的 key: 方法, URI, 排序后的 GET 参数和指定的头信息
+
+    参数:
+        http_data: 请求数据
+        header_names: 需要加入 key 的请求头名称
+        extra: 其他影响响应内容的值, 例如是否保持连接
+    '''
+    params = tuple(sorted(compat.iteritems(http_data.get_params)))
+    headers = tuple(http_data.get_header(name) for name in header_names)
+    return (http_data.method, http_data.uri, params, headers) + extra
+
+
+def _split_date(head):
+    '''把响应头从 Date 处分成前后两段, 命中时插入当前的 Date.
+    没有 Date 头时返回 (head, None)
+
+    参数:
+        head: 序列化好的响应头
+    '''
+    start = head.find(b'\r\nDate: ')
+    if start < 0:
+        return head, None
+    start += 2
+    end = head.index(b'\r\n', start) + 2
+    return head[:start], head[end:]
+
+
+class ResponseCache(object):
+    '''LRU + TTL 的响应缓存, 保存的是序列化好的响应分片, 命中时可以直接发送.
+    只缓存 CACHEABLE_STATUS 中的响应, Date 头不缓存, 命中时使用当前时间.
+
+    总大小超过 max_bytes 时淘汰最久没有使用的响应.
+    多个请求同时未命中同一个 key 时, 只有第一个会调用处理函数,
+    其余的等待它的结果 (single-flight). 只有缓存了的结果才会共享,
+    流式正文和文件只能发送一次, 等待的请求各自重新生成.
+
+    fetch 使用 stackless 的通道等待; 其他运行时 (例如 aio.py) 使用
+    lookup, waiter, begin, finish 和自己的等待方式实现同样的逻辑.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        '''初始化
+
+        参数:
+            max_bytes: 缓存的最大字节数
+        '''
+        self.max_bytes = max_bytes
+        self.size = 0  # 当前缓存的字节数
+        # key -> (过期时间, Date 之前的响应头, Date 之后的响应头 (没有 Date
+        #         时为 None), 正文分片, 字节数), 按使用顺序排列
+        self.__entries = collections.OrderedDict()
+        # 正在生成响应的 key -> 等待结果的对象, 例如 stackless 的通道
+        self.__pending = {}
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0  # 等待其他请求生成响应的次数
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        '''获取未过期的响应, 不存在返回 None
+
+        参数:
+            key: 缓存的 key
+        '''
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            self.size -= entry[4]
+            return None
+        # 重新插入到末尾, 表示最近使用过
+        self.__entries[key] = entry
+        head = entry[1]
+        if entry[2] is not None:
+            head += compat.to_wire(response.date_line()) + entry[2]
+        return [head] + list(entry[3])
+
+    def set(self, key, data, ttl):
+        '''保存响应, 返回是否缓存了
+
+        参数:
+            key: 缓存的 key
+            data: 响应分片的列表, 第一个分片是响应头
+            ttl: 有效时长 (s)
+        '''
+        # 文件分片和流式正文发送后就失效了, 只缓存内存中的数据
+        if not all(isinstance(x, (bytes, memoryview)) for x in data):
+            return False
+        head = data[0]
+        if isinstance(head, memoryview):
+            head = head.tobytes()
+        # 状态行: HTTP/1.1 200 OK
+        if not head[9:12].isdigit() or \
+                int(head[9:12]) not in CACHEABLE_STATUS:
+            return False
+        size = sum(len(x) for x in data)
+        # 单个响应过大时不缓存, 避免清空整个缓存
+        if size > self.max_bytes // 4:
+            return False
+
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            self.size -= old[4]
+        before, after = _split_date(head)
+        self.__entries[key] = (time.time() + ttl, before, after,
+                               tuple(data[1:]), size)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, entry = self.__entries.popitem(last=False)
+            self.size -= entry[4]
+            self.evictions += 1
+            stats.incr('cache_evictions')
+        return True
+
+    def lookup(self, key):
+        '''获取未过期的响应并计入命中, 不存在返回 None
+
+        参数:
+            key: 缓存的 key
+        '''
+        data = self.get(key)
+        if data is not None:
+            self.hits += 1
+            stats.incr('cache_hits')
+        return data
+
+    def waiter(self, key):
+        '''返回正在生成该响应的请求通过 begin 登记的等待对象, 没有时返回 None
+
+        参数:
+            key: 缓存的 key
+        '''
+        waiter = self.__pending.get(key)
+        if waiter is not None:
+            self.waits += 1
+        return waiter
+
+    def begin(self, key, waiter):
+        '''登记正在生成该响应, 之后同一个 key 的请求通过 waiter 等待结果
+
+        参数:
+            key: 缓存的 key
+            waiter: 等待结果的对象
+        '''
+        self.misses += 1
+        stats.incr('cache_misses')
+        self.__pending[key] = waiter
+
+    def finish(self, key, data, ttl):
+        '''生成结束, 缓存响应并取消登记. 返回可以交给等待者的结果:
+        缓存了的响应, 或者 None (生成失败或者不能缓存, 等待者各自重新生成)
+
+        参数:
+            key: 缓存的 key
+            data: 生成的响应分片, 生成失败时为 None
+            ttl: 有效时长 (s)
+        '''
+        del self.__pending[key]
+        # 流式正文和文件只能发送一次, 只有缓存了的响应才能共享
+        if data is not None and self.set(key, data, ttl):
+            return data
+        return None
+
+    def fetch(self, key, ttl, producer):
+        '''获取响应, 未命中时调用 producer 生成并缓存.
+        同一个 key 同时只会有一个微线程调用 producer.
+
+        参数:
+            key: 缓存的 key
+            ttl: 有效时长 (s)
+            producer: 生成响应分片列表的函数
+        '''
+        data = self.lookup(key)
+        if data is not None:
+            return data
+
+        channel = self.waiter(key)
+        if channel is not None:
+            # 已经有微线程在生成该响应, 等待它的结果
+            data = channel.receive()
+            if data is not None:
+                return data
+            # 生成失败或者结果不能缓存, 自己重新生成
+            return producer()
+
+        channel = stackless.channel()
+        self.begin(key, channel)
+        data = None
+        try:
+            data = producer()
+        finally:
+            shared = self.finish(key, data, ttl)
+            # 唤醒所有等待的微线程, 收到 None 的各自调用 producer
+            while channel.balance < 0:
+                channel.send(shared)
+        return data
+
+    def clean(self):
+        '''清空缓存
+        '''
+        self.__entries.clear()
+        self.size = 0
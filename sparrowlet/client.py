@@ -0,0 +1,608 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+非阻塞的 TCP/HTTP 客户端, 用来在处理函数中调用其他服务.
+
+上游连接的 socket 通过 Loop.watch 注册到当前进程 Loop 的 io 中,
+调用的微线程在通道上等待 socket 可读/可写, 不会阻塞 Loop.
+每个上游地址一个连接池, 请求结束后连接放回池中复用.
+
+使用方法 (只能在处理任务的微线程中调用):
+    client = HttpClient()
+    resp = client.get('http://127.0.0.1:8080/user/1')
+    resp.status, resp.get_header('Content-Type'), resp.body
+
+    pool = ConnectionPool(('127.0.0.1', 6379))
+    conn = pool.acquire()
+    try:
+        conn.send(b'PING\\r\\n')
+        data = conn.read_until(b'\\r\\n')
+    finally:
+        pool.release(conn)
+'''
+import collections
+import errno
+import socket
+import time
+
+import stackless
+
+from . import compat
+from . import log
+from . import loop
+from . import metrics
+from .compat import text_type, urlparse
+
+
+logger = log.get_logger()
+stats = metrics.get_metrics()
+
+# 每次 recv 读取的字节数
+RECV_SIZE = 64 * 1024
+# 响应头的最大长度
+MAX_HEADER_SIZE = 64 * 1024
+# 连接池的默认参数
+POOL_MAX_SIZE = 10
+IDLE_TIMEOUT = 60
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# socket 暂时不可读写的错误码
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class ResponseError(Exception):
+    '''上游返回的数据无法解析, 或者在响应完整之前关闭了连接
+    '''
+    pass
+
+
+class Connection(object):
+    '''连接池中的一个上游连接.
+
+    读写暂时无法完成时当前微线程挂起, 由 Loop 在 socket 可读/可写或者超时后唤醒.
+    超时抛出 socket.timeout, 出错抛出 socket.error, 之后连接不能再使用.
+    '''
+
+    def __init__(self, pool, sock):
+        '''初始化
+
+        参数:
+            pool: 所属的连接池
+            sock: 非阻塞的 socket
+        '''
+        self.pool = pool
+        self.socket = sock
+        self.fd = sock.fileno()
+        # 已经接收但还没有被读取的数据
+        self.buffer = b''
+        # 放回连接池的时间
+        self.last_used = time.time()
+        # 完成的请求数, 大于 0 表示是复用的连接
+        self.requests = 0
+        # 接收的总字节数
+        self.received = 0
+        self.closed = False
+        # 等待 socket 事件的通道和超时的定时器
+        self.__channel = None
+        self.__timer = None
+
+    def __stop_wait(self):
+        '''结束等待, 返回等待的通道
+        '''
+        self.pool.loop.unwatch(self.fd)
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        channel, self.__channel = self.__channel, None
+        return channel
+
+    def on_event(self, events):
+        '''socket 可读/可写时由 Loop 调用, 唤醒等待的微线程
+
+        参数:
+            events: io 事件
+        '''
+        channel = self.__stop_wait()
+        if channel is not None:
+            channel.send(events)
+
+    def __on_timeout(self):
+        '''等待超时, 在等待的微线程中抛出 socket.timeout
+        '''
+        self.__timer = None
+        channel = self.__stop_wait()
+        if channel is not None:
+            channel.send_exception(socket.timeout, 'timed out')
+
+    def __wait(self, events, timeout):
+        '''挂起当前微线程直到 socket 发生 events 中的事件
+
+        参数:
+            events: 等待的事件
+            timeout: 最长等待时长 (s), None 表示不限制
+        '''
+        loop_obj = self.pool.loop
+        self.__channel = stackless.channel()
+        loop_obj.watch(self.fd, events | loop.EVENT_ERR, self)
+        if timeout is not None:
+            self.__timer = loop_obj.call_later(timeout, self.__on_timeout)
+        return self.__channel.receive()
+
+    def connect(self, address, timeout):
+        '''非阻塞地建立连接
+
+        参数:
+            address: (host, port)
+            timeout: 连接超时 (s)
+        '''
+        err = self.socket.connect_ex(address)
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.__wait(loop.EVENT_WRITE, timeout)
+            err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+
+    def send(self, data, timeout=None):
+        '''发送全部数据
+
+        参数:
+            data: 字符串
+            timeout: 每次等待可写的超时, None 表示使用连接池的 read_timeout
+        '''
+        if timeout is None:
+            timeout = self.pool.read_timeout
+        view = memoryview(data)
+        while view:
+            try:
+                sent = self.socket.send(view)
+            except socket.error as e:
+                if e.args[0] not in _RETRY_ERRNOS:
+                    raise
+                self.__wait(loop.EVENT_WRITE, timeout)
+                continue
+            stats.incr('bytes_out', sent)
+            view = view[sent:]
+
+    def recv(self, timeout=None):
+        '''接收一次数据, 缓冲区中有数据时直接返回. 对端关闭时返回空字符串
+
+        参数:
+            timeout: 等待可读的超时, None 表示使用连接池的 read_timeout
+        '''
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        if timeout is None:
+            timeout = self.pool.read_timeout
+        while 1:
+            try:
+                data = self.socket.recv(RECV_SIZE)
+            except socket.error as e:
+                if e.args[0] not in _RETRY_ERRNOS:
+                    raise
+                self.__wait(loop.EVENT_READ, timeout)
+                continue
+            self.received += len(data)
+            stats.incr('bytes_in', len(data))
+            return data
+
+    def read_until(self, delimiter, limit=MAX_HEADER_SIZE):
+        '''读取到 delimiter 为止 (包含 delimiter), 多余的数据留在缓冲区
+
+        参数:
+            delimiter: 结束标记
+            limit: 最多读取的字节数, 超过时抛出 ResponseError
+        '''
+        data = self.buffer
+        self.buffer = b''
+        start = 0
+        while 1:
+            pos = data.find(delimiter, start)
+            if pos >= 0:
+                end = pos + len(delimiter)
+                self.buffer = data[end:]
+                return data[:end]
+            if len(data) > limit:
+                raise ResponseError("no {!r} in {} bytes".format(delimiter,
+                                                                 limit))
+            start = max(len(data) - len(delimiter) + 1, 0)
+            chunk = self.recv()
+            if not chunk:
+                raise ResponseError("connection closed")
+            data += chunk
+
+    def read_exactly(self, size):
+        '''读取 size 字节, 对端提前关闭时抛出 ResponseError
+
+        参数:
+            size: 字节数
+        '''
+        chunks = []
+        while size > 0:
+            chunk = self.recv()
+            if not chunk:
+                raise ResponseError("connection closed")
+            if len(chunk) > size:
+                chunk, self.buffer = chunk[:size], chunk[size:]
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def read_all(self):
+        '''读取到对端关闭为止
+        '''
+        chunks = []
+        while 1:
+            chunk = self.recv()
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def is_alive(self):
+        '''检查空闲的连接是否还能使用: 对端已经关闭或者发来了多余的数据时
+        不能再使用
+        '''
+        try:
+            self.socket.recv(1, socket.MSG_PEEK)
+        except socket.error as e:
+            return e.args[0] in _RETRY_ERRNOS
+        return False
+
+    def close(self):
+        '''关闭连接, 重复调用时忽略
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.__stop_wait()
+        try:
+            self.socket.close()
+        except socket.error as e:
+            logger.error(str(e))
+
+
+class ConnectionPool(object):
+    '''一个上游地址的长连接池, 属于当前进程的 Loop.
+
+    最多同时打开 max_size 个连接, 全部在使用时 acquire 等待其他微线程 release.
+    空闲超过 idle_timeout 的连接会被关闭.
+    '''
+
+    def __init__(self, address, max_size=POOL_MAX_SIZE,
+                 idle_timeout=IDLE_TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, loop_obj=None):
+        '''初始化
+
+        参数:
+            address: 上游地址 (host, port)
+            max_size: 最多同时打开的连接数
+            idle_timeout: 空闲连接保留的时长 (s)
+            connect_timeout: 建立连接的超时 (s)
+            read_timeout: 每次等待数据的超时 (s), None 表示不限制
+            loop_obj: 使用的 Loop, None 表示当前进程正在运行的 Loop
+        '''
+        if loop_obj is None:
+            loop_obj = loop.current()
+        if loop_obj is None:
+            raise RuntimeError("ConnectionPool needs a running Loop")
+        self.loop = loop_obj
+        self.address = address
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # 空闲的连接, 最后放回的在末尾
+        self.idle = []
+        # 打开的连接数, 包括空闲的
+        self.size = 0
+        # 等待连接的微线程的通道
+        self.__waiters = collections.deque()
+        # 关闭空闲超时连接的定时器
+        self.__evict_timer = None
+
+    def acquire(self):
+        '''取出一个空闲的连接, 没有时新建. 连接数达到上限时等待
+        '''
+        while 1:
+            now = time.time()
+            while self.idle:
+                conn = self.idle.pop()
+                if now - conn.last_used < self.idle_timeout and \
+                        conn.is_alive():
+                    stats.incr('upstream_reuses')
+                    return conn
+                self.__discard(conn)
+            if self.size < self.max_size:
+                return self.__connect()
+            channel = stackless.channel()
+            self.__waiters.append(channel)
+            channel.receive()
+
+    def __connect(self):
+        '''新建一个连接
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(self, sock)
+        self.size += 1
+        try:
+            conn.connect(self.address, self.connect_timeout)
+        except Exception:
+            self.__discard(conn)
+            raise
+        stats.incr('upstream_connects')
+        return conn
+
+    def __discard(self, conn):
+        '''关闭连接, 并唤醒一个等待的微线程
+
+        参数:
+            conn: 连接
+        '''
+        conn.close()
+        self.size -= 1
+        self.__wake()
+
+    def __wake(self):
+        '''唤醒一个等待连接的微线程
+        '''
+        if self.__waiters:
+            self.__waiters.popleft().send(None)
+
+    def release(self, conn, reuse=True):
+        '''用完之后放回连接. 出错或者协议上不能复用的连接需要关闭
+
+        参数:
+            conn: acquire 取出的连接
+            reuse: 是否可以复用
+        '''
+        if not reuse or conn.closed or conn.buffer:
+            self.__discard(conn)
+            return
+        conn.last_used = time.time()
+        self.idle.append(conn)
+        if self.__evict_timer is None:
+            self.__evict_timer = self.loop.call_at(
+                self.idle[0].last_used + self.idle_timeout, self.__evict)
+        self.__wake()
+
+    def __evict(self):
+        '''关闭空闲超时的连接. 最早放回的连接在最前面, 最先过期
+        '''
+        self.__evict_timer = None
+        now = time.time()
+        idle = self.idle
+        expired = 0
+        while expired < len(idle) and \
+                now - idle[expired].last_used >= self.idle_timeout:
+            expired += 1
+        for conn in idle[:expired]:
+            conn.close()
+        del idle[:expired]
+        self.size -= expired
+        if idle:
+            self.__evict_timer = self.loop.call_at(
+                idle[0].last_used + self.idle_timeout, self.__evict)
+
+    def close(self):
+        '''关闭所有空闲的连接
+        '''
+        for conn in self.idle:
+            conn.close()
+        self.size -= len(self.idle)
+        self.idle = []
+        if self.__evict_timer is not None:
+            self.__evict_timer.cancel()
+            self.__evict_timer = None
+
+
+class HttpResponse(object):
+    '''上游返回的 HTTP 响应
+    '''
+
+    def __init__(self, version, status, reason, headers, body):
+        self.version = version  # HTTP 版本
+        self.status = status  # 状态码
+        self.reason = reason  # 状态说明, 例如 OK
+        self.headers = headers  # 头信息字典
+        self.body = body  # 正文
+
+    def get_header(self, key, default=None):
+        '''不区分大小写地获取头信息
+
+        参数:
+            key: 头信息的名称
+            default: 不存在时的返回值
+        '''
+        key = key.lower()
+        for k, v in compat.iteritems(self.headers):
+            if k.lower() == key:
+                return v
+        return default
+
+
+class HttpClient(object):
+    '''使用连接池的 HTTP/1.1 客户端, 每个 (host, port) 一个连接池.
+    可以在 fork 之前创建, 连接池在每个进程第一次请求时创建
+    '''
+
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=IDLE_TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 headers=None):
+        '''初始化
+
+        参数:
+            max_size: 每个上游最多同时打开的连接数
+            idle_timeout: 空闲连接保留的时长 (s)
+            connect_timeout: 建立连接的超时 (s)
+            read_timeout: 每次等待数据的超时 (s)
+            headers: 每个请求都会带上的头信息
+        '''
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.headers = headers or {}
+        # (host, port) -> ConnectionPool
+        self.pools = {}
+
+    def pool(self, host, port):
+        '''返回上游地址对应的连接池, 不存在时创建
+
+        参数:
+            host: 主机名或者 IP
+            port: 端口
+        '''
+        pool = self.pools.get((host, port))
+        if pool is None or pool.loop is not loop.current():
+            pool = ConnectionPool((host, port), self.max_size,
+                                  self.idle_timeout, self.connect_timeout,
+                                  self.read_timeout)
+            self.pools[(host, port)] = pool
+        return pool
+
+    def get(self, url, **kargs):
+        '''发起 GET 请求, 参数见 request
+        '''
+        return self.request('GET', url, **kargs)
+
+    def post(self, url, body=b'', **kargs):
+        '''发起 POST 请求, 参数见 request
+        '''
+        return self.request('POST', url, body, **kargs)
+
+    def request(self, method, url, body=None, headers=None):
+        '''发起请求, 等待响应完整后返回 HttpResponse.
+        复用的连接在收到响应之前失败时 (例如上游已经关闭了空闲连接)
+        使用新的连接重试一次
+
+        参数:
+            method: HTTP 方法
+            url: 完整的 URL, 只支持 http
+            body: 请求正文
+            headers: 头信息字典
+        '''
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError("unsupported url {}".format(url))
+        host = parts.hostname
+        port = parts.port or 80
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        data = self.__format(method, path, parts.netloc, body, headers)
+
+        pool = self.pool(host, port)
+        while 1:
+            conn = pool.acquire()
+            reused = conn.requests > 0
+            received = conn.received
+            try:
+                conn.send(data)
+                resp, keep_alive = self.__read_response(conn, method)
+            except (socket.error, ResponseError) as e:
+                pool.release(conn, False)
+                # 上游关闭了空闲连接, 还没有收到任何响应时重试
+                if reused and conn.received == received and \
+                        not isinstance(e, socket.timeout):
+                    continue
+                raise
+            except Exception:
+                pool.release(conn, False)
+                raise
+            conn.requests += 1
+            pool.release(conn, keep_alive)
+            return resp
+
+    def __format(self, method, path, netloc, body, headers):
+        '''序列化请求
+
+        参数:
+            method: HTTP 方法
+            path: 路径和参数
+            netloc: Host 头
+            body: 请求正文
+            headers: 头信息字典
+        '''
+        all_headers = {'Host': netloc}
+        all_headers.update(self.headers)
+        if headers:
+            all_headers.update(headers)
+        if body is not None or method in ('POST', 'PUT', 'PATCH'):
+            if isinstance(body, text_type):
+                body = body.encode('utf-8')
+            body = body or b''
+            all_headers['Content-Length'] = str(len(body))
+        lines = ['{} {} HTTP/1.1'.format(method, path)]
+        lines.extend('{}: {}'.format(k, v)
+                     for k, v in compat.iteritems(all_headers))
+        lines.append('\r\n')
+        return compat.to_wire('\r\n'.join(lines)) + (body or b'')
+
+    def __read_response(self, conn, method):
+        '''读取一个完整的响应, 返回 (HttpResponse, 是否可以复用连接)
+
+        参数:
+            conn: 连接
+            method: 请求的 HTTP 方法
+        '''
+        head = compat.native_str(conn.read_until(b'\r\n\r\n'))
+        lines = head[:-4].split('\r\n')
+        try:
+            version, status = lines[0].split(' ', 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise ResponseError("bad status line {!r}".format(lines[0]))
+        reason = lines[0].split(' ', 2)[2] if lines[0].count(' ') > 1 else ''
+        headers = {}
+        for line in lines[1:]:
+            key, sep, value = line.partition(':')
+            if not sep:
+                raise ResponseError("bad header {!r}".format(line))
+            headers[key.strip()] = value.strip()
+        resp = HttpResponse(version, status, reason, headers, b'')
+
+        connection = (resp.get_header('Connection') or '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        length = resp.get_header('Content-Length')
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            pass
+        elif 'chunked' in (resp.get_header('Transfer-Encoding') or ''):
+            resp.body = self.__read_chunked(conn)
+        elif length is not None:
+            try:
+                resp.body = conn.read_exactly(int(length))
+            except ValueError:
+                raise ResponseError("bad Content-Length {!r}".format(length))
+        else:
+            # 没有长度信息, 正文到连接关闭为止
+            resp.body = conn.read_all()
+            keep_alive = False
+        return resp, keep_alive
+
+    def __read_chunked(self, conn):
+        '''读取 chunked 编码的正文
+
+        参数:
+            conn: 连接
+        '''
+        chunks = []
+        while 1:
+            line = conn.read_until(b'\r\n')
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise ResponseError("bad chunk size {!r}".format(line))
+            if size == 0:
+                # 跳过 trailer
+                while conn.read_until(b'\r\n') != b'\r\n':
+                    pass
+                return b''.join(chunks)
+            chunks.append(conn.read_exactly(size))
+            conn.read_exactly(2)
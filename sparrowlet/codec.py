@@ -0,0 +1,299 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+TcpServer 使用的消息分帧解码器.
+
+TCP 连接上的数据没有消息边界, on_receive 每次收到的可能是半条或者多条消息.
+给 TcpServer 设置 codec 后, 每个连接持有一个解码器, decode 直接在连接的
+接收缓冲区 (buff.RecvBuff) 上一次取出所有完整的消息, 每条消息只复制一次,
+之后 TcpServer 对每条消息调用一次 on_message(fd, frame).
+不完整的消息留在接收缓冲区中, 解码器记住已经解析的长度或者已经扫描的位置,
+后续数据到达时从停下的地方继续, 不会重新扫描.
+
+支持的格式:
+    1. LengthPrefixCodec: 定长 (1/2/4/8 字节) 或 varint 长度前缀 + 正文
+    2. DelimiterCodec: 以分隔符结尾, LineCodec 为按行分割
+    3. FixedSizeCodec: 每条消息长度固定
+
+消息超过 max_frame_size 时在解析到长度 (或者扫描超过该长度) 后立即抛出
+FrameTooLarge, 不会先把整条消息接收到内存中.
+'''
+import struct
+
+from .compat import xrange
+
+# 默认的消息最大长度
+MAX_FRAME_SIZE = 1024 * 1024
+# LengthPrefixCodec 使用 varint (protobuf 的 base 128) 长度前缀
+VARINT = 'varint'
+# varint 最多占用的字节数, 足够表示 64 位的长度
+VARINT_MAX_SIZE = 10
+
+
+class FrameError(Exception):
+    '''消息格式错误, 出现后该连接的消息边界已经无法确定, 应关闭连接
+    '''
+    pass
+
+
+class FrameTooLarge(FrameError):
+    '''消息长度超过 max_frame_size
+    '''
+    pass
+
+
+class Codec(object):
+    '''解码器的基类. 每个连接一个实例, 保存跨事件的解码状态
+    '''
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        '''初始化
+
+        参数:
+            max_frame_size: 消息的最大长度, None 表示不限制
+        '''
+        self.max_frame_size = max_frame_size
+
+    def decode(self, recv_buff):
+        '''取出接收缓冲区中所有完整的消息, 返回 bytes 的列表.
+        完整的消息从缓冲区中消费掉, 不完整的部分保留.
+        格式错误时抛出 FrameError
+
+        参数:
+            recv_buff: 连接的接收缓冲区 (buff.RecvBuff)
+        '''
+        raise NotImplementedError
+
+    def encode(self, frame):
+        '''把一条消息编码为待发送的分片列表, 可以直接交给 fd_manager.send
+
+        参数:
+            frame: 消息内容
+        '''
+        raise NotImplementedError
+
+    def _check_size(self, size):
+        '''消息长度超过限制时抛出 FrameTooLarge
+
+        参数:
+            size: 消息长度
+        '''
+        if self.max_frame_size is not None and size > self.max_frame_size:
+            raise FrameTooLarge("frame size {} exceeds {}".format(
+                size, self.max_frame_size))
+
+
+class LengthPrefixCodec(Codec):
+    '''长度前缀 + 正文. 长度只包含正文, 不包含前缀本身
+    '''
+
+    # 前缀宽度 -> struct 格式
+    FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+    def __init__(self, width=4, byteorder='big',
+                 max_frame_size=MAX_FRAME_SIZE):
+        '''初始化
+
+        参数:
+            width: 前缀的字节数 1, 2, 4, 8, 或者 VARINT
+            byteorder: 定长前缀的字节序, big 或 little
+            max_frame_size: 消息的最大长度, None 表示不限制
+        '''
+        Codec.__init__(self, max_frame_size)
+        self.__struct = None
+        if width != VARINT:
+            if width not in self.FORMATS:
+                raise ValueError("unsupported prefix width {!r}".format(width))
+            order = {'big': '>', 'little': '<'}[byteorder]
+            self.__struct = struct.Struct(order + self.FORMATS[width])
+        # 当前消息已经解析出的 (前缀长度, 正文长度), 正文未接收完时保留
+        self.__header = None
+
+    def __parse_header(self, data, pos, end):
+        '''解析 pos 处的长度前缀, 返回 (前缀长度, 正文长度), 不完整时返回 None
+
+        参数:
+            data: 接收缓冲区的 bytearray
+            pos: 前缀的起始位置
+            end: 已接收数据的结束位置
+        '''
+        header = self.__struct
+        if header is not None:
+            if end - pos < header.size:
+                return None
+            return header.size, header.unpack_from(data, pos)[0]
+
+        length = 0
+        shift = 0
+        index = pos
+        while index < end:
+            byte = data[index]
+            length |= (byte & 0x7f) << shift
+            index += 1
+            if not byte & 0x80:
+                return index - pos, length
+            shift += 7
+            if index - pos >= VARINT_MAX_SIZE:
+                raise FrameError("varint prefix too long")
+        return None
+
+    def decode(self, recv_buff):
+        data = recv_buff.data
+        start = pos = recv_buff.start
+        end = recv_buff.end
+        view = memoryview(data)
+        frames = []
+        while 1:
+            header = self.__header
+            if header is None:
+                header = self.__parse_header(data, pos, end)
+                if header is None:
+                    break
+                self._check_size(header[1])
+            header_size, length = header
+            frame_end = pos + header_size + length
+            if frame_end > end:
+                # 正文还没有接收完, 下次不再重新解析前缀
+                self.__header = header
+                break
+            self.__header = None
+            frames.append(view[pos + header_size: frame_end].tobytes())
+            pos = frame_end
+        del view
+        recv_buff.consume(pos - start)
+        return frames
+
+    def encode(self, frame):
+        size = len(frame)
+        if self.__struct is not None:
+            return [self.__struct.pack(size), frame]
+
+        header = bytearray()
+        while size > 0x7f:
+            header.append(size & 0x7f | 0x80)
+            size >>= 7
+        header.append(size)
+        return [bytes(header), frame]
+
+
+class DelimiterCodec(Codec):
+    '''以分隔符结尾的消息, 返回的消息不包含分隔符
+    '''
+
+    def __init__(self, delimiter=b'\n', max_frame_size=MAX_FRAME_SIZE):
+        '''初始化
+
+        参数:
+            delimiter: 分隔符, 例如 b'\\r\\n' 或 b'\\0'
+            max_frame_size: 消息的最大长度 (不包含分隔符), None 表示不限制
+        '''
+        Codec.__init__(self, max_frame_size)
+        if not delimiter:
+            raise ValueError("empty delimiter")
+        self.delimiter = delimiter
+        # 不完整的消息中已经确认没有分隔符的长度, 相对于未消费数据的开头
+        self.__scanned = 0
+
+    def _frame(self, data, view, pos, index):
+        '''取出 [pos, index) 的消息内容
+
+        参数:
+            data: 接收缓冲区的 bytearray
+            view: data 的 memoryview
+            pos: 消息的起始位置
+            index: 分隔符的位置
+        '''
+        return view[pos: index].tobytes()
+
+    def decode(self, recv_buff):
+        data = recv_buff.data
+        start = pos = recv_buff.start
+        end = recv_buff.end
+        delimiter = self.delimiter
+        delimiter_size = len(delimiter)
+        max_frame_size = self.max_frame_size
+        # 其他代码消费了缓冲区时, 已经扫描的位置失效
+        scanned = self.__scanned if self.__scanned <= end - pos else 0
+        view = memoryview(data)
+        frames = []
+        while 1:
+            # 超过最大长度的位置不需要扫描
+            limit = end
+            if max_frame_size is not None:
+                limit = min(end, pos + max_frame_size + delimiter_size)
+            index = data.find(delimiter, pos + scanned, limit)
+            if index < 0:
+                # 分隔符可能跨越两次接收, 结尾的 delimiter_size - 1 个字节
+                # 下次需要重新扫描, 之前的部分一定属于当前消息
+                scanned = max(end - pos - delimiter_size + 1, 0)
+                self._check_size(scanned)
+                self.__scanned = scanned
+                break
+            frames.append(self._frame(data, view, pos, index))
+            pos = index + delimiter_size
+            scanned = 0
+        del view
+        recv_buff.consume(pos - start)
+        return frames
+
+    def encode(self, frame):
+        return [frame, self.delimiter]
+
+
+class LineCodec(DelimiterCodec):
+    '''按行分割的消息, 同时接受 \\n 和 \\r\\n 结尾, 返回的消息不包含行尾.
+    编码时使用 \\r\\n
+    '''
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        '''初始化
+
+        参数:
+            max_frame_size: 一行的最大长度 (包含 \\r, 不包含 \\n), None 表示不限制
+        '''
+        DelimiterCodec.__init__(self, b'\n', max_frame_size)
+
+    def _frame(self, data, view, pos, index):
+        if index > pos and data[index - 1] == 0x0d:  # \r
+            index -= 1
+        return view[pos: index].tobytes()
+
+    def encode(self, frame):
+        return [frame, b'\r\n']
+
+
+class FixedSizeCodec(Codec):
+    '''每条消息长度固定
+    '''
+
+    def __init__(self, size, max_frame_size=MAX_FRAME_SIZE):
+        '''初始化
+
+        参数:
+            size: 消息长度
+            max_frame_size: 消息的最大长度, None 表示不限制
+        '''
+        Codec.__init__(self, max_frame_size)
+        if size <= 0:
+            raise ValueError("frame size must be positive")
+        self._check_size(size)
+        self.size = size
+
+    def decode(self, recv_buff):
+        size = self.size
+        count = len(recv_buff) // size
+        if count == 0:
+            return []
+        start = recv_buff.start
+        view = memoryview(recv_buff.data)
+        frames = [view[pos: pos + size].tobytes()
+                  for pos in xrange(start, start + count * size, size)]
+        del view
+        recv_buff.consume(count * size)
+        return frames
+
+    def encode(self, frame):
+        if len(frame) != self.size:
+            raise ValueError("frame size {} != {}".format(len(frame),
+                                                          self.size))
+        return [frame]
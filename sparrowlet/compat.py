@@ -0,0 +1,74 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+Python 2 和 Python 3 的差异.
+
+stackless 运行时只支持 Python 2, asyncio 运行时 (aio.py) 只支持 Python 3,
+两者共用的模块 (解析, 路由, 响应, 缓存, 统计, 日志) 通过这里的名称同时支持两个版本.
+网络上收发的数据在两个版本中都是 bytes (Python 2 的 str),
+请求行和头信息解码为本地的 str.
+'''
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+try:
+    import stackless
+except ImportError:
+    stackless = None
+
+if PY2:
+    import Queue as queue
+    import cPickle as pickle
+    import httplib as http_client
+    import urlparse
+    from urllib import unquote
+
+    text_type = unicode
+    integer_types = (int, long)
+    xrange = xrange
+
+    def iteritems(d):
+        return d.iteritems()
+
+    def native_str(data):
+        '''网络上收到的 bytes 转换为本地的 str
+        '''
+        return data
+
+    def to_wire(text):
+        '''本地的 str 转换为发送的 bytes
+        '''
+        return text
+
+    exec('''def reraise(tp, value, tb=None):
+    raise tp, value, tb
+''')
+else:
+    import queue
+    import pickle
+    import http.client as http_client
+    import urllib.parse as urlparse
+    from urllib.parse import unquote
+
+    text_type = str
+    integer_types = (int, )
+    xrange = range
+
+    def iteritems(d):
+        return iter(d.items())
+
+    def native_str(data):
+        '''网络上收到的 bytes 转换为本地的 str
+        '''
+        return data.decode('latin-1')
+
+    def to_wire(text):
+        '''本地的 str 转换为发送的 bytes
+        '''
+        return text.encode('latin-1')
+
+    def reraise(tp, value, tb=None):
+        if value.__traceback__ is not tb:
+            raise value.with_traceback(tb)
+        raise value
@@ -1,53 +1,141 @@
 #!/user/bin/env python
 # -*- encoding:utf-8 -*-
 import socket
+import select
 import time
 import errno
 
-import log
-import buff
+from . import log
+from . import buff
+from . import metrics
+from .compat import stackless
 
 
 logger = log.get_logger()
+stats = metrics.get_metrics()
 
+# 从 producer 中取数据时, 发送缓冲区最多积累的字节数
+PRODUCE_SIZE = 64 * 1024
+# 默认的发送缓冲区高水位: 超过后暂停读取该连接
+HIGH_WATER_MARK = 1024 * 1024
+# 默认的发送缓冲区低水位: 暂停后降到该值以下恢复读取
+LOW_WATER_MARK = 256 * 1024
 
-# 单例模型
-def singleton(cls, *args, **kargs):
-    instances = {}
 
-    def _singleton():
-        if cls not in instances:
-            instances[cls] = cls(*args, **kargs)
-        return instances[cls]
-    return _singleton
+# 连接表的初始长度, 不够时按两倍扩展
+TABLE_INIT_SIZE = 1024
 
 
 class FdInfo(object):
     '''包含文件描述子的需要的信息. 文件描述子既可以描述一个接收的 socket,
     也可以描述一个发送的 socket.
+
+    每个连接一个实例, 使用 __slots__ 减少内存占用.
+    收发缓冲区在第一次使用时创建, 空闲时可以通过 release_buffers 释放.
+    socket 由 FdManager.remove 显式关闭, 不依赖 __del__.
     '''
+    __slots__ = ('fd', 'address', 'socket', 'timestamp', '_sending_data',
+                 '_received_data', 'wait_write', 'send_notify', 'idle',
+                 'send_start', 'producer', 'receive_waiter', 'paused',
+                 'drain_waiter', 'closed', 'parser')
 
-    def __init__(self, address, new_socket):
+    def __init__(self, fd, address, new_socket):
         '''新建一个文件描述子, 初始化对应的 socket
 
         参数:
+            fd: 文件描述子
             address: 远端 IP 地址
             new_socket: fd 描述的 socket 实例
             timestamp: 上次操作的时间戳
-            sending_data: 待发送的数据
-            received_data: 已经接收到的数据
+            sending_data: 待发送的数据, 第一次访问时创建
+            received_data: 已经接收到的数据, 第一次访问时创建
+            wait_write: 是否因为有待发送数据而在 io 中注册了可写事件
+            send_notify: 有数据写入后还没有通知上层发送完毕
+            idle: 是否是等待下一个请求的空闲长连接, 由上层服务器设置,
+                  Loop 据此选择 keep-alive 超时
+            send_start: 发送缓冲区从空变为非空的时间, 用来统计发送耗时
+            producer: 按需生成待发送数据的迭代器, 见 send
+            receive_waiter: 在 wait_receive 中等待新数据的微线程使用的通道
+            paused: 发送缓冲区超过高水位后暂停读取, 降到低水位后恢复
+            drain_waiter: 在 wait_drain 中等待缓冲区降到低水位的微线程使用的通道
+            closed: 连接是否已经被 FdManager 关闭
+            parser: 上层协议的解析器, 例如 HttpServer 的 HttpParser,
+                    由上层服务器按需创建, 用来保存跨事件的解析状态
         '''
+        self.fd = fd
         self.address = address
         self.socket = new_socket
         self.timestamp = time.time()
-        self.sending_data = buff.Buff()
-        self.received_data = buff.Buff()
+        self._sending_data = None
+        self._received_data = None
+        self.wait_write = False
+        self.send_notify = False
+        self.idle = False
+        self.send_start = 0
+        self.producer = None
+        self.receive_waiter = None
+        self.paused = False
+        self.drain_waiter = None
+        self.closed = False
+        self.parser = None
 
         self.__init_socket()
 
-    def __del__(self):
-        '''关闭 socket
+    @property
+    def sending_data(self):
+        '''待发送数据的缓冲区 (buff.SendBuff)
+        '''
+        data = self._sending_data
+        if data is None:
+            data = self._sending_data = buff.SendBuff()
+        return data
+
+    @property
+    def received_data(self):
+        '''接收缓冲区 (buff.RecvBuff)
+        '''
+        data = self._received_data
+        if data is None:
+            data = self._received_data = buff.RecvBuff()
+        return data
+
+    @property
+    def send_size(self):
+        '''尚未发送的字节数, 不会创建缓冲区
+        '''
+        data = self._sending_data
+        return 0 if data is None else data.size
+
+    @property
+    def received_size(self):
+        '''尚未消费的已接收字节数, 不会创建缓冲区
         '''
+        data = self._received_data
+        return 0 if data is None else len(data)
+
+    def release_buffers(self):
+        '''释放已经清空的收发缓冲区, 例如连接变为空闲长连接时.
+        接收缓冲区可能在大请求之后扩展得很大, 释放后下次使用时重新创建
+        '''
+        if self._received_data is not None and \
+                len(self._received_data) == 0:
+            self._received_data = None
+        if self._sending_data is not None and \
+                self._sending_data.size == 0 and self.producer is None:
+            self._sending_data = None
+
+    def close(self):
+        '''关闭连接: 清空缓冲区, 关闭 producer 和 socket,
+        唤醒等待该连接的微线程
+        '''
+        self.closed = True
+        if self._sending_data is not None:
+            self._sending_data.clean()
+            self._sending_data = None
+        self._received_data = None
+        self.close_producer()
+        self.wake_receiver()
+        self.wake_drain()
         try:
             self.socket.close()
         except Exception as e:
@@ -64,107 +152,326 @@ class FdInfo(object):
     def receive(self):
         '''接收所有的数据, 并保存数据
         如果存在问题会抛出异常
+
+        返回对端是否已经关闭连接
         '''
         # 修改上次操作时间
         self.timestamp = time.time()
+        received_data = self.received_data
         while 1:
             try:
-                data = self.socket.recv(1024)
-                if data:
-                    self.received_data.append(data)
-                else:  # 传输完毕
-                    return
+                # 直接读进接收缓冲区, 读取大小由缓冲区自适应调整
+                received = received_data.recv_from(self.socket)
+                if received == 0:  # 对端关闭
+                    return True
+                stats.incr('bytes_in', received)
             except socket.error as e:
                 # 暂时没数据传输了, 空出 CPU
                 if e.errno == errno.EAGAIN:
-                    return
+                    return False
                 else:
                     raise e
 
+    def wait_receive(self):
+        '''让出当前微线程, 直到连接收到新数据或者被关闭.
+        等待期间可读事件不再分发接收任务, 而是直接唤醒等待的微线程
+        '''
+        self.receive_waiter = stackless.channel()
+        try:
+            self.receive_waiter.receive()
+        finally:
+            self.receive_waiter = None
+
+    def wake_receiver(self):
+        '''唤醒在 wait_receive 中等待的微线程, 没有则返回 False
+        '''
+        waiter = self.receive_waiter
+        if waiter is None or waiter.balance >= 0:
+            return False
+        waiter.send(None)
+        return True
+
+    def wait_drain(self):
+        '''读取暂停 (发送缓冲区超过高水位) 时让出当前微线程,
+        直到缓冲区降到低水位或者连接被关闭. 持续生成大量数据的处理函数
+        可以在每次发送后调用, 避免数据在内存中堆积
+
+        返回连接是否仍然可用
+        '''
+        if self.paused and not self.closed:
+            if self.drain_waiter is None:
+                self.drain_waiter = stackless.channel()
+            self.drain_waiter.receive()
+        return not self.closed
+
+    def wake_drain(self):
+        '''唤醒所有在 wait_drain 中等待的微线程
+        '''
+        waiter, self.drain_waiter = self.drain_waiter, None
+        while waiter is not None and waiter.balance < 0:
+            waiter.send(None)
+
+    def queue(self, data):
+        '''把数据放进发送缓冲区但不立即发送, 之后调用 send 一起发送.
+        用来把多个响应合并成一次发送
+
+        参数:
+            data: 待传送数据, 格式同 send
+        '''
+        if self.send_size == 0:
+            self.send_start = time.time()
+        if isinstance(data, (list, tuple)):
+            for item in data:
+                self.__append(item)
+        else:
+            self.__append(data)
+        self.send_notify = True
+
     def send(self, data=None):
         '''传送所有的待传送数据
         如果存在问题会抛出异常
+
+        参数:
+            data: 新的待传送数据, 可以是字符串, 也可以是字符串的列表.
+                  列表中的分片会按顺序发送, 不会拼接.
+                  列表的最后一项可以是生成分片的迭代器 (producer),
+                  发送缓冲区空了之后才会从中取出下一批数据.
+                  迭代器结束之前不要再发送其他数据.
+
+        返回待传送数据是否已经全部发送完毕
         '''
         # 修改上次操作时间
         self.timestamp = time.time()
-        if isinstance(data, str):
+        if data is not None:
+            self.queue(data)
+
+        sending_data = self.sending_data
+        while 1:
+            while sending_data.size > 0:
+                try:
+                    sent = sending_data.send_to(self.socket)
+                    stats.incr('bytes_out', sent)
+                except socket.error as e:
+                    # 暂时不传输数据了, 空出 CPU
+                    if e.errno == errno.EAGAIN:
+                        return False
+                    else:
+                        raise e
+            # socket 仍然可写, 继续从迭代器中取数据
+            if self.producer is None or not self.__produce():
+                return self.producer is None
+
+    def __append(self, data):
+        '''把数据放进发送缓冲区, 迭代器保存为 producer
+
+        参数:
+            data: 待发送数据
+        '''
+        if buff.is_producer(data):
+            self.producer = data
+        else:
             self.sending_data.append(data)
 
-        # 没有数据要传送
-        if len(self.sending_data) == 0:
-            return
+    def __produce(self):
+        '''从 producer 中取数据, 直到发送缓冲区达到 PRODUCE_SIZE 或者迭代结束.
+        迭代器抛出的异常会转换为 socket.error, 由调用者关闭连接
+
+        返回是否取到了数据
+        '''
+        sending_data = self.sending_data
+        try:
+            while sending_data.size < PRODUCE_SIZE:
+                sending_data.append(next(self.producer))
+        except StopIteration:
+            self.producer = None
+        except Exception as e:
+            logger.exception("producer failed")
+            self.close_producer()
+            raise socket.error(errno.ECONNABORTED, str(e))
+        return sending_data.size > 0
 
-        send_len = 0  # 已经发送完的数据长度
-        sending_data = self.sending_data.pop_str()
-        while send_len < len(sending_data):
+    def close_producer(self):
+        '''关闭尚未结束的 producer, 例如连接提前关闭时
+        '''
+        producer, self.producer = self.producer, None
+        close = getattr(producer, 'close', None)
+        if close is not None:
             try:
-                send_len += self.socket.send(sending_data[send_len:])
-            except socket.errno as e:
-                # 暂时不传输数据了, 空出 CPU
-                if e.errno == errno.EAGAIN:
-                    self.sending_data.append(sending_data[send_len:])
-                    return
-                else:
-                    raise e
+                close()
+            except Exception as e:
+                logger.error(str(e))
 
 
-@singleton
-class FdManager(dict):
-    '''继承自字典 dict 的类, 实现了如下功能:
+class FdManager(object):
+    '''连接表, 每个 Loop 持有一个实例. 以 fd 为下标直接索引, 实现了如下功能:
     1. 新建: new
-    2. 删除指定 fd: __delitem__
+    2. 删除指定 fd: remove
     3. 指定 fd 接收数据: receive
     4. 指定 fd 发送数据: send
+    5. 等待指定 fd 的发送缓冲区降到低水位: wait_drain
+    6. 查询: get, fd in fd_manager, fd_manager[fd], len, items, keys
     '''
 
-    def __init__(self, *args, **kargv):
+    def __init__(self):
         '''初始化
+        '''
+        # fd -> FdInfo, 没有连接的位置为 None
+        self.__table = [None] * TABLE_INIT_SIZE
+        self.__count = 0
+        self.__io_fd = None
+        self.__events = 0
+        self.__edge_triggered = False
+        self.__high_water = HIGH_WATER_MARK
+        self.__low_water = LOW_WATER_MARK
+        # 数据已经全部发送完毕, 等待通知上层的 fd
+        self.__flushed = []
+        # 发送缓冲区降到低水位, 等待恢复读取的 fd
+        self.__resumed = []
+
+    def get(self, fd, default=None):
+        '''返回 fd 对应的 FdInfo, 不存在时返回 default
 
         参数:
-            io_fd: io 的文件描述子
+            fd: 文件描述子
+            default: 不存在时的返回值
         '''
-        dict.__init__(self, *args, **kargv)
+        try:
+            fd_info = self.__table[fd]
+        except IndexError:
+            return default
+        return default if fd_info is None else fd_info
+
+    def __getitem__(self, fd):
+        fd_info = self.get(fd)
+        if fd_info is None:
+            raise KeyError(fd)
+        return fd_info
+
+    def __contains__(self, fd):
+        return self.get(fd) is not None
+
+    def __len__(self):
+        return self.__count
+
+    def items(self):
+        '''返回所有的 (fd, FdInfo), 遍历整个表, 不要在热路径中使用
+        '''
+        return [(fd, fd_info) for fd, fd_info in enumerate(self.__table)
+                if fd_info is not None]
+
+    def keys(self):
+        '''返回所有的 fd
+        '''
+        return [fd for fd, fd_info in enumerate(self.__table)
+                if fd_info is not None]
 
     def __delitem__(self, fd):
         ''' 删除某 fd, 包括如下操作:
         1. 从 io 中注销
         2. 关闭 fd 对应的 socket
-        3. 删除管理信息 (fd_info_dict)
+        3. 删除管理信息
         如果不存在 fd 会自动忽略
 
         参数:
             fd: 文件描述子
         '''
-        # 删除管理信息
-        fd_info = self.get(fd, None)
-        if fd_info is not None:
-            dict.__delitem__(self, fd)
-            del fd_info
+        fd_info = self.get(fd)
+        if fd_info is None:
+            return
+        self.__table[fd] = None
+        self.__count -= 1
+        stats.incr('connections', -1)
 
-        # 从 io 中注销
+        # 从 io 中注销, 需要在关闭 socket 之前进行
         try:
             self.__io_fd.unregister(fd)
-            pass
         except Exception as e:
             logger.error(str(e))
-            pass
 
-    def __setitem__(self, fd, fd_info):
-        '''重载超类的 __setitem__ 方法, 添加了对象判断.
-        如果不是 FdInfo 对象则抛出 ValueError 异常.
+        # 其他地方 (例如等待中的微线程) 可能还持有 fd_info 的引用,
+        # 所以显式关闭而不是等待回收
+        fd_info.close()
+
+    def set_io(self, io_fd, events, edge_triggered=False):
+        '''设置 io 的文件描述子
+
+        参数:
+            io_fd: epoll 或 poll 对象
+            events: 连接默认关注的事件, 不包含可写事件
+            edge_triggered: 是否是边缘触发模式, 该模式下注册后不再修改关注的事件
+        '''
+        self.__io_fd = io_fd
+        self.__events = events
+        self.__edge_triggered = edge_triggered
+
+    def set_water_marks(self, high_water, low_water):
+        '''设置发送缓冲区的高低水位
+
+        参数:
+            high_water: 超过该字节数后暂停读取连接, None 表示不限制
+            low_water: 暂停后降到该字节数以下恢复读取
+        '''
+        self.__high_water = high_water
+        self.__low_water = low_water
+
+    def __update_write(self, fd, fd_info, finished):
+        '''依据发送缓冲区调整事件的注册.
+        只有数据没能一次发送完时才关注可写事件, 发送完毕后立即取消.
+        缓冲区超过高水位时不再关注可读事件, 降到低水位后恢复.
 
         参数:
             fd: 文件描述子
             fd_info: FdInfo 实例
+            finished: 待发送数据是否已经全部发送
         '''
-        if not isinstance(fd_info, FdInfo):
-            raise ValueError
-        dict.__setitem__(self, fd, fd_info)
+        if finished and fd_info.send_notify:
+            fd_info.send_notify = False
+            self.__flushed.append(fd)
+            stats.observe('send', time.time() - fd_info.send_start)
+
+        wait_write = not finished
+        paused = fd_info.paused
+        if self.__high_water is not None:
+            size = fd_info.send_size
+            if paused:
+                paused = size > self.__low_water
+            else:
+                paused = size > self.__high_water
+        if wait_write == fd_info.wait_write and paused == fd_info.paused:
+            return
 
-    def set_io(self, io_fd):
-        self.__io_fd = io_fd
+        if paused != fd_info.paused:
+            if paused:
+                stats.incr('read_pauses')
+            else:
+                self.__resumed.append(fd)
+        fd_info.wait_write = wait_write
+        fd_info.paused = paused
+        # 边缘触发模式下由 Loop 跳过暂停的连接的可读事件
+        if not self.__edge_triggered:
+            events = self.__events
+            # select.POLLIN/POLLOUT 与 select.EPOLLIN/EPOLLOUT 的值相同
+            if paused:
+                events &= ~select.POLLIN
+            if wait_write:
+                events |= select.POLLOUT
+            self.__io_fd.modify(fd, events)
+
+    def pop_resumed(self):
+        '''返回并清空恢复读取的 fd
+        '''
+        resumed = self.__resumed
+        self.__resumed = []
+        return resumed
+
+    def pop_flushed(self):
+        '''返回并清空所有数据已经发送完毕, 需要通知上层 on_send 的 fd
+        '''
+        flushed = self.__flushed
+        self.__flushed = []
+        return flushed
 
-    def new(self, address, new_socket, events):
+    def new(self, address, new_socket):
         '''创建一个新的 fd->fd_info 映射
 
         参数:
@@ -173,35 +480,86 @@ class FdManager(dict):
         '''
         # 注册事件和 socket 到 eopll
         fd = new_socket.fileno()
-        self.__io_fd.register(fd, events)
-        fd_info = FdInfo(address, new_socket)
-        self[fd] = fd_info
+        self.__io_fd.register(fd, self.__events)
+        table = self.__table
+        if fd >= len(table):
+            table.extend([None] * max(len(table), fd + 1 - len(table)))
+        # 同一个 fd 上残留的旧连接 (不应出现), 直接覆盖
+        if table[fd] is None:
+            self.__count += 1
+        fd_info = table[fd] = FdInfo(fd, address, new_socket)
+        stats.incr('connections')
+        return fd_info
 
     def receive(self, fd):
         '''指定 fd 接收数据
 
         参数:
             fd: 指定文件描述子
+
+        返回对端是否已经关闭连接
         '''
         fd_info = self.get(fd)
         if fd_info is None:
             logger.error("Invalid fd {fd}".format(fd=fd))
             return
 
-        fd_info.receive()
+        return fd_info.receive()
 
     def send(self, fd, data=None):
         '''指定 fd 传送数据
 
         参数:
             fd: 指定文件描述子
+            data: 新的待传送数据
+
+        返回待传送数据是否已经全部发送完毕.
+        发送出错 (包括 producer 抛出异常) 时关闭连接并返回 False
         '''
         fd_info = self.get(fd)
         if fd_info is None:
             logger.error("Invalid fd {fd}".format(fd=fd))
             return
 
-        fd_info.send(data)
+        try:
+            finished = fd_info.send(data)
+        except socket.error as e:
+            logger.error("{fd} send failed: {e}".format(fd=fd, e=e))
+            self.remove(fd)
+            return False
+        self.__update_write(fd, fd_info, finished)
+        return finished
+
+    def queue(self, fd, data):
+        '''把数据放进指定 fd 的发送缓冲区, 之后调用 send 一起发送
+
+        参数:
+            fd: 指定文件描述子
+            data: 待传送数据
+
+        返回发送缓冲区是否超过高水位, 此时应该先调用 send
+        '''
+        fd_info = self.get(fd)
+        if fd_info is None:
+            logger.error("Invalid fd {fd}".format(fd=fd))
+            return False
+
+        fd_info.queue(data)
+        return self.__high_water is not None and \
+            fd_info.send_size > self.__high_water
+
+    def wait_drain(self, fd):
+        '''指定 fd 的读取暂停时让出当前微线程, 直到发送缓冲区降到低水位
+
+        参数:
+            fd: 指定文件描述子
+
+        返回连接是否仍然可用
+        '''
+        fd_info = self.get(fd)
+        if fd_info is None:
+            return False
+        return fd_info.wait_drain()
 
     def remove(self, fd):
         self.__delitem__(fd)
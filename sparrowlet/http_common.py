@@ -0,0 +1,287 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+stackless (http_server.py) 和 asyncio (aio.py) 两个 HTTP 服务器共用的逻辑,
+不依赖具体的运行时. 请求的路由, 响应的格式化和缓存都在 HttpServerMixin 中,
+两个 HttpServer 只负责收发数据和等待处理函数的结果.
+'''
+from . import cache
+from . import compat
+from . import http_parser
+from . import log
+from . import metrics
+from . import response
+from . import router
+
+# UriInterface 可以处理的 HTTP 方法, 对应同名的小写方法
+HTTP_METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH'))
+# UriInterface.offload 支持的取值
+OFFLOAD_THREAD = 'thread'
+OFFLOAD_PROCESS = 'process'
+
+logger = log.get_logger()
+stats = metrics.get_metrics()
+
+
+def call_in_process(uri_cls, method, http_data):
+    '''在进程池中创建处理类并调用处理函数, 返回 (结果, 状态, 头信息).
+    生成器等流式结果不能 pickle, 在子进程中合并成字符串
+
+    参数:
+        uri_cls: 处理类
+        method: 处理函数名, 例如 get
+        http_data: 请求数据
+    '''
+    uri_obj = uri_cls(http_data)
+    content = getattr(uri_obj, method)()
+    if response.is_stream(content):
+        content = b''.join(response.iter_chunks(content))
+    return content, uri_obj.status, uri_obj.headers
+
+
+def find_handler(handlers, method):
+    '''返回处理该方法的类, 没有时返回 None
+
+    参数:
+        handlers: Router.match 返回的 HTTP 方法 -> 处理类 的字典
+        method: 大写的 HTTP 方法
+    '''
+    return handlers.get(method) or handlers.get(None)
+
+
+def allowed_methods(handlers):
+    '''计算路径支持的 HTTP 方法, 用于 405 返回的 Allow 头
+
+    参数:
+        handlers: HTTP 方法 -> 处理类 的字典
+    '''
+    allowed = set()
+    for method, uri_cls in compat.iteritems(handlers):
+        for candidate in (method, ) if method else HTTP_METHODS:
+            if hasattr(uri_cls, candidate.lower()):
+                allowed.add(candidate)
+    return ', '.join(sorted(allowed))
+
+
+def wants_keep_alive(http_data):
+    '''依据 HTTP 版本和 Connection 头判断客户端是否要求保持连接
+
+    参数:
+        http_data: 请求数据
+    '''
+    connection = http_data.get_header('Connection', '').lower()
+    if http_data.version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+def response_status(send_data):
+    '''从序列化好的响应中取出状态码, 头的开头是 "HTTP/1.1 200"
+
+    参数:
+        send_data: [头, 正文] 形式的响应分片
+    '''
+    return int(send_data[0][9:12])
+
+
+class HttpServerMixin(object):
+    '''两个运行时的 HttpServer 共用的请求处理: 注册路由, 解析错误的响应,
+    是否保持连接, 404/400/405 的分发和响应缓存.
+
+    与 TcpServer 一起继承, 子类需要实现:
+        _produce(uri_cls, uri_obj, method, keep_alive): 调用处理函数并格式化结果
+        _fetch(key, ttl, producer): 从响应缓存获取, 未命中时调用 producer,
+                                    同一个 key 同时只生成一次
+    '''
+
+    def _init_http(self, max_keep_alive_requests, cache_max_bytes, stats_path,
+                   max_body_size, spool_size):
+        '''初始化, 参数见 http_server.HttpServer
+        '''
+        self.max_keep_alive_requests = max_keep_alive_requests
+        self.max_body_size = max_body_size
+        self.spool_size = spool_size
+        # 储存 URI 对应关系的词典
+        self.uri_dict = {}
+        # 路由表, 包含 uri_dict 中的静态路径
+        self.router = router.Router()
+        # GET 请求的响应缓存
+        self.response_cache = cache.ResponseCache(cache_max_bytes)
+        # 响应头的序列化, 默认的 HTTP 头只序列化一次
+        self.response_builder = response.ResponseBuilder({
+            'Content-Type': 'text/html;charset=utf-8',
+        })
+        if stats_path is not None:
+            self.route(stats_path, metrics.StatsHandler, methods=['GET'])
+
+    def _format(self, content, status=200, headers=None, keep_alive=True,
+                head_only=False):
+        '''格式化 HTTP 返回结果, 返回 [头, 正文] 两个分片
+
+        参数:
+            content: 返回的正文
+            status: 返回的状态码, 例如 404 或者 "404 Not Found"
+            headers: 追加或覆盖默认头的字典
+            keep_alive: 是否保持连接
+            head_only: 是否只发送头, 用于 HEAD 请求
+        '''
+        head, body = self.response_builder.build(content, status, headers,
+                                                 keep_alive)
+        return [head, b''] if head_only else [head, body]
+
+    def _respond(self, uri_obj, content, keep_alive):
+        '''使用处理类设置的状态和头信息格式化返回结果
+
+        参数:
+            uri_obj: 处理类的实例
+            content: 处理函数的返回值
+            keep_alive: 是否保持连接
+        '''
+        # HTTP/1.0 不支持 chunked 编码
+        chunked = uri_obj.http_data.version == 'HTTP/1.1'
+        head, body = self.response_builder.build(content, uri_obj.status,
+                                                 uri_obj.headers, keep_alive,
+                                                 chunked)
+        # HEAD 的响应头与 GET 相同 (包括 Content-Length), 但是没有正文
+        if uri_obj.http_data.method.upper() == 'HEAD':
+            if hasattr(body, 'close'):
+                body.close()
+            body = b''
+        return [head, body]
+
+    def _handler_failed(self, uri_cls, uri_obj, exc_info):
+        '''处理函数抛出异常时记录错误, 把响应改为 500 并返回它的正文.
+        直接调用, 线程池和进程池中执行的处理函数都使用同样的处理
+
+        参数:
+            uri_cls: 处理类
+            uri_obj: 处理类的实例
+            exc_info: 异常的 (类型, 实例, traceback)
+        '''
+        logger.error("{} failed".format(uri_cls.__name__), exc_info=exc_info)
+        uri_obj.status = 500
+        # 处理函数设置的头信息可能与出错的结果有关, 不再使用
+        uri_obj.headers = {}
+        return "500 {}".format(compat.http_client.responses[500])
+
+    def register(self, uri_dict):
+        '''注册处理对应 uri 的类
+
+        参数:
+            uri_dict: URI 与处理的类的对应词典
+        '''
+        self.uri_dict.update(uri_dict)
+        for uri, uri_cls in compat.iteritems(uri_dict):
+            self.router.add(uri, uri_cls)
+
+    def route(self, pattern, uri_cls, methods=None):
+        '''注册带参数的路径, 解析出的参数保存在 http_data.path_params 中.
+        路径模式的写法见 router.py
+
+        参数:
+            pattern: 路径模式, 例如 /user/<int:uid>
+            uri_cls: 处理的类
+            methods: 只处理这些 HTTP 方法, None 表示不限制.
+                     同一路径可以给不同的方法注册不同的类.
+        '''
+        self.router.add(pattern, uri_cls, methods)
+
+    def _keep_alive(self, http_data, parser):
+        '''依据 HTTP 版本和 Connection 头判断是否保持连接
+
+        参数:
+            http_data: 请求数据
+            parser: 该连接的解析器
+        '''
+        # 正在优雅退出, 不再保持连接
+        if self.loop.stopping:
+            return False
+        # 达到单个连接的请求数上限
+        if self.max_keep_alive_requests and \
+                parser.request_count >= self.max_keep_alive_requests:
+            return False
+        return wants_keep_alive(http_data)
+
+    def _wants_stream(self, http_data):
+        '''收到头信息后判断处理类是否要流式读取正文 (stream_body)
+
+        参数:
+            http_data: 还没有正文的请求数据
+        '''
+        method = http_data.method.upper()
+        handlers, _ = self.router.match(http_data.uri, method)
+        if handlers is None:
+            return False
+        uri_cls = find_handler(handlers, method)
+        return getattr(uri_cls, 'stream_body', False)
+
+    def _parse(self, fd, parser, received_data):
+        '''解析下一个完整的请求, 返回 (请求数据, 错误响应).
+        数据还没接收完时都是 None. 请求非法时返回 400 或 413 的响应,
+        之后该连接的数据边界已经无法确定, 不再保持连接
+
+        参数:
+            fd: 文件描述子
+            parser: 该连接的解析器
+            received_data: 该连接的接收缓冲区
+        '''
+        try:
+            return parser.parse(received_data), None
+        except http_parser.HttpBodyTooLarge as e:
+            logger.error("{fd} {e}".format(fd=fd, e=e))
+            status = 413
+        except http_parser.HttpParseError as e:
+            logger.error("{fd} received data error: {e}".format(fd=fd, e=e))
+            status = 400
+        parser.keep_alive = False
+        stats.count_status(status)
+        # 正文与状态行使用同一个原因短语
+        message = "{} {}".format(status, compat.http_client.responses[status])
+        return None, self._format(message, status, keep_alive=False)
+
+    def _handle(self, fd, http_data, keep_alive):
+        '''调用 URI 对应的处理类, 返回格式化好的结果.
+        结果的形式由子类的 _produce 和 _fetch 决定, 例如 asyncio 中的 Future
+
+        参数:
+            fd: 文件描述子
+            http_data: 请求数据
+            keep_alive: 是否保持连接
+        '''
+        method = http_data.method.upper()
+        handlers, params = self.router.match(http_data.uri, method)
+
+        # 页面不存在
+        if handlers is None:
+            return self._format("404 Not Found", 404, keep_alive=keep_alive,
+                                head_only=method == 'HEAD')
+
+        # 既不是 GET 也不是 POST 等常见方法, 那是什么鬼?
+        if method not in HTTP_METHODS:
+            return self._format("400 Bad Request", 400, keep_alive=keep_alive)
+
+        uri_cls = find_handler(handlers, method)
+        handle_name = method.lower()
+        if uri_cls is not None:
+            http_data.path_params = params
+            uri_obj = uri_cls(http_data)
+
+        # 路径存在但不支持该方法
+        if uri_cls is None or not hasattr(uri_obj, handle_name):
+            headers = {'Allow': allowed_methods(handlers)}
+            return self._format("405 Method Not Allowed", 405, headers,
+                                keep_alive=keep_alive,
+                                head_only=method == 'HEAD')
+
+        logger.info(" ".join((self.fd_manager[fd].address[0],
+                              method.lower(), http_data.raw_uri)))
+
+        def produce():
+            return self._produce(uri_cls, uri_obj, handle_name, keep_alive)
+
+        cache_ttl = getattr(uri_cls, 'cache_ttl', 0)
+        if method == 'GET' and cache_ttl > 0:
+            # 响应中的 Connection 头与 keep_alive 有关, 所以也加入 key
+            key = cache.make_key(http_data, uri_cls.cache_headers, keep_alive)
+            return self._fetch(key, cache_ttl, produce)
+        return produce()
@@ -0,0 +1,473 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+可断点续传的 HTTP 请求解析器.
+
+每个连接 (FdInfo) 持有一个解析器, 数据分多次到达时会从上一次停下的位置继续解析,
+每个字节只会被扫描一次, 不完整的请求会保留到下一次可读事件.
+解析直接在连接的接收缓冲区 (buff.RecvBuff) 上进行, 已经解析的数据会被消费掉.
+
+正文的长度由 Content-Length 决定, 或者使用 chunked 编码 (Transfer-Encoding),
+chunked 的正文在解析时解码. 处理方式:
+    1. 超过 max_body_size 时抛出 HttpBodyTooLarge, Content-Length
+       在收到头信息后立即检查, chunked 在收到每个分片的长度时检查
+    2. 超过 spool_size 时写入临时文件, HttpData.content 为文件对象
+    3. stream_filter 返回 True 的请求在收到头信息后立即返回,
+       HttpData.content 为 BodyReader, 由处理函数边接收边读取
+'''
+import tempfile
+
+from . import buff
+from . import compat
+from .compat import unquote
+
+
+# 解析状态
+STATE_REQUEST_LINE = 0  # 等待请求行
+STATE_HEADER = 1  # 解析头信息
+STATE_CONTENT = 2  # 接收正文
+STATE_CHUNK_SIZE = 3  # 等待 chunked 分片的长度行
+STATE_CHUNK_DATA = 4  # 接收 chunked 分片的数据
+STATE_CHUNK_END = 5  # 等待分片数据之后的 \r\n
+STATE_TRAILER = 6  # 最后一个分片之后的 trailer, 以空行结束
+
+# 请求行和头信息的总长度上限, 超过则认为请求非法
+MAX_HEADER_SIZE = 64 * 1024
+# 默认的正文最大长度
+MAX_BODY_SIZE = 64 * 1024 * 1024
+# 默认超过该长度的正文写入临时文件
+SPOOL_SIZE = 1024 * 1024
+
+
+class HttpParseError(Exception):
+    '''HTTP 请求格式错误, 出现后该连接的数据边界已经无法确定
+    '''
+    pass
+
+
+class HttpBodyTooLarge(HttpParseError):
+    '''正文长度超过限制, 上层应返回 413 并关闭连接
+    '''
+    pass
+
+
+class BodyReader(object):
+    '''流式读取正文的文件对象.
+    数据还没有到达时 read 会让出当前微线程, 直到连接收到新数据.
+    连接中途关闭时 read 返回已有的数据, 并把 aborted 设为 True.
+    '''
+
+    def __init__(self, parser, length):
+        '''初始化
+
+        参数:
+            parser: 所属的解析器, 读取时由它把接收缓冲区中的正文交给 feed
+            length: 正文长度, chunked 编码时为 None
+        '''
+        self.length = length
+        self.aborted = False
+        self.__parser = parser
+        self.__fd_info = None
+        self.__chunks = []
+        self.__size = 0  # 已接收未读取的字节数
+        self.__eof = False  # 正文已经全部接收
+        self.discarded = False  # 处理函数已经结束, 剩余的正文直接丢弃
+
+    def attach(self, fd_info):
+        '''绑定连接, 读取时从它的接收缓冲区中取数据
+
+        参数:
+            fd_info: 连接信息
+        '''
+        self.__fd_info = fd_info
+
+    def feed(self, data):
+        if not self.discarded:
+            self.__chunks.append(data)
+            self.__size += len(data)
+
+    def finish(self):
+        self.__eof = True
+
+    def discard(self):
+        '''处理函数结束后不再保存剩余的正文
+        '''
+        self.discarded = True
+        self.__chunks = []
+        self.__size = 0
+
+    def read(self, size=-1):
+        '''读取正文, size 小于 0 时读取全部. 返回空字符串表示已经读完
+
+        参数:
+            size: 最多读取的字节数
+        '''
+        fd_info = self.__fd_info
+        while not self.__eof and (size < 0 or self.__size < size):
+            self.__parser.parse(fd_info.received_data)
+            if self.__eof or 0 <= size <= self.__size:
+                break
+            if fd_info.closed:
+                self.aborted = True
+                break
+            fd_info.wait_receive()
+
+        data = b''.join(self.__chunks)
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+            self.__chunks = [rest]
+        else:
+            self.__chunks = []
+        self.__size -= len(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(buff.FILE_CHUNK_SIZE), b'')
+
+
+class HttpData(object):
+    '''用于保存处理过后的 HTTP 请求数据
+    '''
+
+    def __init__(self):
+        self.version = None  # HTTP 版本
+        self.uri = None  # HTTP 请求的 URI
+        self.raw_uri = None  # HTTP 的原始 URI, 包含参数
+        self.method = None  # 请求方式 POST/GET
+        self.content = None  # 正文数据
+        self.headers = {}  # 头信息字典
+        self.get_params = {}  # GET 信息字典
+        self.path_params = {}  # 从路径中解析出的参数字典, 见 HttpServer.route
+
+    def get_header(self, key, default=None):
+        '''不区分大小写地获取头信息
+
+        参数:
+            key: 头信息的名称
+            default: 不存在时的返回值
+        '''
+        value = self.headers.get(key)
+        if value is not None:
+            return value
+
+        key = key.lower()
+        for k, v in compat.iteritems(self.headers):
+            if k.lower() == key:
+                return v
+        return default
+
+
+class HttpParser(object):
+    '''HTTP 请求解析的状态机.
+
+    使用方法:
+        http_data = parser.parse(fd_info.received_data)  # 数据不完整时返回 None
+
+    解析器会记住:
+        1. 当前行已经扫描到的位置
+        2. 已经解析出来的请求行和头信息
+        3. 剩余未接收的 Content-Length 或者 chunked 分片的长度
+    '''
+
+    def __init__(self, max_body_size=MAX_BODY_SIZE, spool_size=SPOOL_SIZE,
+                 stream_filter=None):
+        '''初始化
+
+        参数:
+            max_body_size: 正文的最大长度, None 表示不限制
+            spool_size: 超过该长度的正文写入临时文件, None 表示不写入
+            stream_filter: 收到头信息后调用, 参数为 HttpData,
+                           返回 True 时该请求的正文流式读取
+        '''
+        self.max_body_size = max_body_size
+        self.spool_size = spool_size
+        self.stream_filter = stream_filter
+        self.__reader = None  # 正在流式读取的正文
+        self.__scan = 0  # 当前行已经扫描过的长度, 下次从这里继续查找 \r\n
+        self.__header_size = 0  # 当前请求已经解析的请求行和头信息的长度
+        self.__state = STATE_REQUEST_LINE
+        self.__http_data = HttpData()
+        self.__content = buff.Buff()  # 已接收的正文, 也可以是临时文件
+        self.__content_left = 0  # 剩余未接收的正文 (或当前分片) 长度
+        self.__body_size = 0  # chunked 编码已经声明的正文总长度
+        self.request_count = 0  # 该连接已经完整解析的请求数
+        self.keep_alive = True  # 该连接是否保持, 由上层服务器决定
+
+    def is_idle(self):
+        '''是否处于两个请求之间, 没有解析到一半的请求
+        '''
+        return self.__state == STATE_REQUEST_LINE and self.__scan == 0 and \
+            self.__reader is None
+
+    def end_stream(self):
+        '''流式请求的处理函数结束后调用, 之后才会解析下一个请求.
+        处理函数没有读取的正文会被丢弃
+        '''
+        reader = self.__reader
+        if reader is None:
+            return
+        reader.discard()
+        # 正文已经接收完毕
+        if self.__state == STATE_REQUEST_LINE:
+            self.__reader = None
+
+    def parse(self, buff):
+        '''从上一次停下的位置继续解析.
+
+        返回一个完整的 HttpData, 数据不完整时返回 None.
+        格式错误时抛出 HttpParseError.
+
+        参数:
+            buff: 连接的接收缓冲区, 解析过的数据会被消费掉
+        '''
+        while 1:
+            state = self.__state
+            if state == STATE_CONTENT or state == STATE_CHUNK_DATA:
+                if not self.__read_content(buff):
+                    return None
+                if state == STATE_CHUNK_DATA:
+                    self.__state = STATE_CHUNK_END
+                    continue
+                if self.__reader is None:
+                    return self.__finish()
+                self.__finish_stream()
+                continue
+            # 流式请求的处理函数还没有结束
+            if self.__reader is not None and state == STATE_REQUEST_LINE:
+                return None
+
+            end_index = buff.find(b'\r\n', self.__scan)
+            if end_index < 0:
+                # 最后一个字节可能是 \r, 下次从这里开始找
+                self.__scan = max(len(buff) - 1, 0)
+                if self.__header_size + len(buff) > MAX_HEADER_SIZE:
+                    raise HttpParseError("header too large")
+                return None
+
+            # 每行都小于上限的大量头信息也要限制
+            self.__header_size += end_index + 2
+            if self.__header_size > MAX_HEADER_SIZE:
+                raise HttpParseError("header too large")
+            line = compat.native_str(buff.read(end_index))
+            buff.consume(2)
+            self.__scan = 0
+
+            if state == STATE_REQUEST_LINE:
+                # 忽略请求之间多余的空行
+                if line:
+                    self.__parse_request_line(line)
+                    self.__state = STATE_HEADER
+                else:
+                    self.__header_size = 0
+            elif state == STATE_HEADER:
+                if line:
+                    self.__parse_header(line)
+                # 连续2个\r\n, 之后的都是正文数据
+                elif self.__begin_content():
+                    return self.__http_data
+            elif state == STATE_CHUNK_SIZE:
+                self.__parse_chunk_size(line)
+            elif state == STATE_CHUNK_END:
+                if line:
+                    raise HttpParseError("invalid chunk")
+                self.__header_size = 0
+                self.__state = STATE_CHUNK_SIZE
+            # trailer 中的头信息不使用, 以空行结束
+            elif not line:
+                if self.__reader is None:
+                    return self.__finish()
+                self.__finish_stream()
+
+    def __parse_request_line(self, line):
+        '''解析请求行
+
+        参数:
+            line: 请求的第一行
+        '''
+        try:
+            method, uri, version = line.split(' ')
+        except ValueError:
+            raise HttpParseError("invalid request line")
+
+        http_data = self.__http_data
+        http_data.method = method
+        http_data.raw_uri = uri
+        http_data.version = version
+        self.__parse_uri(uri)
+
+    def __parse_header(self, line):
+        '''解析 HTTP 的头信息
+
+        参数:
+            line: 头信息的一行数据
+        '''
+        try:
+            key, value = line.split(':', 1)
+        except ValueError:
+            return
+
+        key = unquote(key.strip())
+        value = unquote(value.strip())
+        # 如果有重复只保留最后一个
+        self.__http_data.headers[key] = value
+
+    def __parse_uri(self, uri):
+        '''解析 URI
+
+        参数:
+            uri: 从 HTTP 头中获取的 URI
+        '''
+        http_data = self.__http_data
+        # 如果不包含参数就直接 return
+        beg_index = uri.find('?')
+        if beg_index < 0:
+            http_data.uri = unquote(uri)
+            return
+
+        get_line = uri[beg_index + 1:]
+        http_data.uri = unquote(uri[: beg_index])
+        for pair in get_line.split('&'):
+            # 值中可以包含 =, 例如 base64
+            key, sep, value = pair.partition("=")
+            if not sep:
+                continue
+
+            key = unquote(key.strip())
+            value = unquote(value.strip())
+            # 如果有重复只保留最后一个
+            http_data.get_params[key] = value
+
+    def __begin_content(self):
+        '''头信息解析完毕, 依据 Content-Length 确定正文长度
+        '''
+        self.__header_size = 0
+        http_data = self.__http_data
+        transfer_encoding = http_data.get_header('Transfer-Encoding')
+        if transfer_encoding is not None:
+            return self.__begin_chunked(transfer_encoding)
+
+        content_length = http_data.get_header('Content-Length', '0')
+        try:
+            content_length = int(content_length)
+        except ValueError:
+            raise HttpParseError("invalid Content-Length")
+        if content_length < 0:
+            raise HttpParseError("invalid Content-Length")
+        if self.max_body_size is not None and \
+                content_length > self.max_body_size:
+            raise HttpBodyTooLarge("body too large: {}".format(
+                content_length))
+
+        self.__content_left = content_length
+        self.__state = STATE_CONTENT
+        if content_length > 0 and self.stream_filter is not None and \
+                self.stream_filter(self.__http_data):
+            self.__reader = BodyReader(self, content_length)
+            self.__http_data.content = self.__reader
+            self.request_count += 1
+            return True
+        if self.spool_size is not None and content_length > self.spool_size:
+            self.__content = tempfile.TemporaryFile()
+        return False
+
+    def __begin_chunked(self, transfer_encoding):
+        '''使用 chunked 编码的正文, 长度在接收分片时才知道
+
+        参数:
+            transfer_encoding: Transfer-Encoding 头的值
+        '''
+        # 同时有两种长度时无法确定请求的边界, 前后的代理可能理解不同
+        if transfer_encoding.strip().lower() != 'chunked' or \
+                self.__http_data.get_header('Content-Length') is not None:
+            raise HttpParseError("unsupported Transfer-Encoding: {}".format(
+                transfer_encoding))
+
+        self.__body_size = 0
+        self.__state = STATE_CHUNK_SIZE
+        if self.stream_filter is not None and \
+                self.stream_filter(self.__http_data):
+            self.__reader = BodyReader(self, None)
+            self.__http_data.content = self.__reader
+            self.request_count += 1
+            return True
+        return False
+
+    def __parse_chunk_size(self, line):
+        '''解析 chunked 分片的长度行, 长度为 0 表示正文结束
+
+        参数:
+            line: 分片的长度行, 可以带有扩展 (";" 之后的部分)
+        '''
+        size = line.split(';', 1)[0].strip()
+        try:
+            size = int(size, 16)
+        except ValueError:
+            raise HttpParseError("invalid chunk size")
+        if size < 0:
+            raise HttpParseError("invalid chunk size")
+        self.__header_size = 0
+        if size == 0:
+            self.__state = STATE_TRAILER
+            return
+
+        self.__body_size += size
+        if self.max_body_size is not None and \
+                self.__body_size > self.max_body_size:
+            raise HttpBodyTooLarge("body too large: {}".format(
+                self.__body_size))
+        # 已经接收的正文转存到临时文件中
+        if self.spool_size is not None and self.__reader is None and \
+                self.__body_size > self.spool_size and \
+                isinstance(self.__content, buff.Buff):
+            spool = tempfile.TemporaryFile()
+            spool.write(self.__content.pop_str())
+            self.__content = spool
+        self.__content_left = size
+        self.__state = STATE_CHUNK_DATA
+
+    def __read_content(self, recv_buff):
+        '''读取正文, 正文接收完毕返回 True
+
+        参数:
+            recv_buff: 连接的接收缓冲区
+        '''
+        size = min(self.__content_left, len(recv_buff))
+        if size > 0:
+            if self.__reader is not None:
+                self.__reader.feed(recv_buff.read(size))
+            elif isinstance(self.__content, buff.Buff):
+                self.__content.append(recv_buff.read(size))
+            else:
+                self.__content.write(recv_buff.read(size))
+            self.__content_left -= size
+        return self.__content_left == 0
+
+    def __finish(self):
+        '''完成一个请求, 重置状态准备解析下一个请求
+        '''
+        http_data = self.__http_data
+        if isinstance(self.__content, buff.Buff):
+            http_data.content = self.__content.pop_str()
+        else:
+            # 写入临时文件的正文, 从头开始读取
+            http_data.content = self.__content
+            http_data.content.seek(0)
+            self.__content = buff.Buff()
+
+        self.__http_data = HttpData()
+        self.__state = STATE_REQUEST_LINE
+        # chunked 的长度行和 trailer 也计入了头信息的长度
+        self.__header_size = 0
+        self.request_count += 1
+        return http_data
+
+    def __finish_stream(self):
+        '''流式请求的正文接收完毕, 重置状态.
+        处理函数已经结束时可以开始解析下一个请求
+        '''
+        self.__reader.finish()
+        self.__http_data = HttpData()
+        self.__state = STATE_REQUEST_LINE
+        self.__header_size = 0
+        if self.__reader.discarded:
+            self.__reader = None
@@ -1,243 +1,202 @@
 #!/user/bin/env python
 # -*- encoding:utf-8 -*-
-import urllib
-import copy
+import sys
+import time
 
-import tcp_server
-import log
-import fd
+import stackless
 
+from . import tcp_server
+from . import http_parser
+from . import http_common
+from . import log
+from . import buff
+from . import metrics
+from .http_common import OFFLOAD_THREAD, OFFLOAD_PROCESS
 
-logger = log.get_logger()
-fd_manager = fd.FdManager()
-
-
-class HttpData(object):
-    '''用于保存处理过后的 HTTP 请求数据
-    '''
 
-    def __init__(self):
-        self.version = None  # HTTP 版本
-        self.uri = None  # HTTP 请求的 URI
-        self.raw_uri = None  # HTTP 的原始 URI, 包含参数
-        self.method = None  # 请求方式 POST/GET
-        self.content = None  # 正文数据
-        self.headers = {}  # 头信息字典
-        self.get_params = {}  # GET 信息字典
+logger = log.get_logger()
+stats = metrics.get_metrics()
 
 
-class HttpServer(tcp_server.TcpServer):
+class HttpServer(http_common.HttpServerMixin, tcp_server.TcpServer):
     '''基于 stackless 的简单 HTTP 服务器.
 
-    会响应的 URI 需要通过 register 函数来注册.
+    会响应的 URI 需要通过 register 或 route 函数来注册.
+    路由和响应的格式化见 http_common.HttpServerMixin.
     '''
 
-    def __init__(self, port, timeout, tasklet_num):
+    def __init__(self, port, timeout, tasklet_num, keep_alive_timeout=None,
+                 max_keep_alive_requests=100, cache_max_bytes=64 * 1024 * 1024,
+                 stats_path=None, max_body_size=http_parser.MAX_BODY_SIZE,
+                 spool_size=http_parser.SPOOL_SIZE, **kargs):
         '''初始化
 
         参数:
             port: 监听端口
-            timeout: 超时时长 (ms)
-            tasklet_num: 微线程个数
+            timeout: 超时时长 (s)
+            tasklet_num: 最少保留的微线程个数, 负载高时会自动增加
+            keep_alive_timeout: 长连接空闲的超时时长, None 表示与 timeout 相同
+            max_keep_alive_requests: 单个连接最多处理的请求数, 0 表示不限制
+            cache_max_bytes: 响应缓存的最大字节数, 只有设置了 cache_ttl 的
+                             UriInterface 会使用缓存
+            stats_path: 返回统计数据的路径, 例如 /stats, None 表示不开启
+            max_body_size: 请求正文的最大长度, 超过时返回 413, None 表示不限制
+            spool_size: 超过该长度的请求正文写入临时文件, None 表示不写入
+            kargs: 其余参数见 TcpServer
         '''
-        tcp_server.TcpServer.__init__(self, port, timeout, tasklet_num)
-        # 储存 URI 对应关系的词典
-        self.uri_dict = {}
-        # 默认的 HTTP 头
-        self.__default_send_header = {
-            'Content-Type': 'text/html;charset=utf-8',
-            'Connection': 'keep-alive',
-        }
-        # 404 返回的结果
-        self.__404 = self.__format("404 Not Found", "404 Not Found")
-        # 400 返回的结果
-        self.__400 = self.__format("400 Bad Request", "400 Bad Request")
-
-    def __parse_header(self, line, index, http_data):
-        '''解析 HTTP 的头信息
+        tcp_server.TcpServer.__init__(self, port, timeout, tasklet_num,
+                                      keep_alive_timeout=keep_alive_timeout,
+                                      **kargs)
+        self._init_http(max_keep_alive_requests, cache_max_bytes, stats_path,
+                        max_body_size, spool_size)
+
+    def __call(self, uri_cls, uri_obj, method):
+        '''调用处理函数, 依据处理类的 offload 属性在当前微线程,
+        线程池或者进程池中执行
 
         参数:
-            line: 头信息的一行数据
-            index: 头信息的行号, 从0开始
-            http_data: 保存处理完后信息的对象
+            uri_cls: 处理类
+            uri_obj: 处理类的实例
+            method: 处理函数名, 例如 get
         '''
-        # 第一行信息比较特殊
-        if index == 0:
-            # 如果这里报错链接关闭, 因为数据解析位置已经出错
-            method, uri, version = line.split(' ')
-            http_data.method = method
-            http_data.raw_uri = uri
-            self.__parse_uri(uri, http_data)
-            http_data.version = version
-            return
-
-        # 其余行数据格式比较固定
-        try:
-            key, value = line.split(':', 1)
-        except ValueError:
-            return
-
-        key = urllib.unquote(key.strip())
-        value = urllib.unquote(value.strip())
-        # 如果有重复只保留最后一个
-        http_data.headers[key] = value
-
-    def __parse_uri(self, uri, http_data):
-        '''解析 URI
+        offload = getattr(uri_cls, 'offload', None)
+        if offload is None:
+            return getattr(uri_obj, method)()
+        if offload == OFFLOAD_THREAD:
+            return self.loop.run_in_thread(getattr(uri_obj, method))
+        if offload == OFFLOAD_PROCESS:
+            content, uri_obj.status, uri_obj.headers = \
+                self.loop.run_in_process(http_common.call_in_process, uri_cls,
+                                         method, uri_obj.http_data)
+            return content
+        raise ValueError("unknown offload {!r} of {}".format(
+            offload, uri_cls.__name__))
+
+    def _produce(self, uri_cls, uri_obj, method, keep_alive):
+        '''调用处理函数并格式化结果, 等待期间只挂起当前微线程.
+        处理函数抛出异常时返回 500
 
         参数:
-            uri: 从 HTTP 头中获取的 URI
-            http_data: 保存处理完后信息的对象
+            uri_cls: 处理类
+            uri_obj: 处理类的实例
+            method: 处理函数名, 例如 get
+            keep_alive: 是否保持连接
         '''
-        # 如果不包含参数就直接 return
         try:
-            beg_index = uri.index('?')
-        except ValueError:
-            http_data.uri = urllib.unquote(uri)
-            return
-
-        get_line = uri[beg_index + 1:]
-        http_data.uri = urllib.unquote(uri[: beg_index])
-        for pair in get_line.split('&'):
-            try:
-                key, value = pair.split("=")
-            except ValueError:
-                continue
+            content = self.__call(uri_cls, uri_obj, method)
+        except Exception:
+            content = self._handler_failed(uri_cls, uri_obj, sys.exc_info())
+        return self._respond(uri_obj, content, keep_alive)
 
-            key = urllib.unquote(key.strip())
-            value = urllib.unquote(value.strip())
-            # 如果有重复只保留最后一个
-            http_data.get_params[key] = value
-
-    def __parse_content(self, content, http_data):
-        '''解析 content. 依据头信息中的 Content-Length 判断是否已经接收完毕.
-
-        参数:
-            content: HTTP 正文
-            http_data: 保存处理完后信息的对象
+    def _fetch(self, key, ttl, producer):
+        '''从响应缓存获取, 未命中时调用 producer, 见 cache.ResponseCache.fetch
         '''
-        # 如果不包含 Content-Length 就意味着没有 content.
-        content_length = 0
-        keys = ('Content-Length', 'content-length')
-        for key in keys:
-            http_data.headers.get(key)
-            if content_length is not None:
-                break
-
-        left_data = None
-        if content_length <= len(content):
-            # 保存正文数据
-            http_data.content = content[:content_length]
-            left_data = content[content_length:]
-        else:
-            left_data = content
-        # 把多余的数据存放进 FdInfo, 留着下次用
-        fd_manager.append_received_data(fd, left_data)
-
-    def __parse(self, data, http_data):
-        '''解析的入口函数.
+        return self.response_cache.fetch(key, ttl, producer)
 
-        如果 http_data 中的 content 是 None, 则表示没有接收完整数据.
-
-        参数:
-            data: 收取到的数据, 可能完整可能不完整.
-            http_data: 保存处理完后信息的对象
+    def on_receive(self, fd):
+        '''接收到数据后的操作
+        数据交给该连接的解析器, 不完整的请求会留在解析器中等待后续数据.
+        已经完整的多个请求 (pipelining) 会按顺序依次处理,
+        它们的响应合并后一起发送.
         '''
-        beg_index, end_index = 0, 0
-
-        index = 0
-        go_on = False
-        while 1:
-            # 查找每一个分行
-            try:
-                end_index = data.index('\r\n', beg_index)
-            except ValueError:
+        fd_manager = self.fd_manager
+        fd_info = fd_manager.get(fd)
+        if fd_info is None:
+            return
+        if fd_info.parser is None:
+            fd_info.parser = http_parser.HttpParser(
+                self.max_body_size, self.spool_size, self._wants_stream)
+        # 有新的请求数据, 不再按空闲长连接计算超时
+        fd_info.idle = False
+
+        parser = fd_info.parser
+        # 每个响应单独发送会产生多个小包, 先放进发送缓冲区, 最后一起发送
+        queued = False
+        # 已经决定关闭的连接不再处理后续请求. 发送缓冲区超过高水位时
+        # 也不再处理, 降到低水位后由 Loop 重新派发
+        while parser.keep_alive and not fd_info.paused:
+            start = time.time()
+            http_data, error = self._parse(fd, parser, fd_info.received_data)
+            if error is not None:
+                fd_manager.queue(fd, error)
+                queued = True
                 break
 
-            # 连续2个\r\n, 之后的都是正文数据.
-            # 正文处理过后这轮请求的边界就已经处理完了
-            if beg_index == end_index:
-                self.__parse_content(data[beg_index + 2:], http_data)
-                # 如果有
-                go_on = True
+            # 数据还没接收完毕
+            if http_data is None:
                 break
 
-            # 头信息
-            line = data[beg_index: end_index]
-            self.__parse_header(line, index, http_data)
-            beg_index = end_index + 2
-            index += 1
-
-    def __format(self, content, code="200 OK", header=None):
-        '''格式化 HTTP 返回结果
+            handle_start = time.time()
+            stats.observe('parse', handle_start - start)
+            parser.keep_alive = self._keep_alive(http_data, parser)
+            if isinstance(http_data.content, http_parser.BodyReader):
+                # 流式读取正文的处理函数会等待后续数据, 在新的微线程中
+                # 立即运行, 避免工作微线程全部在等待时 Loop 无法派发任务
+                if queued:
+                    fd_manager.send(fd)
+                task = stackless.tasklet()
+                task.bind(self.__stream)
+                task.setup(fd, fd_info, http_data)
+                task.run()
+                return
+            send_data = self._handle(fd, http_data, parser.keep_alive)
+            stats.observe('handler', time.time() - handle_start)
+            if send_data:
+                stats.count_status(http_common.response_status(send_data))
+                queued = True
+                # 超过高水位时立即发送, 仍然超过则暂停处理后续请求
+                if fd_manager.queue(fd, send_data):
+                    queued = False
+                    fd_manager.send(fd)
+                    if fd_info.closed:
+                        return
+                # 流式响应发送完之前不处理后续的请求, 由 on_send 继续
+                if buff.is_producer(send_data[-1]):
+                    break
+
+        if queued:
+            fd_manager.send(fd)
+
+    def __stream(self, fd, fd_info, http_data):
+        '''运行流式读取正文的处理函数, 之后继续处理已经收到的后续请求
 
         参数:
-            content: 返回的正文
-            code: 返回的错误码
-            header: 返回的头, 如果为 None 自动使用默认头信息
+            fd: 连接的文件描述符
+            fd_info: 连接信息
+            http_data: 正文为 BodyReader 的请求数据
         '''
-        if header is None:
-            header = copy.copy(self.__default_send_header)
-        # 添加长度
-        header['Content-Length'] = str(len(content))
-        # 将字典信息变成一行
-        header_line = "\r\n".join([": ".join(x) for x in header.items()])
-
-        return 'HTTP/1.1 {}\r\n{}\r\n\r\n{}'.format(code, header_line, content)
-
-    def register(self, uri_dict):
-        '''注册处理对应 uri 的类
-
-        参数:
-            uri_dict: URI 与处理的类的对应词典
-        '''
-        self.uri_dict.update(uri_dict)
-
-    def on_receive(self, fd):
-        '''接收到数据后的操作
-        '''
-        # 分析获取到的数据
-        data = fd_manager.pop_received_data(fd)
-        http_data = HttpData()
-
-        try:
-            self.__parse(data, http_data)
-        except Exception as e:
-            print e
-            logger.error("{fd} received data error".format(fd=fd))
-            fd_manager.remove(fd)
-            return
-
-        # 数据还没接收完毕
-        if http_data.content is None:
+        parser = fd_info.parser
+        handle_start = time.time()
+        http_data.content.attach(fd_info)
+        send_data = self._handle(fd, http_data, parser.keep_alive)
+        stats.observe('handler', time.time() - handle_start)
+        parser.end_stream()
+        # 读取正文期间连接可能已经关闭
+        if fd_info.closed:
             return
-
-        method = http_data.method.lower()
-        uri_cls = self.uri_dict.get(http_data.uri)
-        send_data = None
-
-        # 页面不存在
-        if uri_cls is None:
-            send_data = self.__404
-        else:
-            uri_obj = uri_cls(http_data)
-            if method == 'get':
-                logger.info(" ".join((fd_manager[fd].address[0],
-                                      method, http_data.raw_uri)))
-                send_data = uri_obj.get()
-                send_data = self.__format(send_data)
-            elif method == 'post':
-                logger.info(" ".join((fd_manager[fd].address[0],
-                                      method, http_data.raw_uri)))
-                send_data = uri_obj.post()
-                send_data = self.__format(send_data)
-            else:  # 既不是 GET 也不是 POST, 那是什么鬼?
-                send_data = self.__400
-
         if send_data:
-            fd_manager.send(fd, send_data)
+            stats.count_status(http_common.response_status(send_data))
+            self.fd_manager.send(fd, send_data)
+            if buff.is_producer(send_data[-1]):
+                return
+        if parser.keep_alive and fd_info.received_size > 0:
+            self.on_receive(fd)
 
     def on_send(self, fd):
-        ''' 发送完后关闭连接
+        '''发送完后的操作
+        长连接保留 fd 等待下一个请求, 否则关闭连接.
+        流式响应期间收到的后续请求在这里继续处理
         '''
-        fd_manager.remove(fd)
+        fd_info = self.fd_manager.get(fd)
+        if fd_info is None:
+            return
+
+        parser = fd_info.parser
+        if parser is None or not parser.keep_alive:
+            self.fd_manager.remove(fd)
+        elif fd_info.received_size > 0:
+            self.on_receive(fd)
+        elif parser.is_idle():
+            fd_info.idle = True
+            # 空闲的长连接不保留缓冲区, 下一个请求到达时重新创建
+            fd_info.release_buffers()
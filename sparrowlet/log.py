@@ -1,12 +1,260 @@
 #!/user/bin/env python
 # -*- encoding:utf-8 -*-
+'''
+非阻塞的日志.
+
+事件循环中只把格式化好的日志放进队列, 由单独的写线程批量写入文件,
+磁盘 IO 不会阻塞事件循环. 队列满时丢弃日志并计数.
+
+多个进程可以写同一个文件: 每次写入前对锁文件加 flock, 按大小或时间分割时
+只有一个进程会执行 rename, 其他进程发现文件被替换后重新打开.
+也可以设置 per_worker_file, 让每个 worker 写自己的文件.
+'''
+import errno
+import fcntl
 import logging
 import os
+import threading
+import time
+
+from .compat import queue, text_type
 
 init_flag = False
 path = 'log'
 filename = 'sparrow.log'
 
+# 日志文件超过该大小 (byte) 时分割, 0 表示不按大小分割
+max_bytes = 256 * 1024 * 1024
+# 按时间分割的周期 (s), 例如 86400 表示每天, 0 表示不按时间分割
+rotate_interval = 0
+# 队列中最多缓存的日志条数, 超过后丢弃
+queue_size = 10000
+# 写线程每批最多写入的日志条数
+batch_size = 512
+# 多进程时每个 worker 是否写自己的文件 (filename.编号)
+per_worker_file = False
+
+# 队列的结束标记
+_STOP = object()
+
+
+class LogWriter(object):
+    '''把日志批量写入文件, 负责文件的分割. 在写线程中运行.
+    '''
+
+    def __init__(self, file_path):
+        '''初始化
+
+        参数:
+            file_path: 日志文件路径
+        '''
+        self.file_path = file_path
+        self.__fd = None
+        self.__lock_fd = os.open(file_path + '.lock',
+                                 os.O_WRONLY | os.O_CREAT, 0o644)
+
+    def write(self, data):
+        '''加锁后写入数据, 需要时先分割文件
+
+        参数:
+            data: 待写入的字符串
+        '''
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        fcntl.flock(self.__lock_fd, fcntl.LOCK_EX)
+        try:
+            self.__check_file()
+            while data:
+                written = os.write(self.__fd, data)
+                data = data[written:]
+        finally:
+            fcntl.flock(self.__lock_fd, fcntl.LOCK_UN)
+
+    def __check_file(self):
+        '''文件被其他进程分割后重新打开, 达到分割条件时分割
+        '''
+        try:
+            stat = os.stat(self.file_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            stat = None
+
+        if stat is not None and stat.st_size > 0 and self.__need_rotate(stat):
+            os.rename(self.file_path, self.__rotate_name(stat))
+            stat = None
+
+        if self.__fd is not None and \
+                (stat is None or os.fstat(self.__fd).st_ino != stat.st_ino):
+            os.close(self.__fd)
+            self.__fd = None
+        if self.__fd is None:
+            self.__fd = os.open(self.file_path,
+                                os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def __need_rotate(self, stat):
+        '''依据文件的大小和最后修改时间判断是否需要分割.
+        分割后的新文件修改时间在当前周期内, 所以其他进程不会重复分割.
+
+        参数:
+            stat: 日志文件的 os.stat 结果
+        '''
+        if max_bytes and stat.st_size >= max_bytes:
+            return True
+        if rotate_interval:
+            now = time.time()
+            return int(stat.st_mtime // rotate_interval) != \
+                int(now // rotate_interval)
+        return False
+
+    def __rotate_name(self, stat):
+        '''分割后的文件名: 文件名.最后修改时间, 重名时加上序号
+
+        参数:
+            stat: 日志文件的 os.stat 结果
+        '''
+        suffix = time.strftime('%Y%m%d-%H%M%S', time.localtime(stat.st_mtime))
+        name = '{}.{}'.format(self.file_path, suffix)
+        index = 1
+        while os.path.exists(name):
+            name = '{}.{}.{}'.format(self.file_path, suffix, index)
+            index += 1
+        return name
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+        os.close(self.__lock_fd)
+
+
+class QueueHandler(logging.Handler):
+    '''把格式化好的日志放进队列的 Handler, emit 不会阻塞.
+
+    统计信息:
+        written: 已经写入文件的条数
+        dropped: 队列满或者写入失败时丢弃的条数
+    '''
+
+    def __init__(self, file_path, level=logging.NOTSET):
+        '''初始化
+
+        参数:
+            file_path: 日志文件路径
+            level: 日志级别
+        '''
+        logging.Handler.__init__(self, level)
+        self.file_path = file_path
+        self.written = 0
+        self.dropped = 0
+        # emit 所在的线程和写线程都会增加 dropped
+        self.__dropped_lock = threading.Lock()
+        self.__queue = None
+        self.__thread = None
+        self.__pid = None
+        self.__reported_dropped = 0
+
+    def start(self, file_path=None):
+        '''启动写线程. fork 之后线程不会被继承, 需要在子进程中重新启动
+
+        参数:
+            file_path: 新的日志文件路径, None 表示不变
+        '''
+        if file_path is not None:
+            self.file_path = file_path
+        # 旧队列的锁可能在 fork 时被写线程持有, 所以使用新的队列和锁
+        self.__queue = queue.Queue(queue_size)
+        self.__dropped_lock = threading.Lock()
+        self.__pid = os.getpid()
+        self.__thread = threading.Thread(target=self.__run,
+                                         args=(self.__queue, ),
+                                         name='log-writer')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def emit(self, record):
+        if self.__pid != os.getpid():
+            # fork 之后第一次写日志
+            self.start()
+        try:
+            line = self.format(record)
+            # Python 2 的 unicode 编码为 utf-8, Python 3 写入时再编码
+            if not isinstance(line, str):
+                line = line.encode('utf-8')
+            self.__queue.put_nowait(line + '\n')
+        except queue.Full:
+            self.__drop(1)
+        except Exception:
+            self.handleError(record)
+
+    def __drop(self, count):
+        '''增加丢弃的条数
+
+        参数:
+            count: 丢弃的条数
+        '''
+        with self.__dropped_lock:
+            self.dropped += count
+
+    def __run(self, log_queue):
+        '''写线程的主循环: 阻塞等待日志, 每次取出队列中已有的日志一起写入
+
+        参数:
+            log_queue: 日志队列
+        '''
+        writer = LogWriter(self.file_path)
+        stopped = False
+        while not stopped:
+            lines = [log_queue.get()]
+            try:
+                while len(lines) < batch_size:
+                    lines.append(log_queue.get_nowait())
+            except queue.Empty:
+                pass
+            stopped = _STOP in lines
+            if stopped:
+                lines.remove(_STOP)
+
+            dropped = self.dropped
+            if dropped != self.__reported_dropped:
+                lines.append('WARNING {} {} log records dropped\n'.format(
+                    time.strftime('%Y-%m-%d %H:%M:%S'),
+                    dropped - self.__reported_dropped))
+                self.__reported_dropped = dropped
+            if not lines:
+                continue
+            try:
+                writer.write(''.join(lines))
+                self.written += len(lines)
+            except (IOError, OSError):
+                self.__drop(len(lines))
+        writer.close()
+
+    def stop(self, timeout=5):
+        '''停止写线程, 等待队列中的日志写完
+
+        参数:
+            timeout: 最长等待时长 (s)
+        '''
+        thread = self.__thread
+        if thread is None or not thread.is_alive() or \
+                self.__pid != os.getpid():
+            return
+        try:
+            self.__queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+        self.__thread = None
+        self.__pid = None
+
+    def close(self):
+        self.stop()
+        logging.Handler.close(self)
+
+
+handler = None
+
 
 def get_logger():
     global init_flag
@@ -18,7 +266,7 @@ def get_logger():
 
 
 def init_logger():
-    global path, filename, init_flag
+    global path, filename, init_flag, handler
     fmt = '%(levelname)s %(asctime)s %(filename)s|%(lineno)d %(message)s'
     formatter = logging.Formatter(fmt)
     logger = logging.getLogger()
@@ -26,8 +274,32 @@ def init_logger():
     file_path = '{}/{}'.format(path, filename)
     if not os.path.exists(path):
         os.mkdir(path)
-    fh = logging.FileHandler(file_path)
-    fh.setLevel(logging.INFO)
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    handler = QueueHandler(file_path, logging.INFO)
+    handler.setFormatter(formatter)
+    handler.start()
+    logger.addHandler(handler)
     init_flag = True
+
+
+def after_fork(index):
+    '''worker 进程启动时调用, 重新启动写线程
+
+    参数:
+        index: worker 编号
+    '''
+    if handler is None:
+        return
+    file_path = None
+    if per_worker_file:
+        file_path = '{}/{}.{}'.format(path, filename, index)
+    handler.start(file_path)
+
+
+def shutdown(timeout=5):
+    '''把队列中的日志写完, 进程退出前调用
+
+    参数:
+        timeout: 最长等待时长 (s)
+    '''
+    if handler is not None:
+        handler.stop(timeout)
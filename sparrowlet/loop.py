@@ -2,25 +2,51 @@
 # -*- encoding:utf-8 -*-
 import select
 import time
+import os
+import errno
+import math
 
-import log
-import fd
+import stackless
+
+from . import log
+from . import fd
 import socket
-import tasks
+from . import tasks
+from . import timer
+from . import metrics
+from . import offload
 
 
 # 包装了一层的事件
 EVENT_READ = select.POLLIN
 EVENT_WRITE = select.POLLOUT
 EVENT_ERR = select.POLLERR | select.POLLHUP
+# 边缘触发, 只有 epoll 支持
+EVENT_ET = getattr(select, 'EPOLLET', 0)
+# 多个进程共享监听 socket 时每个事件只唤醒一个进程, Linux 4.5 开始支持
+EVENT_EXCLUSIVE = getattr(select, 'EPOLLEXCLUSIVE', 1 << 28)
 
-# 命令
-CMD_ONRECEIVE = 0x01
-CMD_ONSEND = 0x02
+# 时间轮每个格子的最大时长 (s)
+TIMER_TICK = 1.0
+# 输出接收连接数的间隔 (s)
+ACCEPT_REPORT_INTERVAL = 60
+# 优雅退出时检查剩余连接的间隔 (s)
+STOP_CHECK_INTERVAL = 1.0
 
 # 全局定义的单例对象
-fd_manager = fd.FdManager()
 logger = log.get_logger()
+stats = metrics.get_metrics()
+
+# 当前进程正在运行的 Loop, 见 current
+_current = [None]
+
+
+def current():
+    '''返回当前进程正在运行的 Loop, 还没有运行时返回 None.
+    处理函数可以通过它把阻塞的调用交给线程池或进程池:
+        loop.current().run_in_thread(func, *args)
+    '''
+    return _current[0]
 
 
 class Loop(object):
@@ -30,28 +56,91 @@ class Loop(object):
     2. 新建: new
     3. 发送数据: send
     4. 接受数据: receive
+
+    每个 Loop 持有自己的连接表 fd_manager (fd.FdManager)
+    和执行阻塞调用的线程池/进程池 offloader (offload.Offloader)
+
+    连接表以外的 fd (例如连接上游服务的 socket) 可以通过 watch 注册到同一个
+    io 中, 发生事件时回调注册的对象
+
+    定时回调: call_later, call_at, call_every, 微线程中等待: sleep.
+    回调在 Loop 中执行, 不能阻塞; 需要等待的操作请放到新的微线程中
     '''
 
-    def __init__(self, listen_fd, timeout, task_channel):
+    def __init__(self, listen_fd, timeout, task_pool, read_timeout=None,
+                 write_timeout=None, keep_alive_timeout=None,
+                 edge_triggered=False, batch_size=-1, exclusive_accept=False,
+                 high_water_mark=fd.HIGH_WATER_MARK,
+                 low_water_mark=fd.LOW_WATER_MARK,
+                 offload_threads=offload.THREAD_NUM, offload_processes=0):
         '''初始化
 
         参数:
             listen_fd: 监听 socket
-            timeout: 超时时长
-            task_channel: 传递任务的通道
+            timeout: 超时时长 (s)
+            task_pool: 处理任务的微线程池 (tasks.TaskletPool)
+            read_timeout: 等待请求数据的超时时长, None 表示与 timeout 相同
+            write_timeout: 有数据待发送时的超时时长, None 表示与 timeout 相同
+            keep_alive_timeout: 空闲长连接的超时时长, None 表示与 timeout 相同
+            edge_triggered: 是否对连接使用 epoll 的边缘触发模式.
+                            poll 不支持该模式, 会自动退回水平触发.
+            batch_size: 每次 poll 最多处理的事件数, -1 表示不限制 (仅 epoll)
+            exclusive_accept: 使用 EPOLLEXCLUSIVE 注册监听 socket (仅 epoll)
+            high_water_mark: 连接的发送缓冲区超过该字节数后暂停读取,
+                             None 表示不限制
+            low_water_mark: 暂停后发送缓冲区降到该字节数以下恢复读取
+            offload_threads: run_in_thread 使用的线程数
+            offload_processes: run_in_process 使用的进程数,
+                               0 表示与 CPU 核数相同
         '''
         # 传入的参数
         self.timeout = timeout
+        self.read_timeout = timeout if read_timeout is None else read_timeout
+        self.write_timeout = timeout if write_timeout is None \
+            else write_timeout
+        self.keep_alive_timeout = timeout if keep_alive_timeout is None \
+            else keep_alive_timeout
         self.listen_fd = listen_fd
+        # 连接超时使用的时间轮
+        tick = min(TIMER_TICK, self.read_timeout, self.write_timeout,
+                   self.keep_alive_timeout)
+        self.__wheel = timer.TimerWheel(time.time(), tick)
+        # watch 注册的 fd -> 回调对象
+        self.__watchers = {}
+        # call_later 等添加的定时回调
+        self.__timers = timer.TimerHeap()
+        self.call_every(ACCEPT_REPORT_INTERVAL, self.__report)
+        self.batch_size = batch_size
+        self.exclusive_accept = exclusive_accept
+        # 该进程接收的连接数
+        self.accept_count = 0
+        # 优雅退出的截止时间, None 表示没有在退出
+        self.__stop_deadline = None
+        self.__listening = True
+        # 执行阻塞调用的线程池和进程池, 结果通过管道唤醒 Loop
+        self.offloader = offload.Offloader(offload_threads, offload_processes,
+                                           self.__close_inherited)
         #  响应的事件
         self.events = EVENT_READ | EVENT_ERR
         # io 的文件描述子
         self.io_fd = None
         self.__init_io()
+        # 连接关注的事件. 边缘触发模式下一次注册读写事件, 之后不再修改
+        self.edge_triggered = edge_triggered and self.__is_epoll
+        if edge_triggered and not self.edge_triggered:
+            logger.error("edge triggered mode needs epoll, use level mode")
+        if self.edge_triggered:
+            conn_events = self.events | EVENT_WRITE | EVENT_ET
+        else:
+            conn_events = self.events
         # 文件描述子管理器
-        fd_manager.set_io(self.io_fd)
-        # 任务管道
-        self.task_channel = task_channel
+        self.fd_manager = fd.FdManager()
+        self.fd_manager.set_io(self.io_fd, conn_events, self.edge_triggered)
+        self.fd_manager.set_water_marks(high_water_mark, low_water_mark)
+        # 处理任务的微线程池
+        self.task_pool = task_pool
+        # 本轮等待分发的任务: [操作码, fd, 操作码, fd, ...]
+        self.__ready = []
 
     def __init_listen(self, port):
         '''初始化监听 socket
@@ -70,15 +159,118 @@ class Loop(object):
         '''
         try:
             self.io_fd = select.epoll()
+            self.__is_epoll = True
+            self.__poll_scale = 1  # epoll 的超时单位是秒
         except AttributeError:
             self.io_fd = select.poll()
+            self.__is_epoll = False
+            self.__poll_scale = 1000  # poll 的超时单位是毫秒
 
         try:
-            self.io_fd.register(self.listen_fd.fileno(), self.events)
-        except select.error as e:
+            self.__register_listener()
+            self.watch(self.offloader.fileno(), EVENT_READ, self.offloader)
+        except (select.error, IOError) as e:
             logger.critical(str(e))
             self.io_fd = None
 
+    def __register_listener(self):
+        '''注册监听 socket, 内核不支持 EPOLLEXCLUSIVE 时退回普通注册
+        '''
+        listen_fileno = self.listen_fd.fileno()
+        if self.exclusive_accept and self.__is_epoll:
+            try:
+                self.io_fd.register(listen_fileno,
+                                    EVENT_READ | EVENT_EXCLUSIVE)
+                return
+            except IOError as e:
+                logger.error("EPOLLEXCLUSIVE unsupported: {}".format(e))
+        self.io_fd.register(listen_fileno, self.events)
+
+    def watch(self, fileno, events, watcher):
+        '''把连接表以外的 fd 注册到 io 中, 已经注册时修改关注的事件.
+        发生事件时调用 watcher.on_event(events)
+
+        参数:
+            fileno: 文件描述符
+            events: 关注的事件, 例如 EVENT_READ
+            watcher: 回调对象
+        '''
+        if fileno in self.__watchers:
+            self.io_fd.modify(fileno, events)
+        else:
+            self.io_fd.register(fileno, events)
+        self.__watchers[fileno] = watcher
+
+    def unwatch(self, fileno):
+        '''注销 watch 注册的 fd, 不存在时自动忽略
+
+        参数:
+            fileno: 文件描述符
+        '''
+        if self.__watchers.pop(fileno, None) is not None:
+            self.io_fd.unregister(fileno)
+
+    def call_at(self, when, callback, *args):
+        '''在指定时间调用 callback(*args), 返回可以 cancel 的 TimerHandle
+
+        参数:
+            when: 调用的时间 (time.time() 的时间戳)
+            callback: 回调函数
+            args: 回调函数的参数
+        '''
+        return self.__timers.add(when, callback, args)
+
+    def call_later(self, delay, callback, *args):
+        '''delay 秒后调用 callback(*args), 返回可以 cancel 的 TimerHandle
+
+        参数:
+            delay: 延迟 (s)
+            callback: 回调函数
+            args: 回调函数的参数
+        '''
+        return self.__timers.add(time.time() + delay, callback, args)
+
+    def call_every(self, interval, callback, *args):
+        '''每隔 interval 秒调用一次 callback(*args), 第一次在 interval 秒后.
+        返回的 TimerHandle 取消后不再调用
+
+        参数:
+            interval: 间隔 (s)
+            callback: 回调函数
+            args: 回调函数的参数
+        '''
+        if interval <= 0:
+            raise ValueError("interval must be positive: {}".format(interval))
+        return self.__timers.add(time.time() + interval, callback, args,
+                                 interval)
+
+    def sleep(self, seconds):
+        '''挂起当前微线程 seconds 秒, 期间 Loop 继续处理其他连接.
+        只能在处理任务的微线程中调用
+
+        参数:
+            seconds: 时长 (s)
+        '''
+        channel = stackless.channel()
+        self.call_later(seconds, channel.send, None)
+        channel.receive()
+
+    def __run_timers(self, now):
+        '''执行已经到期的定时回调, 回调抛出的异常只记录日志
+
+        参数:
+            now: 当前时间
+        '''
+        for handle in self.__timers.expire(now):
+            # 可能被同一批中之前的回调取消
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.exception("timer callback {!r} failed".format(
+                    handle.callback))
+
     def __event_new(self):
         ''' 创建一个新的 fd, 会进行如下操作:
         1. 接收监听 socket
@@ -92,49 +284,261 @@ class Loop(object):
                 new_socket.setsockopt(socket.SOL_SOCKET,
                                       socket.SO_REUSEADDR, 1)
                 # 添加到 fd 管理
-                fd_manager.new(addr, new_socket, self.events)
-            except socket.error as e:
+                self.fd_manager.new(addr, new_socket)
+                self.__schedule(new_socket.fileno())
+                self.accept_count += 1
+                stats.incr('accepts')
+            except socket.error:
                 break
 
-    def __event_receive(self, fd):
+    def __event_receive(self, fd, fd_info):
+        '''读取数据直到 EAGAIN, 然后交给微线程处理
+
+        参数:
+            fd: 文件描述子
+            fd_info: 对应的 FdInfo
+        '''
         try:
-            fd_manager.receive(fd)
-            self.io_fd.modify(fd, self.events | EVENT_WRITE)
+            closed = fd_info.receive()
         except socket.error as e:
             logger.error(str(e))
-            fd_manager.remove(fd)
+            self.fd_manager.remove(fd)
+            return
 
-        self.task_channel.send(tasks.ReceiveTask(fd))
+        if fd_info.received_size == 0:
+            # 对端已经关闭且没有新数据
+            if closed:
+                self.fd_manager.remove(fd)
+            return
+
+        # 有微线程在等待该连接的数据 (例如流式读取正文), 直接唤醒它
+        if fd_info.wake_receiver():
+            return
+        ready = self.__ready
+        ready.append(tasks.CMD_ONRECEIVE)
+        ready.append(fd)
+
+    def __dispatch(self):
+        '''把积累的任务成批交给微线程池
+        '''
+        ready = self.__ready
+        if ready:
+            self.__ready = []
+            self.task_pool.dispatch(ready)
 
     def __event_send(self, fd):
-        try:
-            fd_manager.send(fd)
-            self.io_fd.modify(fd, self.events)
-        except socket.error as e:
-            logger.error(str(e))
-            fd_manager.remove(fd)
+        '''发送待发送的数据直到 EAGAIN.
+        可写事件的注册, 发送完毕的通知和出错时关闭连接由 fd_manager.send 负责
 
-        self.task_channel.send(tasks.SendTask(fd))
+        参数:
+            fd: 文件描述子
+        '''
+        self.fd_manager.send(fd)
 
     def __event_error(self, fd):
-        fd_manager.remove(fd)
+        '''连接出错或者被挂断, 直接关闭
+
+        参数:
+            fd: 文件描述子
+        '''
+        self.fd_manager.remove(fd)
+
+    def __notify_send(self):
+        '''通知上层数据已经发送完毕的 fd.
+        on_send 中可能再次发送数据, 所以循环直到没有新的 fd
+        '''
+        flushed = self.fd_manager.pop_flushed()
+        while flushed:
+            ready = self.__ready
+            for sock_fd in flushed:
+                if sock_fd in self.fd_manager:
+                    ready.append(tasks.CMD_ONSEND)
+                    ready.append(sock_fd)
+            self.__dispatch()
+            for sock_fd in flushed:
+                self.__schedule(sock_fd)
+            flushed = self.fd_manager.pop_flushed()
+
+    def __resume(self):
+        '''发送缓冲区降到低水位后, 唤醒等待的微线程,
+        并读取暂停期间到达的数据. 边缘触发模式下这些数据不会再产生可读事件
+        '''
+        for sock_fd in self.fd_manager.pop_resumed():
+            fd_info = self.fd_manager.get(sock_fd)
+            if fd_info is None or fd_info.paused:
+                continue
+            fd_info.wake_drain()
+            # 被唤醒的微线程可能已经关闭连接
+            if self.fd_manager.get(sock_fd) is fd_info:
+                self.__event_receive(sock_fd, fd_info)
+        self.__dispatch()
 
-    def __check_timeout(self, fd):
-        '''检查是否超时, 超时的计算是处理完请求的时间与上一次操作的时间的差
-        如果超时则删除该 fd, 如果没超时则更新上一次操作时间为现在
+    def __get_timeout(self, fd_info):
+        '''依据连接的状态选择超时时长
+
+        参数:
+            fd_info: 连接信息
+        '''
+        if fd_info.send_size > 0:
+            return self.write_timeout
+        if fd_info.idle:
+            return self.keep_alive_timeout
+        return self.read_timeout
+
+    def __schedule(self, fd):
+        '''依据上一次操作的时间更新 fd 在时间轮中的截止时间
 
         参数:
             fd:  指定文件描述子
         '''
-        fd_info = fd_manager.get(fd)
+        fd_info = self.fd_manager.get(fd)
         if fd_info is None:
+            self.__wheel.remove(fd)
             return
+        self.__wheel.add(fd, fd_info.timestamp + self.__get_timeout(fd_info))
+
+    def __check_timeout(self, now):
+        '''淘汰到达截止时间的连接, 只处理时间轮中已经到期的 fd.
+        连接的状态可能在加入时间轮后发生变化, 所以到期后会重新计算截止时间.
+
+        参数:
+            now: 当前时间
+        '''
+        for sock_fd in self.__wheel.expire(now):
+            fd_info = self.fd_manager.get(sock_fd)
+            if fd_info is None:  # 已经被删除
+                continue
+            deadline = fd_info.timestamp + self.__get_timeout(fd_info)
+            if deadline <= now:
+                logger.info("{fd} timeout".format(fd=sock_fd))
+                self.fd_manager.remove(sock_fd)
+                stats.incr('timeouts')
+            else:
+                self.__wheel.add(sock_fd, deadline)
+
+    def __poll(self):
+        '''等待 io 事件, 超时时长由时间轮和定时回调中最近的截止时间决定
+        被信号打断时返回空列表
+        '''
         now = time.time()
-        # 超时
-        if now - fd_info.timestamp > self.timeout:
-            fd_manager.remove(fd)
+        timeout = self.__wheel.next_timeout(now)
+        timer_timeout = self.__timers.next_timeout(now)
+        if timer_timeout is not None:
+            timeout = timer_timeout if timeout is None \
+                else min(timeout, timer_timeout)
+        if self.__stop_deadline is not None:
+            timeout = min(timeout, STOP_CHECK_INTERVAL) \
+                if timeout is not None else STOP_CHECK_INTERVAL
+        if timeout is None:
+            timeout = -1
         else:
-            fd_info.timestamp = now
+            # 向上取整到毫秒, 避免在截止时间之前返回后空转
+            timeout = math.ceil(timeout * 1000) / 1000 * self.__poll_scale
+
+        try:
+            if self.__is_epoll:
+                return self.io_fd.poll(timeout, self.batch_size)
+            return self.io_fd.poll(timeout)
+        except (IOError, select.error) as e:
+            # epoll 抛出 IOError, poll 抛出 select.error
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def stop(self, timeout):
+        '''优雅退出: 停止接收新连接, 关闭空闲的长连接,
+        等待其余连接处理完毕后 run 返回, 最多等待 timeout 秒.
+        可以在信号处理函数中调用, 实际操作在主循环中进行.
+
+        参数:
+            timeout: 最长等待时长 (s)
+        '''
+        if self.__stop_deadline is None:
+            self.__stop_deadline = time.time() + timeout
+
+    def __close_inherited(self):
+        '''在进程池的子进程中关闭从 Loop 继承的 socket, 管道和 epoll,
+        否则 Loop 关闭连接后对端仍然收不到 FIN
+        '''
+        fds = self.fd_manager.keys()
+        fds.extend(self.__watchers)
+        fds.append(self.io_fd.fileno())
+        if self.__listening:
+            fds.append(self.listen_fd.fileno())
+        for fileno in fds:
+            try:
+                os.close(fileno)
+            except OSError:
+                pass
+
+    def run_in_thread(self, func, *args, **kargs):
+        '''在线程池中调用阻塞的函数, 当前微线程挂起直到返回, 不会阻塞 Loop.
+        只能在处理任务的微线程中调用, 返回 func 的返回值, 异常会重新抛出
+
+        参数:
+            func: 调用的函数
+            args: 位置参数
+            kargs: 关键字参数
+        '''
+        return self.offloader.run_in_thread(func, *args, **kargs)
+
+    def run_in_process(self, func, *args, **kargs):
+        '''在进程池中调用占用 CPU 的函数, 其余同 run_in_thread.
+        func 需要是模块级的函数, 参数和返回值都需要能被 pickle
+
+        参数:
+            func: 调用的函数
+            args: 位置参数
+            kargs: 关键字参数
+        '''
+        return self.offloader.run_in_process(func, *args, **kargs)
+
+    def __stop_listen(self):
+        '''注销并关闭监听 socket, 新连接交给其他进程处理
+        '''
+        self.__listening = False
+        try:
+            self.io_fd.unregister(self.listen_fd.fileno())
+            self.listen_fd.close()
+        except Exception as e:
+            logger.error(str(e))
+        logger.info("pid {} stop listening, {} connections left".format(
+            os.getpid(), len(self.fd_manager)))
+
+    def __drained(self, now):
+        '''优雅退出时关闭空闲的连接, 返回是否可以结束主循环
+
+        参数:
+            now: 当前时间
+        '''
+        if self.__listening:
+            self.__stop_listen()
+
+        for sock_fd, fd_info in self.fd_manager.items():
+            if fd_info.idle and fd_info.send_size == 0:
+                self.fd_manager.remove(sock_fd)
+
+        if len(self.fd_manager) == 0:
+            return True
+        if now >= self.__stop_deadline:
+            logger.error("pid {} force close {} connections".format(
+                os.getpid(), len(self.fd_manager)))
+            for sock_fd in self.fd_manager.keys():
+                self.fd_manager.remove(sock_fd)
+            return True
+        return False
+
+    @property
+    def stopping(self):
+        '''是否正在优雅退出
+        '''
+        return self.__stop_deadline is not None
+
+    def __report(self):
+        '''定期输出该进程接收的连接数, 用来观察各个进程之间的负载是否均衡
+        '''
+        logger.info("pid {} accepted {} connections, {} active".format(
+            os.getpid(), self.accept_count, len(self.fd_manager)))
 
     def run(self):
         '''io 的主循环, 会依据事件进行对应操作
@@ -142,21 +546,56 @@ class Loop(object):
         if self.io_fd is None:
             self.__init_io()
 
+        _current[0] = self
+        listen_fileno = self.listen_fd.fileno()
+        fd_manager = self.fd_manager
+        watchers = self.__watchers
         while 1:
             # 等待 io 抛出事件
-            io_list = self.io_fd.poll()
+            io_list = self.__poll()
 
-            for fd, events in io_list:
-                if fd == self.listen_fd.fileno():  # 新建
+            for sock_fd, events in io_list:
+                if sock_fd == listen_fileno and self.__listening:  # 新建
                     self.__event_new()
-                elif events & EVENT_READ:  # 读操作
-                    self.__event_receive(fd)
-                elif events & EVENT_WRITE:  # 写操作
-                    self.__event_send(fd)
+                    continue
+
+                fd_info = fd_manager.get(sock_fd)
+                if fd_info is None:
+                    # watch 注册的 fd, 例如线程池的唤醒管道和上游连接
+                    watcher = watchers.get(sock_fd)
+                    if watcher is not None:
+                        watcher.on_event(events)
+                    continue
+                if events & EVENT_READ:  # 读操作
+                    # 暂停读取的连接留到发送缓冲区降到低水位后再读
+                    if not fd_info.paused:
+                        self.__event_receive(sock_fd, fd_info)
                 elif events & EVENT_ERR:  # 错误
-                    self.__event_error(fd)
-                else:  # 其他情况,  暂不考虑
+                    self.__event_error(sock_fd)
                     continue
+                # 边缘触发模式下读写事件可能同时出现
+                if events & EVENT_WRITE and fd_info.wait_write and \
+                        fd_manager.get(sock_fd) is fd_info:  # 写操作
+                    self.__event_send(sock_fd)
+
+                # 更新截止时间
+                self.__schedule(sock_fd)
+
+            # 到期的定时回调
+            self.__run_timers(time.time())
+            # 本轮可读的连接成批交给微线程处理
+            self.__dispatch()
+            # 通知发送完毕
+            self.__notify_send()
+            # 恢复读取发送缓冲区已经降到低水位的连接
+            self.__resume()
+            # 检测超时
+            now = time.time()
+            self.__check_timeout(now)
+            self.task_pool.maintain(now)
 
-                # 检测超时
-                self.__check_timeout(fd)
+            # 优雅退出
+            if self.__stop_deadline is not None and self.__drained(now):
+                self.offloader.close()
+                logger.info("pid {} loop exited".format(os.getpid()))
+                return
@@ -0,0 +1,329 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+多进程模式下的主进程 (master).
+
+master 只负责管理 worker, 自己不处理连接:
+    1. 启动 N 个 worker, 可选绑定到不同的 CPU
+    2. 回收退出的 worker 并重新启动, 短时间内反复退出的 worker 延迟重启
+    3. SIGTERM/SIGINT: 通知所有 worker 处理完已有连接后退出
+    4. SIGHUP: 逐个替换 worker (先启动新的再停止旧的), 监听 socket 始终保持打开
+    5. SIGUSR1: 把所有 worker 汇总的统计数据写入日志
+'''
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import signal
+import time
+
+from . import log
+from . import metrics
+
+
+logger = log.get_logger()
+
+# master 每轮检查 worker 状态的间隔 (s)
+CHECK_INTERVAL = 1.0
+# 回收 worker 时轮询的间隔 (s)
+WAIT_INTERVAL = 0.1
+# 统计 worker 意外退出次数的时间窗口 (s)
+CRASH_WINDOW = 60.0
+# 窗口内第二次退出起延迟重启, 延迟从 RESPAWN_DELAY 开始每次翻倍,
+# 最长 MAX_RESPAWN_DELAY (s)
+RESPAWN_DELAY = 1.0
+MAX_RESPAWN_DELAY = 60.0
+
+
+def set_cpu_affinity(cpu):
+    '''把当前进程绑定到指定 CPU 上.
+    Python 2 没有 os.sched_setaffinity, 使用 ctypes 调用 libc.
+
+    参数:
+        cpu: CPU 编号
+    '''
+    setaffinity = getattr(os, 'sched_setaffinity', None)
+    if setaffinity is not None:
+        setaffinity(0, [cpu])
+        return
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    mask = (ctypes.c_ulong * (cpu // 64 + 1))()
+    mask[cpu // 64] = 1 << (cpu % 64)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def describe_status(status):
+    '''把 waitpid 返回的状态转换成可读的退出原因
+
+    参数:
+        status: waitpid 返回的退出状态
+    '''
+    if os.WIFSIGNALED(status):
+        return "killed by signal {}".format(os.WTERMSIG(status))
+    return "exit code {}".format(os.WEXITSTATUS(status))
+
+
+class Master(object):
+    '''master 进程, 管理多个 worker
+    '''
+
+    def __init__(self, worker_func, process_num, cpu_affinity=False,
+                 graceful_timeout=30):
+        '''初始化
+
+        参数:
+            worker_func: worker 进程的入口函数, 参数为 worker 的编号,
+                         函数返回后 worker 进程退出
+            process_num: worker 个数
+            cpu_affinity: 是否把第 i 个 worker 绑定到第 i 个 CPU 上
+            graceful_timeout: 等待 worker 优雅退出的时长 (s), 超时后强制结束
+        '''
+        self.worker_func = worker_func
+        self.process_num = process_num
+        self.cpu_affinity = cpu_affinity
+        self.graceful_timeout = graceful_timeout
+        # 编号 -> pid
+        self.workers = {}
+        # 正在退出的旧 worker, pid -> 编号
+        self.__retired = {}
+        # 统计数据段的分配, pid -> 数据段编号, 见 metrics.py
+        self.__slots = {}
+        # 编号 -> 最近意外退出的时间, 用于发现反复崩溃的 worker
+        self.__deaths = collections.defaultdict(collections.deque)
+        # 等待延迟重启的 worker, 编号 -> 重启时间
+        self.__pending = {}
+        self.__stopping = False
+        self.__reloading = False
+        self.__dumping = False
+
+    def __take_slot(self, index):
+        '''为新 worker 选择一个没有进程在写入的统计数据段,
+        优先使用与编号对应的数据段
+
+        参数:
+            index: worker 编号
+        '''
+        busy = set(self.__slots.values())
+        slot_num = metrics.get_metrics().slot_num
+        for slot in range(index, slot_num, self.process_num):
+            if slot not in busy:
+                return slot
+        for slot in range(slot_num):
+            if slot not in busy:
+                return slot
+        # 退出的 worker 还没有被回收, 只能共用
+        logger.error("no free metrics slot for worker {}".format(index))
+        return index % slot_num
+
+    def __spawn(self, index):
+        '''启动一个 worker
+
+        参数:
+            index: worker 编号
+        '''
+        slot = self.__take_slot(index)
+        pid = os.fork()
+        if pid > 0:
+            self.workers[index] = pid
+            self.__slots[pid] = slot
+            logger.info("worker {} started, pid={}".format(index, pid))
+            return pid
+
+        # worker 进程, 恢复默认的信号处理, 由 worker 自己决定
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        # 终端挂断时由 master 决定如何处理
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        # 日志的写线程没有被 fork 过来
+        log.after_fork(index)
+        # 写入 master 分配的统计数据段
+        metrics.get_metrics().select(slot)
+        code = 0
+        try:
+            if self.cpu_affinity:
+                cpu = index % os.sysconf('SC_NPROCESSORS_ONLN')
+                try:
+                    set_cpu_affinity(cpu)
+                except OSError as e:
+                    logger.error("set cpu affinity failed: {}".format(e))
+            self.worker_func(index)
+        except BaseException as e:
+            logger.critical("worker {} exited: {}".format(index, e))
+            code = 1
+        # os._exit 不会执行 atexit, 需要自己写完剩余的日志
+        log.shutdown()
+        # 不返回到 master 的代码中
+        os._exit(code)
+
+    def __on_stop(self, signum, frame):
+        self.__stopping = True
+
+    def __on_reload(self, signum, frame):
+        self.__reloading = True
+
+    def __on_dump(self, signum, frame):
+        self.__dumping = True
+
+    def __on_child(self, signum, frame):
+        # 只用来打断 sleep, 回收在主循环中进行
+        pass
+
+    def __reap(self):
+        '''回收所有已经退出的 worker, 意外退出的 worker 会被重新启动
+        '''
+        while 1:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+            # 进程已经退出, 它的数据段可以分配给新的 worker
+            slot = self.__slots.pop(pid, None)
+            if slot is not None:
+                metrics.get_metrics().release(slot)
+
+            if pid in self.__retired:
+                del self.__retired[pid]
+                continue
+
+            for index, worker_pid in self.workers.items():
+                if worker_pid != pid:
+                    continue
+                del self.workers[index]
+                if self.__stopping:
+                    break
+                logger.error("worker {} (pid={}) died, {}".format(
+                    index, pid, describe_status(status)))
+                self.__respawn(index)
+                break
+
+    def __respawn(self, index):
+        '''重新启动意外退出的 worker. CRASH_WINDOW 内第一次退出时立即重启,
+        之后每次退出的重启延迟翻倍, 避免启动即崩溃的 worker 占满 CPU
+
+        参数:
+            index: worker 编号
+        '''
+        now = time.time()
+        deaths = self.__deaths[index]
+        deaths.append(now)
+        while deaths[0] < now - CRASH_WINDOW:
+            deaths.popleft()
+        if len(deaths) == 1:
+            self.__spawn(index)
+            return
+
+        delay = min(RESPAWN_DELAY * 2 ** (len(deaths) - 2), MAX_RESPAWN_DELAY)
+        logger.error("worker {} died {} times in {:.0f}s, "
+                     "restart in {:.1f}s".format(
+                         index, len(deaths), CRASH_WINDOW, delay))
+        self.__pending[index] = now + delay
+
+    def __spawn_pending(self):
+        '''启动已经到达重启时间的 worker, 返回距下一次重启的时长 (s),
+        没有等待重启的 worker 时返回 None
+        '''
+        now = time.time()
+        for index, when in list(self.__pending.items()):
+            if when <= now:
+                del self.__pending[index]
+                self.__spawn(index)
+        if not self.__pending:
+            return None
+        return max(min(self.__pending.values()) - now, 0)
+
+    def __wait(self, pids, timeout):
+        '''等待指定的 worker 退出, 超时后强制结束
+
+        参数:
+            pids: 需要等待的 pid 集合
+            timeout: 等待时长 (s)
+        '''
+        deadline = time.time() + timeout
+        while 1:
+            self.__reap()
+            alive = [pid for pid in pids
+                     if pid in self.__retired or pid in self.workers.values()]
+            if not alive:
+                return
+            if time.time() >= deadline:
+                break
+            time.sleep(WAIT_INTERVAL)
+
+        for pid in alive:
+            logger.error("worker pid={} killed".format(pid))
+            self.__kill(pid, signal.SIGKILL)
+        time.sleep(WAIT_INTERVAL)
+        self.__reap()
+
+    def __kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def __reload(self):
+        '''逐个替换 worker: 先启动新的, 再让旧的处理完已有连接后退出.
+        任何时刻都有 process_num 个 worker 在接收新连接.
+        '''
+        logger.info("rolling restart {} workers".format(len(self.workers)))
+        for index in sorted(self.workers):
+            if self.__stopping:
+                return
+            old_pid = self.workers[index]
+            self.__retired[old_pid] = index
+            self.__spawn(index)
+            self.__kill(old_pid, signal.SIGTERM)
+            self.__wait([old_pid], self.graceful_timeout)
+        logger.info("rolling restart finished")
+
+    def __stop(self):
+        '''通知所有 worker 优雅退出并等待
+        '''
+        logger.info("stopping {} workers".format(len(self.workers)))
+        pids = list(self.workers.values()) + list(self.__retired)
+        for pid in pids:
+            self.__kill(pid, signal.SIGTERM)
+        self.__wait(pids, self.graceful_timeout)
+        logger.info("master exited")
+
+    def run(self):
+        '''master 的主循环, 直到收到 SIGTERM/SIGINT 并且所有 worker 退出
+        '''
+        signal.signal(signal.SIGTERM, self.__on_stop)
+        signal.signal(signal.SIGINT, self.__on_stop)
+        signal.signal(signal.SIGHUP, self.__on_reload)
+        signal.signal(signal.SIGUSR1, self.__on_dump)
+        signal.signal(signal.SIGCHLD, self.__on_child)
+
+        for index in range(self.process_num):
+            self.__spawn(index)
+        logger.info("{} processes started".format(self.process_num))
+
+        while not self.__stopping:
+            self.__reap()
+            wait = self.__spawn_pending()
+            if self.__dumping:
+                self.__dumping = False
+                logger.info("metrics:\n" + metrics.get_metrics().dump())
+            if self.__reloading:
+                self.__reloading = False
+                self.__reload()
+                continue
+            if wait is None or wait > CHECK_INTERVAL:
+                wait = CHECK_INTERVAL
+            time.sleep(wait)
+
+        self.__stop()
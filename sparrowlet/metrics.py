@@ -0,0 +1,222 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+跨进程的运行统计.
+
+计数器保存在 fork 之前创建的共享内存 (匿名 mmap) 中, 每个 worker 有自己的一段,
+只有该 worker 会写入, 所以不需要加锁. 数据段由 master 分配, 个数是 worker 的两倍:
+滚动重启时旧 worker 还在处理已有连接, 新 worker 使用另一个空闲的数据段,
+旧 worker 被回收之后它的数据段才会再分配出去. 任何进程都可以读取所有 worker 的数据并汇总,
+例如 master 收到 SIGUSR1 时, 或者 HttpServer 的统计页面.
+'''
+import bisect
+import ctypes
+import mmap
+
+from . import compat
+from . import uri_interface
+
+
+# 计数器
+COUNTERS = (
+    'accepts',  # 接收的连接数
+    'connections',  # 当前的连接数
+    'bytes_in',  # 接收的字节数
+    'bytes_out',  # 发送的字节数
+    'timeouts',  # 超时关闭的连接数
+    'read_pauses',  # 发送缓冲区超过高水位而暂停读取的次数
+    'messages',  # 设置了 codec 的 TcpServer 解码出的消息数
+    'upstream_connects',  # 新建的上游连接数, 见 client.py
+    'upstream_reuses',  # 复用连接池中空闲连接的次数
+    'cache_hits',  # 响应缓存的命中次数, 见 cache.py
+    'cache_misses',  # 响应缓存未命中并生成响应的次数
+    'cache_evictions',  # 响应缓存超过大小后淘汰的响应数
+)
+# 单独统计的 HTTP 状态码, 其余的计入 other
+STATUS_CODES = (200, 204, 206, 301, 302, 304, 400, 401, 403, 404, 405, 408,
+                413, 416, 429, 500, 502, 503, 504)
+# 耗时分布
+HISTOGRAMS = (
+    'parse',  # 解析出一个完整请求的耗时
+    'handler',  # 处理函数的耗时
+    'send',  # 数据放入发送缓冲区到全部发送完毕的耗时
+)
+# 每个 worker 对应的数据段个数, 见模块说明
+SLOTS_PER_WORKER = 2
+# 耗时分布的区间上限 (s), 最后还有一个无上限的区间
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def _layout():
+    '''计算每个值在一个 worker 的数据段中的下标
+    '''
+    names = list(COUNTERS)
+    names.extend('status_{}'.format(code) for code in STATUS_CODES)
+    names.append('status_other')
+    for name in HISTOGRAMS:
+        names.extend('{}_bucket_{}'.format(name, i)
+                     for i in compat.xrange(len(BUCKETS) + 1))
+        # 总耗时以微秒为单位保存
+        names.extend(('{}_count'.format(name), '{}_sum'.format(name)))
+    return dict((name, i) for i, name in enumerate(names)), len(names)
+
+
+INDEX, SLOT_LENGTH = _layout()
+Slot = ctypes.c_int64 * SLOT_LENGTH
+# 热点路径上使用的下标, 避免每次拼接名称
+STATUS_INDEX = dict((code, INDEX['status_{}'.format(code)])
+                    for code in STATUS_CODES)
+# 名称 -> (第一个区间, 次数, 总耗时) 的下标
+HISTOGRAM_INDEX = dict((name, (INDEX[name + '_bucket_0'],
+                               INDEX[name + '_count'],
+                               INDEX[name + '_sum']))
+                       for name in HISTOGRAMS)
+
+
+class Metrics(object):
+    '''保存在共享内存中的统计数据
+
+    使用方法:
+        stats = metrics.get_metrics()
+        stats.incr('accepts')
+        stats.observe('handler', 0.002)
+        print(stats.dump())
+    '''
+
+    def __init__(self):
+        self.__mmap = None
+        self.__slots = []
+        self.worker_num = 0
+        # 当前进程写入的数据段
+        self.slot = None
+        self.init(1)
+
+    def init(self, worker_num):
+        '''重新分配共享内存, 需要在 fork 之前调用, 之前的数据会被清空.
+        单进程时只需要一个数据段
+
+        参数:
+            worker_num: worker 个数
+        '''
+        self.worker_num = worker_num
+        slot_num = worker_num * SLOTS_PER_WORKER if worker_num > 1 else 1
+        # 旧的 mmap 可能还被数据段引用, 不主动关闭
+        size = ctypes.sizeof(Slot)
+        # 匿名 mmap 默认是 MAP_SHARED, fork 出的子进程共享同一块内存
+        self.__mmap = mmap.mmap(-1, size * slot_num)
+        self.__slots = [Slot.from_buffer(self.__mmap, i * size)
+                        for i in compat.xrange(slot_num)]
+        self.slot = self.__slots[0]
+
+    @property
+    def slot_num(self):
+        '''数据段的个数
+        '''
+        return len(self.__slots)
+
+    def select(self, index):
+        '''worker 启动时选择 master 分配给它的数据段.
+        数据段会继承之前的 worker 的计数, 但当前连接数清零
+
+        参数:
+            index: 数据段编号
+        '''
+        self.slot = self.__slots[index]
+        self.slot[INDEX['connections']] = 0
+
+    def release(self, index):
+        '''数据段的 worker 已经退出, 由 master 清零它的当前连接数.
+        累计的计数保留, 汇总的总数不会因为 worker 退出而减少
+
+        参数:
+            index: 数据段编号
+        '''
+        self.__slots[index][INDEX['connections']] = 0
+
+    def incr(self, name, value=1):
+        '''增加计数
+
+        参数:
+            name: 计数器名称
+            value: 增加的值
+        '''
+        self.slot[INDEX[name]] += value
+
+    def count_status(self, code):
+        '''按 HTTP 状态码计数
+
+        参数:
+            code: 状态码
+        '''
+        index = STATUS_INDEX.get(code)
+        if index is None:
+            index = INDEX['status_other']
+        self.slot[index] += 1
+
+    def observe(self, name, seconds):
+        '''记录一次耗时
+
+        参数:
+            name: 耗时分布的名称
+            seconds: 耗时 (s)
+        '''
+        slot = self.slot
+        bucket_index, count_index, sum_index = HISTOGRAM_INDEX[name]
+        slot[bucket_index + bisect.bisect_left(BUCKETS, seconds)] += 1
+        slot[count_index] += 1
+        slot[sum_index] += int(seconds * 1000000)
+
+    def snapshot(self):
+        '''汇总所有 worker 的数据, 返回 名称 -> 值 的字典.
+        读取时 worker 可能正在写入, 各个值之间不保证是同一时刻的
+        '''
+        total = [0] * SLOT_LENGTH
+        for slot in self.__slots:
+            for i, value in enumerate(slot):
+                total[i] += value
+        return dict((name, total[i]) for name, i in compat.iteritems(INDEX))
+
+    def dump(self):
+        '''汇总数据的文本格式 (与 Prometheus 的文本格式兼容)
+        '''
+        data = self.snapshot()
+        lines = ['sparrowlet_workers {}'.format(self.worker_num)]
+        for name in COUNTERS:
+            suffix = '' if name == 'connections' else '_total'
+            lines.append('sparrowlet_{}{} {}'.format(name, suffix, data[name]))
+        for code in STATUS_CODES + ('other', ):
+            lines.append('sparrowlet_requests_total{{code="{}"}} {}'.format(
+                code, data['status_{}'.format(code)]))
+
+        for name in HISTOGRAMS:
+            prefix = 'sparrowlet_{}_seconds'.format(name)
+            cumulative = 0
+            for i, bound in enumerate(BUCKETS + ('+Inf', )):
+                cumulative += data['{}_bucket_{}'.format(name, i)]
+                lines.append('{}_bucket{{le="{}"}} {}'.format(
+                    prefix, bound, cumulative))
+            lines.append('{}_sum {:.6f}'.format(
+                prefix, data[name + '_sum'] / 1000000.0))
+            lines.append('{}_count {}'.format(prefix, data[name + '_count']))
+        return '\n'.join(lines) + '\n'
+
+
+_metrics = None
+
+
+def get_metrics():
+    '''返回进程内唯一的 Metrics 对象
+    '''
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+class StatsHandler(uri_interface.UriInterface):
+    '''以文本格式返回统计数据, 通过 HttpServer 的 stats_path 参数开启
+    '''
+
+    def get(self):
+        self.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return get_metrics().dump()
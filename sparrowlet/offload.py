@@ -0,0 +1,264 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+把阻塞或者占用 CPU 的调用交给线程池或进程池执行.
+
+调用的微线程在通道上等待结果, 不会阻塞 Loop. 线程池和进程池在完成后
+把结果放进队列, 再往管道写入一个字节; 管道的读端注册在 Loop 的 epoll 中,
+Loop 收到可读事件后把结果交还给等待的微线程.
+
+进程池的参数和返回值由这里 pickle, 进程池只传递 bytes 和能 pickle 的异常:
+Python 2 的 apply_async 在 pickle 失败时不会调用回调, 等待的微线程会一直挂起;
+Python 3 的 ProcessPoolExecutor 收到不能还原的异常后整个进程池都不能再使用.
+'''
+import os
+import sys
+import fcntl
+import errno
+import threading
+import collections
+import multiprocessing
+
+from . import compat
+from . import log
+from .compat import pickle, queue, stackless
+
+# 线程池的默认线程数
+THREAD_NUM = 4
+
+logger = log.get_logger()
+
+
+def _set_nonblocking(fileno):
+    '''把文件描述符设置为非阻塞
+
+    参数:
+        fileno: 文件描述符
+    '''
+    flags = fcntl.fcntl(fileno, fcntl.F_GETFL)
+    fcntl.fcntl(fileno, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class OffloadError(Exception):
+    '''进程池中的调用失败, 并且原来的异常不能 pickle
+    '''
+    pass
+
+
+def _picklable(error):
+    '''返回能够传回父进程的异常, 不能 pickle 时转换为 OffloadError
+
+    参数:
+        error: 子进程中的异常
+    '''
+    try:
+        pickle.loads(pickle.dumps(error, pickle.HIGHEST_PROTOCOL))
+        return error
+    except Exception:
+        return OffloadError("{}: {}".format(type(error).__name__, error))
+
+
+def pack_call(func, args, kargs):
+    '''在父进程中 pickle 调用, 不能 pickle 时直接抛出异常
+
+    参数:
+        func: 模块级的函数
+        args: 位置参数
+        kargs: 关键字参数
+    '''
+    return pickle.dumps((func, args, kargs), pickle.HIGHEST_PROTOCOL)
+
+
+def call_packed(payload):
+    '''在子进程中调用 pack_call 的结果, 返回值也在这里 pickle.
+    Python 2 的 apply_async 没有出错的回调, 所以异常也作为结果返回:
+    (True, pickle 后的返回值) 或者 (False, 异常)
+
+    参数:
+        payload: pickle 后的 (func, args, kargs)
+    '''
+    try:
+        func, args, kargs = pickle.loads(payload)
+        return True, pickle.dumps(func(*args, **kargs),
+                                  pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return False, _picklable(e)
+
+
+def unpack_result(result):
+    '''在父进程中还原 call_packed 的结果, 调用失败时抛出子进程中的异常
+
+    参数:
+        result: call_packed 的返回值
+    '''
+    ok, value = result
+    if ok:
+        return pickle.loads(value)
+    raise value
+
+
+class Offloader(object):
+    '''Loop 使用的线程池和进程池, 第一次使用时才会创建
+
+    使用方法:
+        offloader = Offloader(4, 0)
+        loop.watch(offloader.fileno(), EVENT_READ, offloader)
+        # 在微线程中
+        result = offloader.run_in_thread(func, *args)
+        # 管道可读时 Loop 调用 offloader.on_event(events)
+    '''
+
+    def __init__(self, thread_num=THREAD_NUM, process_num=0,
+                 initializer=None):
+        '''初始化
+
+        参数:
+            thread_num: 线程池的线程数
+            process_num: 进程池的进程数, 0 表示与 CPU 核数相同
+            initializer: 进程池的子进程启动时调用的函数.
+                         进程池在使用时才 fork, 可以用它关闭继承的 socket
+        '''
+        self.thread_num = max(thread_num, 1)
+        self.process_num = process_num or multiprocessing.cpu_count()
+        self.initializer = initializer
+        # 唤醒 Loop 的管道
+        self.__read_fd, self.__write_fd = os.pipe()
+        _set_nonblocking(self.__read_fd)
+        _set_nonblocking(self.__write_fd)
+        # 已经完成的调用: (通道, (是否成功, 返回值或异常信息))
+        self.__done = collections.deque()
+        self.__jobs = queue.Queue()
+        self.__threads = []
+        self.__process_pool = None
+        # 正在等待结果的调用数
+        self.pending = 0
+
+    def fileno(self):
+        '''需要注册到 Loop 的管道读端
+        '''
+        return self.__read_fd
+
+    def __complete(self, channel, result):
+        '''在线程池或者进程池的回调线程中保存结果, 并唤醒 Loop
+
+        参数:
+            channel: 等待结果的通道
+            result: (是否成功, 返回值或异常信息)
+        '''
+        self.__done.append((channel, result))
+        try:
+            os.write(self.__write_fd, '\0')
+        except OSError as e:
+            # 管道已满时 Loop 一定会被唤醒, 不需要再写
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def __work(self):
+        '''工作线程的主循环
+        '''
+        jobs = self.__jobs
+        while 1:
+            job = jobs.get()
+            if job is None:
+                return
+            channel, func, args, kargs = job
+            try:
+                result = True, func(*args, **kargs)
+            except Exception:
+                result = False, sys.exc_info()
+            self.__complete(channel, result)
+
+    def __wait(self, channel):
+        '''挂起当前微线程直到结果返回, 出错时在当前微线程中重新抛出异常
+
+        参数:
+            channel: 等待结果的通道
+        '''
+        self.pending += 1
+        try:
+            ok, value = channel.receive()
+        finally:
+            self.pending -= 1
+        if ok:
+            return value
+        if isinstance(value, tuple):
+            # 线程中的异常, 保留原来的 traceback
+            compat.reraise(*value)
+        raise value
+
+    def run_in_thread(self, func, *args, **kargs):
+        '''在线程池中调用 func(*args, **kargs), 适合阻塞的 IO 操作.
+        只能在微线程中调用, 返回 func 的返回值
+
+        参数:
+            func: 调用的函数
+            args: 位置参数
+            kargs: 关键字参数
+        '''
+        if len(self.__threads) < self.thread_num:
+            thread = threading.Thread(target=self.__work)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+        channel = stackless.channel()
+        self.__jobs.put((channel, func, args, kargs))
+        return self.__wait(channel)
+
+    def run_in_process(self, func, *args, **kargs):
+        '''在进程池中调用 func(*args, **kargs), 适合占用 CPU 的计算.
+        func, 参数和返回值都需要能被 pickle. 只能在微线程中调用.
+        参数不能 pickle 时直接抛出异常, 返回值不能 pickle 时抛出 OffloadError
+
+        参数:
+            func: 模块级的函数
+            args: 位置参数
+            kargs: 关键字参数
+        '''
+        if self.__process_pool is None:
+            self.__process_pool = multiprocessing.Pool(self.process_num,
+                                                       self.initializer)
+            logger.info("pid {} process pool started, {} processes".format(
+                os.getpid(), self.process_num))
+        payload = pack_call(func, args, kargs)
+        channel = stackless.channel()
+        options = {}
+        if not compat.PY2:
+            # 子进程意外退出等进程池自己的错误
+            options['error_callback'] = \
+                lambda e: self.__complete(channel, (False, e))
+        self.__process_pool.apply_async(
+            call_packed, (payload, ),
+            callback=lambda result: self.__complete(channel, result),
+            **options)
+        return pickle.loads(self.__wait(channel))
+
+    def on_event(self, events):
+        '''管道可读时由 Loop 调用, 把结果交还给等待的微线程
+
+        参数:
+            events: io 事件
+        '''
+        while 1:
+            try:
+                if not os.read(self.__read_fd, 4096):
+                    break
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+        done = self.__done
+        while done:
+            channel, result = done.popleft()
+            channel.send(result)
+
+    def close(self):
+        '''停止线程池和进程池, 关闭管道
+        '''
+        for thread in self.__threads:
+            self.__jobs.put(None)
+        self.__threads = []
+        if self.__process_pool is not None:
+            self.__process_pool.terminate()
+            self.__process_pool = None
+        os.close(self.__read_fd)
+        os.close(self.__write_fd)
@@ -0,0 +1,195 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+HTTP 响应头的序列化.
+
+不变的部分 (状态行, 默认头, Connection) 预先序列化并缓存,
+每个响应只需要拼接 Content-Length, Date 和处理类设置的头.
+
+处理函数返回生成器, 迭代器或文件对象时, 正文使用 chunked 编码流式发送.
+'''
+import email.utils
+import time
+
+from . import buff
+from . import compat
+from .compat import text_type
+
+# 从文件对象中每次读取的大小
+STREAM_READ_SIZE = 64 * 1024
+# 没有 Content-Length 的状态码
+NO_BODY_STATUS = frozenset((204, 304))
+
+# 由服务器决定的头, 处理类设置的同名头会被忽略
+RESERVED_HEADERS = frozenset(('Connection', 'Content-Length'))
+
+CONNECTION_LINES = {
+    True: 'Connection: keep-alive\r\n',
+    False: 'Connection: close\r\n',
+}
+
+# 状态 (整数或者 "200 OK" 形式的字符串) -> (状态码, 状态行)
+_status_lines = {}
+# [秒, Date 头]
+_date = [0, '']
+
+
+def is_stream(content):
+    '''判断处理函数的返回值是否需要流式发送:
+    生成器, 迭代器, 列表等可迭代对象, 或者有 read 方法的文件对象
+
+    参数:
+        content: 处理函数的返回值
+    '''
+    if isinstance(content, (bytes, text_type, memoryview, bytearray,
+                            buff.FileBody)):
+        return False
+    return hasattr(content, 'read') or hasattr(content, '__iter__')
+
+
+def iter_chunks(content):
+    '''依次返回流式正文的每个分片, unicode 编码为 utf-8, 跳过空分片.
+    结束或者被关闭时关闭 content
+
+    参数:
+        content: 可迭代对象或者文件对象
+    '''
+    if hasattr(content, 'read'):
+        chunks = iter(lambda: content.read(STREAM_READ_SIZE), b'')
+    else:
+        chunks = iter(content)
+    try:
+        for data in chunks:
+            if isinstance(data, text_type):
+                data = data.encode('utf-8')
+            if data:
+                yield data
+    finally:
+        close = getattr(content, 'close', None)
+        if close is not None:
+            close()
+
+
+def chunk_encode(content):
+    '''使用 chunked 编码的流式正文, 每个分片的长度行和分片本身分开返回,
+    不复制分片的数据
+
+    参数:
+        content: 可迭代对象或者文件对象
+    '''
+    chunks = iter_chunks(content)
+    try:
+        for data in chunks:
+            yield compat.to_wire('{:x}\r\n'.format(len(data)))
+            yield data
+            yield b'\r\n'
+    finally:
+        chunks.close()
+    yield b'0\r\n\r\n'
+
+
+def status_line(status, version='HTTP/1.1'):
+    '''返回 (状态码, 状态行), 结果会被缓存
+
+    参数:
+        status: 整数状态码, 例如 404, 或者完整的状态, 例如 "404 Not Found"
+        version: HTTP 版本
+    '''
+    line = _status_lines.get(status)
+    if line is None:
+        if isinstance(status, compat.integer_types):
+            code = status
+            status_text = '{} {}'.format(
+                code, compat.http_client.responses.get(code, ''))
+        else:
+            code = int(status[:3])
+            status_text = status
+        line = _status_lines[status] = (
+            code, '{} {}\r\n'.format(version, status_text.strip()))
+    return line
+
+
+def date_line():
+    '''返回当前时间的 Date 头, 每秒最多生成一次
+    '''
+    now = int(time.time())
+    if now != _date[0]:
+        _date[0] = now
+        _date[1] = 'Date: {}\r\n'.format(
+            email.utils.formatdate(now, usegmt=True))
+    return _date[1]
+
+
+class ResponseBuilder(object):
+    '''序列化响应头, 默认头只在创建时序列化一次
+
+    使用方法:
+        builder = ResponseBuilder({'Content-Type': 'text/html;charset=utf-8'})
+        head, body = builder.build('hello', 200, {'X-Id': '1'})
+    '''
+
+    def __init__(self, default_headers):
+        '''初始化
+
+        参数:
+            default_headers: 每个响应都带有的头信息
+        '''
+        self.__default_items = [(name, '{}: {}\r\n'.format(name, value))
+                                for name, value in default_headers.items()]
+        self.__default_block = ''.join(x[1] for x in self.__default_items)
+
+    def build(self, content, status=200, headers=None, keep_alive=True,
+              chunked=True):
+        '''生成响应, 返回 [头, 正文] 两个分片
+
+        参数:
+            content: 正文, 可以是字符串, unicode, memoryview, FileBody 或 None,
+                     也可以是生成分片的迭代器或者文件对象 (见 is_stream)
+            status: 整数状态码, 或者 "200 OK" 形式的字符串
+            headers: 追加或者覆盖默认头的字典, 可以为 None
+            keep_alive: 是否保持连接
+            chunked: 客户端是否支持 chunked 编码 (HTTP/1.1).
+                     不支持时流式的正文会先全部读入内存
+        '''
+        length = None
+        if isinstance(content, text_type):
+            content = content.encode('utf-8')
+        elif content is None:
+            content = b''
+        elif is_stream(content):
+            if chunked:
+                content = chunk_encode(content)
+            else:
+                content = b''.join(iter_chunks(content))
+        if not buff.is_producer(content):
+            length = len(content)
+        return [self.head(status, headers, keep_alive, length), content]
+
+    def head(self, status, headers, keep_alive, length):
+        '''生成响应头
+
+        参数:
+            status: 整数状态码, 或者 "200 OK" 形式的字符串
+            headers: 追加或者覆盖默认头的字典, 可以为 None
+            keep_alive: 是否保持连接
+            length: 正文长度, None 表示使用 chunked 编码
+        '''
+        code, line = status_line(status)
+        parts = [line, date_line(), CONNECTION_LINES[keep_alive]]
+        if length is None:
+            parts.append('Transfer-Encoding: chunked\r\n')
+        elif code not in NO_BODY_STATUS:
+            parts.append('Content-Length: {}\r\n'.format(length))
+
+        if not headers:
+            parts.append(self.__default_block)
+        else:
+            # 被覆盖的默认头不再输出
+            for name, default_line in self.__default_items:
+                if name not in headers:
+                    parts.append(default_line)
+            for name, value in compat.iteritems(headers):
+                if name not in RESERVED_HEADERS:
+                    parts.append('{}: {}\r\n'.format(name, value))
+        parts.append('\r\n')
+        return compat.to_wire(''.join(parts))
@@ -0,0 +1,232 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+URI 路由, 把注册的路径模式编译成按 "/" 分段的前缀树.
+
+路径模式的写法:
+    /user/list              静态路径
+    /user/<uid>             参数, 匹配一个非空分段, 值为字符串
+    /user/<int:uid>         带类型的参数, 支持 str, int, float
+    /static/<path:name>     通配, 匹配剩余的所有分段 (可以为空), 只能出现在末尾
+
+匹配的优先级为: 静态分段 > 带类型参数 > 通配.
+查找只沿着路径的分段向下走, 耗时与路径长度成正比, 与路由数量无关.
+指定了 HTTP 方法时, 不处理该方法的路由会被跳过, 继续尝试优先级更低的路由;
+都不处理时返回第一个匹配路径的路由, 由上层返回 405.
+'''
+
+
+def _to_str(segment):
+    if not segment:
+        raise ValueError
+    return segment
+
+
+def _to_int(segment):
+    if not segment.isdigit():
+        raise ValueError
+    return int(segment)
+
+
+def _to_float(segment):
+    return float(segment)
+
+
+# 参数类型 -> (转换函数, 优先级), 优先级小的先尝试
+CONVERTERS = {
+    'int': (_to_int, 0),
+    'float': (_to_float, 1),
+    'str': (_to_str, 2),
+}
+# 通配类型
+WILDCARD = 'path'
+
+
+class RouteError(Exception):
+    '''路径模式格式错误或者与已有的路由冲突
+    '''
+    pass
+
+
+class RouteNode(object):
+    '''前缀树的节点, 对应路径中的一个分段
+    '''
+
+    def __init__(self):
+        self.static = {}  # 静态分段 -> 子节点
+        self.params = []  # [(优先级, 类型, 参数名, 转换函数, 子节点)]
+        self.wildcard = None  # (参数名, 子节点)
+        self.handlers = None  # HTTP 方法 -> 处理类, None 表示任意方法
+
+    def accepts(self, method):
+        '''是否注册了处理该方法的路由, method 为 None 时只要求注册了路由
+
+        参数:
+            method: 大写的 HTTP 方法
+        '''
+        handlers = self.handlers
+        if handlers is None:
+            return False
+        return method is None or method in handlers or None in handlers
+
+    def param_child(self, type_name, name):
+        '''获取或创建参数子节点
+
+        参数:
+            type_name: 参数类型
+            name: 参数名
+        '''
+        for _, t, n, _, child in self.params:
+            if t == type_name:
+                if n != name:
+                    raise RouteError(
+                        "param <{}:{}> conflicts with <{}:{}>".format(
+                            type_name, name, t, n))
+                return child
+
+        converter, priority = CONVERTERS[type_name]
+        child = RouteNode()
+        self.params.append((priority, type_name, name, converter, child))
+        self.params.sort(key=lambda x: x[0])
+        return child
+
+
+class Router(object):
+    '''路由表
+
+    使用方法:
+        router.add('/user/<int:uid>', UserHandler, methods=['GET'])
+        handlers, params = router.match('/user/12', 'GET')
+        # handlers = {'GET': UserHandler}, params = {'uid': 12}
+    '''
+
+    def __init__(self):
+        self.__root = RouteNode()
+        # 完全静态的路径直接使用字典查找
+        self.__static = {}
+
+    def add(self, pattern, handler, methods=None):
+        '''注册路由
+
+        参数:
+            pattern: 路径模式
+            handler: 处理类
+            methods: 支持的 HTTP 方法列表, None 表示任意方法
+        '''
+        if not pattern.startswith('/'):
+            raise RouteError("pattern must start with '/': " + pattern)
+
+        node = self.__root
+        segments = pattern[1:].split('/')
+        dynamic = False
+        for index, segment in enumerate(segments):
+            if not (segment.startswith('<') and segment.endswith('>')):
+                node = node.static.setdefault(segment, RouteNode())
+                continue
+
+            dynamic = True
+            type_name, _, name = segment[1:-1].rpartition(':')
+            type_name = type_name or 'str'
+            if not name:
+                raise RouteError("empty param name: " + pattern)
+
+            if type_name == WILDCARD:
+                if index != len(segments) - 1:
+                    raise RouteError("wildcard must be the last segment: " +
+                                     pattern)
+                if node.wildcard is None:
+                    node.wildcard = (name, RouteNode())
+                elif node.wildcard[0] != name:
+                    raise RouteError("wildcard conflicts: " + pattern)
+                node = node.wildcard[1]
+            elif type_name in CONVERTERS:
+                node = node.param_child(type_name, name)
+            else:
+                raise RouteError("unknown param type: " + type_name)
+
+        if node.handlers is None:
+            node.handlers = {}
+        if methods is None:
+            node.handlers[None] = handler
+        else:
+            for method in methods:
+                node.handlers[method.upper()] = handler
+
+        if not dynamic:
+            self.__static[pattern] = node.handlers
+
+    def match(self, path, method=None):
+        '''查找路径对应的处理类
+
+        参数:
+            path: 请求的路径, 不包含参数
+            method: 大写的 HTTP 方法, 优先返回处理该方法的路由.
+                    None 表示只按路径匹配
+
+        返回 (handlers, params):
+            handlers: HTTP 方法 -> 处理类 的字典, 路径不存在时为 None
+            params: 从路径中解析出的参数字典
+        '''
+        handlers = self.__static.get(path)
+        if handlers is not None and (method is None or method in handlers or
+                                     None in handlers):
+            return handlers, {}
+
+        if not path.startswith('/'):
+            return None, None
+        segments = path[1:].split('/')
+        params = {}
+        node = self.__match(self.__root, segments, 0, params, method)
+        if node is not None:
+            return node.handlers, params
+        if method is None:
+            return None, None
+        # 没有处理该方法的路由, 返回只按路径匹配的结果, 上层返回 405
+        if handlers is not None:
+            return handlers, {}
+        return self.match(path)
+
+    def __match(self, node, segments, index, params, method):
+        '''从 node 开始匹配 segments[index:], 返回匹配到的节点
+
+        参数:
+            node: 当前节点
+            segments: 路径的所有分段
+            index: 当前分段的下标
+            params: 保存解析出的参数
+            method: 大写的 HTTP 方法, None 表示不限制
+        '''
+        if index == len(segments):
+            if node.accepts(method):
+                return node
+            # 通配可以匹配空的剩余路径
+            if node.wildcard is not None and \
+                    node.wildcard[1].accepts(method):
+                params[node.wildcard[0]] = ''
+                return node.wildcard[1]
+            return None
+
+        segment = segments[index]
+        child = node.static.get(segment)
+        if child is not None:
+            found = self.__match(child, segments, index + 1, params, method)
+            if found is not None:
+                return found
+
+        for _, _, name, converter, child in node.params:
+            try:
+                value = converter(segment)
+            except ValueError:
+                continue
+            params[name] = value
+            found = self.__match(child, segments, index + 1, params, method)
+            if found is not None:
+                return found
+            del params[name]
+
+        if node.wildcard is not None:
+            name, child = node.wildcard
+            if child.accepts(method):
+                params[name] = '/'.join(segments[index:])
+                return child
+        return None
@@ -0,0 +1,177 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+静态文件服务
+'''
+import collections
+import email.utils
+import mimetypes
+import os
+
+from . import buff
+from . import uri_interface
+
+
+class HotFileCache(object):
+    '''小文件的 LRU 缓存, 保存文件的完整内容.
+    每次请求都会 stat 文件, 修改时间或大小变化后重新读取.
+    '''
+
+    def __init__(self, max_entries):
+        '''初始化
+
+        参数:
+            max_entries: 最多缓存的文件数
+        '''
+        self.max_entries = max_entries
+        # 文件路径 -> (修改时间, 大小, 内容)
+        self.__entries = collections.OrderedDict()
+
+    def get(self, path, stat):
+        '''获取文件内容, 缓存失效时重新读取
+
+        参数:
+            path: 文件路径
+            stat: 文件的 os.stat 结果
+        '''
+        entry = self.__entries.pop(path, None)
+        if entry is None or entry[0] != stat.st_mtime or \
+                entry[1] != stat.st_size:
+            with open(path, 'rb') as f:
+                entry = (stat.st_mtime, stat.st_size, f.read())
+        # 重新插入到末尾, 表示最近使用过
+        self.__entries[path] = entry
+        if len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+        return entry[2]
+
+
+class StaticFiles(uri_interface.UriInterface):
+    '''静态文件的处理类, 把 root 目录下的文件映射到一个带通配的路径上:
+
+        class Assets(sparrowlet.StaticFiles):
+            root = '/var/www/assets'
+
+        svr.route('/assets/<path:path>', Assets, methods=['GET', 'HEAD'])
+
+    小于 hot_max_size 的文件缓存在内存中, 大文件使用 sendfile 发送.
+    支持 HEAD, ETag, Last-Modified (304) 和单个区间的 Range 请求.
+    '''
+    # 文件所在的根目录
+    root = None
+    # 路径参数的名称
+    path_param = 'path'
+    # 目录请求时返回的文件
+    index = 'index.html'
+    # 小于该大小的文件缓存在内存中
+    hot_max_size = 64 * 1024
+    # 所有 StaticFiles 共享的小文件缓存
+    hot_cache = HotFileCache(256)
+
+    def __resolve(self):
+        '''把请求的路径转换为 root 下的文件路径, 不合法或者不存在时返回 None
+        '''
+        root = os.path.realpath(self.root)
+        name = self.http_data.path_params.get(self.path_param, '')
+        path = os.path.realpath(os.path.join(root, name.lstrip('/')))
+        # 不允许访问 root 以外的文件. root 为 "/" 时 root + os.sep 是 "//",
+        # 所以用 join 统一加上结尾的分隔符
+        if path != root and not path.startswith(os.path.join(root, '')):
+            return None
+        if os.path.isdir(path):
+            path = os.path.join(path, self.index)
+        if not os.path.isfile(path):
+            return None
+        return path
+
+    def __not_modified(self, etag, mtime):
+        '''依据 If-None-Match 和 If-Modified-Since 判断客户端的缓存是否有效
+
+        参数:
+            etag: 文件的 ETag
+            mtime: 文件的修改时间
+        '''
+        if_none_match = self.http_data.get_header('If-None-Match')
+        if if_none_match is not None:
+            tags = [x.strip() for x in if_none_match.split(',')]
+            return etag in tags or '*' in tags
+
+        if_modified_since = self.http_data.get_header('If-Modified-Since')
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def __parse_range(self, size):
+        '''解析 Range 头, 只支持单个区间.
+
+        参数:
+            size: 文件大小
+
+        返回 (start, end) 闭区间; 没有 Range 或无法识别时返回 None;
+        区间不合法时返回 False
+        '''
+        value = self.http_data.get_header('Range')
+        if not value or not value.startswith('bytes=') or ',' in value:
+            return None
+        start, sep, end = value[6:].strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if start:
+                start = int(start)
+                end = int(end) if end else size - 1
+            else:  # 最后 N 个字节
+                start = max(size - int(end), 0)
+                end = size - 1
+        except ValueError:
+            return None
+        end = min(end, size - 1)
+        if start > end or start >= size:
+            return False
+        return start, end
+
+    def get(self):
+        path = self.__resolve() if self.root else None
+        if path is None:
+            self.status = 404
+            return "404 Not Found"
+
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = '"{:x}-{:x}"'.format(int(stat.st_mtime), size)
+        headers = self.headers
+        headers['ETag'] = etag
+        headers['Last-Modified'] = email.utils.formatdate(stat.st_mtime,
+                                                          usegmt=True)
+        headers['Accept-Ranges'] = 'bytes'
+        headers['Content-Type'] = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+
+        if self.__not_modified(etag, stat.st_mtime):
+            self.status = 304
+            return None
+
+        offset, count = 0, size
+        byte_range = self.__parse_range(size)
+        if byte_range is False:
+            self.status = 416
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return None
+        elif byte_range is not None:
+            offset, count = byte_range[0], byte_range[1] - byte_range[0] + 1
+            self.status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                byte_range[0], byte_range[1], size)
+
+        if size <= self.hot_max_size:
+            data = self.hot_cache.get(path, stat)
+            if count == size:
+                return data
+            return memoryview(data)[offset: offset + count]
+        return buff.FileBody(open(path, 'rb'), offset, count)
+
+    def head(self):
+        # 与 GET 相同, 服务器发送响应时会去掉正文
+        return self.get()
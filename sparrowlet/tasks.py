@@ -1,21 +1,141 @@
 #!/user/bin/env python
 # -*- encoding:utf-8 -*-
 '''
-用于在通道中传输的任务
+Loop 与处理任务的微线程之间的任务分发.
+
+任务不再包装成对象, 而是以 [操作码, fd, 操作码, fd, ...] 的扁平列表
+成批地通过通道交给微线程, 每次 poll 得到的就绪 fd 只需要几次通道切换.
+微线程池的大小随负载在 min_size 和 max_size 之间伸缩.
 '''
+import time
 
+import stackless
 
-class SendTask(object):
-    '''发送任务
-    '''
+from . import log
+
+# 操作码, 同时也是处理函数列表的下标
+CMD_ONRECEIVE = 0x01
+CMD_ONSEND = 0x02
+
+# 通知微线程退出的批次
+_EXIT = None
+# 检查是否需要回收空闲微线程的间隔 (s)
+SHRINK_INTERVAL = 10.0
+# 默认的微线程数上限
+MAX_TASKLET_NUM = 1024
 
-    def __init__(self, fd):
-        self.fd = fd
+logger = log.get_logger()
 
 
-class ReceiveTask(object):
-    '''接收任务
+class TaskletPool(object):
+    '''可伸缩的微线程池
+
+    使用方法:
+        pool = TaskletPool({CMD_ONRECEIVE: on_receive, CMD_ONSEND: on_send},
+                           10, 100)
+        batch = [CMD_ONRECEIVE, 5, CMD_ONSEND, 7]
+        pool.dispatch(batch)
     '''
 
-    def __init__(self, fd):
-        self.fd = fd
+    def __init__(self, handlers, min_size, max_size=None):
+        '''初始化, 并创建 min_size 个微线程
+
+        参数:
+            handlers: 操作码 -> 处理函数, 处理函数的参数为 fd
+            min_size: 最少保留的微线程数
+            max_size: 微线程数上限, None 表示 max(min_size, MAX_TASKLET_NUM)
+        '''
+        self.__handlers = [None] * (max(handlers) + 1)
+        for cmd, handler in handlers.items():
+            self.__handlers[cmd] = handler
+        self.min_size = max(min_size, 1)
+        self.max_size = max(self.min_size, MAX_TASKLET_NUM) \
+            if max_size is None else max(self.min_size, max_size)
+        self.channel = stackless.channel()
+        # 当前的微线程数
+        self.size = 0
+        # 上一次回收以来同时在工作的微线程数的峰值
+        self.__peak = 0
+        self.__next_shrink = time.time() + SHRINK_INTERVAL
+        self.__grow(self.min_size)
+
+    def __grow(self, count):
+        '''创建微线程
+
+        参数:
+            count: 创建的个数
+        '''
+        for i in xrange(count):
+            task = stackless.tasklet()
+            task.bind(self.__work)
+            task.setup()
+        self.size += count
+
+    def __work(self):
+        '''每个微线程的主循环: 接收一批任务, 依次调用对应的处理函数
+        '''
+        handlers = self.__handlers
+        channel = self.channel
+        try:
+            while 1:
+                batch = channel.receive()
+                if batch is _EXIT:
+                    return
+                for i in xrange(0, len(batch), 2):
+                    handlers[batch[i]](batch[i + 1])
+        finally:
+            self.size -= 1
+
+    @property
+    def idle(self):
+        '''在通道上等待任务的微线程数
+        '''
+        return max(-self.channel.balance, 0)
+
+    def dispatch(self, batch):
+        '''把就绪的任务分给空闲的微线程. 空闲的微线程不够时扩充微线程池,
+        达到上限后平均分给现有的微线程, 发送会等待到有微线程空闲为止
+
+        参数:
+            batch: [操作码, fd, ...] 形式的任务列表
+        '''
+        count = len(batch) >> 1
+        if count == 0:
+            return
+        idle = self.idle
+        if count > idle and self.size < self.max_size:
+            grow = min(count - idle, self.max_size - self.size)
+            self.__grow(grow)
+            idle += grow
+        parts = max(min(count, idle), 1)
+        self.__peak = max(self.__peak, self.size - idle + parts)
+
+        if parts == 1:
+            self.channel.send(batch)
+            return
+        # 前 extra 份各多分一个任务
+        size, extra = divmod(count, parts)
+        start = 0
+        for i in xrange(parts):
+            end = start + ((size + 1 if i < extra else size) << 1)
+            self.channel.send(batch[start:end])
+            start = end
+
+    def maintain(self, now):
+        '''定期回收多余的空闲微线程, 保留最近的峰值和 min_size 中较大的数量
+
+        参数:
+            now: 当前时间
+        '''
+        if now < self.__next_shrink:
+            return
+        self.__next_shrink = now + SHRINK_INTERVAL
+        keep = max(self.min_size, self.__peak)
+        self.__peak = self.size - self.idle
+        retire = min(self.idle, self.size - keep)
+        if retire <= 0:
+            return
+        for i in xrange(retire):
+            self.channel.send(_EXIT)
+        logger.info("retired {} idle tasklets, {} left".format(
+            retire, self.size))
@@ -3,14 +3,23 @@
 import stackless
 import multiprocessing
 import socket
-import os
+import signal
 import sys
 
-import tasks
-import loop
-import log
+from . import tasks
+from . import loop
+from . import fd
+from . import log
+from . import master
+from . import metrics
+from . import offload
+from . import codec as codec_module
 
 logger = log.get_logger()
+stats = metrics.get_metrics()
+
+# Python 2 的 socket 模块没有这个常量, 使用 Linux 上的值
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
 
 class TcpServer(object):
@@ -19,99 +28,227 @@ class TcpServer(object):
     支持如下操作:
         1. 接收数据完毕的回调函数: on_receive
         2. 发送数据完毕的回调函数: on_send
-        3. 使用 fd_manager 可完成如下操作:
-            3.1. 发送数据: fd_manager.send(fd, data)
-            3.2. 接收数据: fd_manager.receive(fd)
-            3.3. 删除 fd: fd_manager.remove(fd)
-            3.4. 弹出接收到的数据: fd_manager.pop_received_data(fd)
+        3. 使用 self.fd_manager (当前进程 Loop 的连接表) 可完成如下操作:
+            3.1. 发送数据: self.fd_manager.send(fd, data)
+            3.2. 接收数据: self.fd_manager.receive(fd)
+            3.3. 删除 fd: self.fd_manager.remove(fd)
+            3.4. 弹出接收到的数据: self.fd_manager.pop_received_data(fd)
+            3.5. 等待发送缓冲区降到低水位: self.fd_manager.wait_drain(fd)
+        4. 阻塞或者占用 CPU 的调用交给线程池或进程池, 当前微线程挂起等待结果:
+            4.1. self.loop.run_in_thread(func, *args)
+            4.2. self.loop.run_in_process(func, *args)
+        5. 设置 codec 后按消息处理, 见 codec.py: 不需要重写 on_receive,
+           每条完整的消息调用一次 on_message(fd, frame),
+           回复可以通过 self.send_message(fd, frame) 编码后发送
     '''
 
-    def __init__(self, port, timeout, tasklet_num):
+    def __init__(self, port, timeout, tasklet_num, read_timeout=None,
+                 write_timeout=None, keep_alive_timeout=None,
+                 edge_triggered=False, batch_size=-1, reuse_port=False,
+                 exclusive_accept=False, graceful_timeout=30,
+                 high_water_mark=fd.HIGH_WATER_MARK,
+                 low_water_mark=fd.LOW_WATER_MARK, max_tasklet_num=None,
+                 offload_threads=offload.THREAD_NUM, offload_processes=0,
+                 codec=None):
         '''初始化
 
         参数:
             port: 监听端口
-            timeout: 超时时长 (ms)
-            tasklet_num: 微线程个数
+            timeout: 超时时长 (s)
+            tasklet_num: 最少保留的微线程个数, 负载高时会自动增加
+            read_timeout: 等待请求数据的超时时长, None 表示与 timeout 相同
+            write_timeout: 有数据待发送时的超时时长, None 表示与 timeout 相同
+            keep_alive_timeout: 空闲长连接的超时时长, None 表示与 timeout 相同
+            edge_triggered: 是否使用 epoll 的边缘触发模式
+            batch_size: 每次 poll 最多处理的事件数, -1 表示不限制
+            reuse_port: 每个进程使用 SO_REUSEPORT 绑定自己的监听 socket,
+                        由内核把新连接分配给各个进程
+            exclusive_accept: 共享监听 socket 时使用 EPOLLEXCLUSIVE 注册,
+                              每个新连接只唤醒一个进程
+            graceful_timeout: 收到 SIGTERM 后等待已有连接处理完毕的时长 (s)
+            high_water_mark: 连接的发送缓冲区超过该字节数后暂停读取和处理
+                             该连接的请求, None 表示不限制
+            low_water_mark: 暂停后发送缓冲区降到该字节数以下恢复读取
+            max_tasklet_num: 微线程个数的上限, None 表示使用
+                             tasks.MAX_TASKLET_NUM (不小于 tasklet_num)
+            offload_threads: 每个进程执行阻塞调用的线程数
+            offload_processes: 每个进程执行 CPU 密集调用的进程池大小,
+                               0 表示与 CPU 核数相同. 第一次使用时才会创建
+            codec: 创建每个连接的消息解码器的函数, 例如 codec.LineCodec 或
+                   functools.partial(codec.LengthPrefixCodec, width=2),
+                   None 表示不分帧, 由 on_receive 自己处理接收到的数据
         '''
+        self.__port = port
         self.__timeout = timeout
-
-        self.__task_channel = stackless.channel()
-        self.__init_tasklets(tasklet_num)
-        self.__listen_fd = self.__init_listener(port)
-
-    def __init_tasklets(self, tasklet_num):
-        '''初始化微线程, 并开启. 每个微线程都绑定 __process 函数
-
-        参数:
-            tasklet_num: 微线程个数
-        '''
-        for i in xrange(tasklet_num):
-            task = stackless.tasklet()
-            task.bind(self.__process)
-            task.setup()
-        logger.info("{} tasklets initialized".format(tasklet_num))
-
-    def __process(self):
-        '''每个微线程的主循环
-        '''
-        while 1:
-            task = self.__task_channel.receive()
-            if isinstance(task, tasks.ReceiveTask):
-                self.on_receive(task.fd)
-            elif isinstance(task, tasks.SendTask):
-                self.on_send(task.fd)
-
-    def __init_listener(self, port):
+        self.__read_timeout = read_timeout
+        self.__write_timeout = write_timeout
+        self.__keep_alive_timeout = keep_alive_timeout
+        self.__edge_triggered = edge_triggered
+        self.__batch_size = batch_size
+        self.__reuse_port = reuse_port
+        self.__exclusive_accept = exclusive_accept
+        self.__graceful_timeout = graceful_timeout
+        self.__high_water_mark = high_water_mark
+        self.__low_water_mark = low_water_mark
+        self.__offload_threads = offload_threads
+        self.__offload_processes = offload_processes
+        self.codec = codec
+        # 当前进程的 IO Loop 和它的连接表, 进程启动后才会创建
+        self.loop = None
+        self.fd_manager = None
+
+        self.__task_pool = tasks.TaskletPool(
+            {tasks.CMD_ONRECEIVE: self.on_receive,
+             tasks.CMD_ONSEND: self.on_send},
+            tasklet_num, max_tasklet_num)
+        logger.info("{} tasklets initialized, up to {}".format(
+            self.__task_pool.size, self.__task_pool.max_size))
+        # SO_REUSEPORT 模式下每个进程启动时各自创建监听 socket
+        self.__listen_fd = None
+        if not reuse_port:
+            self.__listen_fd = self.__init_listener(port)
+
+    def __init_listener(self, port, reuse_port=False):
         '''初始化监听 socket
 
         参数:
             port: 监听端口
+            reuse_port: 是否设置 SO_REUSEPORT
         '''
         reload(sys)
         sys.setdefaultencoding("utf8")
 
         listen_fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         listen_fd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            listen_fd.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         listen_fd.bind(('', port))
         listen_fd.listen(1024)
         listen_fd.setblocking(0)
         logger.info("initialize listener finished, port={}".format(port))
         return listen_fd
 
-    def __single_process_run(self):
+    def __on_stop(self, signum, frame):
+        '''收到 SIGTERM/SIGINT 后停止接收新连接, 处理完已有连接后退出
+        '''
+        logger.info("signal {} received, stopping".format(signum))
+        self.loop.stop(self.__graceful_timeout)
+
+    def __single_process_run(self, index=0):
         '''单进程启动
         IO Loop 也是使用 tasklet 启动的一个 "微线程"
+
+        参数:
+            index: 多进程模式下 worker 的编号
         '''
-        loop_obj = loop.Loop(self.__listen_fd, self.__timeout,
-                             self.__task_channel)
+        listen_fd = self.__listen_fd
+        if self.__reuse_port:
+            listen_fd = self.__init_listener(self.__port, reuse_port=True)
+
+        loop_obj = loop.Loop(listen_fd, self.__timeout,
+                             self.__task_pool,
+                             read_timeout=self.__read_timeout,
+                             write_timeout=self.__write_timeout,
+                             keep_alive_timeout=self.__keep_alive_timeout,
+                             edge_triggered=self.__edge_triggered,
+                             batch_size=self.__batch_size,
+                             exclusive_accept=self.__exclusive_accept,
+                             high_water_mark=self.__high_water_mark,
+                             low_water_mark=self.__low_water_mark,
+                             offload_threads=self.__offload_threads,
+                             offload_processes=self.__offload_processes)
+        self.loop = loop_obj
+        self.fd_manager = loop_obj.fd_manager
+        signal.signal(signal.SIGTERM, self.__on_stop)
+        signal.signal(signal.SIGINT, self.__on_stop)
         task = stackless.tasklet()
         task.bind(loop_obj.run)
         task.setup()
         stackless.run()
 
-    def run(self, process_num=1):
-        '''支持多进程和单进程启动
+    def run(self, process_num=1, cpu_affinity=False):
+        '''支持多进程和单进程启动.
+        多进程时当前进程作为 master, 负责启动, 重启和停止 worker:
+            SIGTERM/SIGINT: 所有 worker 处理完已有连接后退出
+            SIGHUP: 逐个重启 worker, 不中断服务
+            SIGUSR1: 把所有 worker 汇总的统计数据写入日志
 
         参数:
             process_num: 进程数, 默认为1, 如果设置为0则依据 CPU 核数决定
+            cpu_affinity: 多进程时是否把每个 worker 绑定到不同的 CPU
         '''
         if process_num == 0:
             process_num = multiprocessing.cpu_count()
 
         if process_num > 1:
-            for i in xrange(process_num):
-                new_pid = os.fork()
-                if new_pid == 0:
-                    self.__single_process_run()
-        self.__single_process_run()
-        logger.info("{} processes started".format(process_num))
+            # 统计数据的共享内存需要在 fork 之前创建
+            metrics.get_metrics().init(process_num)
+            master_obj = master.Master(
+                self.__single_process_run, process_num,
+                cpu_affinity=cpu_affinity,
+                graceful_timeout=self.__graceful_timeout)
+            master_obj.run()
+        else:
+            self.__single_process_run()
+
+    def __decoder(self, fd_info):
+        '''返回连接的消息解码器, 第一次使用时创建
+
+        参数:
+            fd_info: 连接信息
+        '''
+        decoder = fd_info.parser
+        if decoder is None:
+            decoder = fd_info.parser = self.codec()
+        return decoder
 
     def on_receive(self, fd):
-        '''接收完毕后的操作
+        '''接收完毕后的操作.
+        设置了 codec 时一次取出所有完整的消息, 依次交给 on_message,
+        消息格式错误或者超过长度限制时关闭连接
+        '''
+        if self.codec is None:
+            return
+        fd_info = self.fd_manager.get(fd)
+        if fd_info is None:
+            return
+
+        try:
+            frames = self.__decoder(fd_info).decode(fd_info.received_data)
+        except codec_module.FrameError as e:
+            logger.error("{fd} frame error: {e}".format(fd=fd, e=e))
+            self.fd_manager.remove(fd)
+            return
+        if frames:
+            stats.incr('messages', len(frames))
+        for frame in frames:
+            self.on_message(fd, frame)
+            # 处理消息时连接可能已经关闭
+            if fd_info.closed:
+                return
+
+    def on_message(self, fd, frame):
+        '''设置了 codec 时, 收到一条完整消息后的操作
+
+        参数:
+            fd: 文件描述子
+            frame: 消息内容 (bytes), 不包含长度前缀或者分隔符
         '''
         pass
 
+    def send_message(self, fd, frame):
+        '''使用该连接的解码器编码一条消息并发送, 返回值同 fd_manager.send
+
+        参数:
+            fd: 文件描述子
+            frame: 消息内容
+        '''
+        fd_info = self.fd_manager.get(fd)
+        if fd_info is None:
+            logger.error("Invalid fd {fd}".format(fd=fd))
+            return False
+        return self.fd_manager.send(fd, self.__decoder(fd_info).encode(frame))
+
     def on_send(self, fd):
         '''发送完毕后的操作
         '''
@@ -0,0 +1,245 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+Loop 使用的定时结构:
+    TimerWheel: 连接的超时, 截止时间频繁更新, 精度为一个格子
+    TimerHeap: call_later 等定时回调, 按截止时间精确执行
+'''
+import heapq
+import itertools
+
+# 已取消的定时器超过堆的一半且不少于该数量时重建堆
+COMPACT_MIN = 64
+
+
+class TimerWheel(object):
+    '''哈希时间轮, 用来管理大量连接的超时时间.
+
+    时间被切分为长度为 tick 的格子, 每个 key 按照截止时间落入对应的格子.
+    每次 expire 只访问走过的格子, 不需要扫描全部连接.
+    同一个 key 重复 add 会更新截止时间.
+    '''
+
+    def __init__(self, now, tick=1.0, slot_num=512):
+        '''初始化
+
+        参数:
+            now: 当前时间
+            tick: 每个格子代表的时长 (s)
+            slot_num: 格子个数, 超过一圈的截止时间会在之后的圈数中处理
+        '''
+        self.tick = float(tick)
+        self.slot_num = slot_num
+        # 每个格子是 key -> 截止时间 的字典
+        self.__slots = [{} for i in range(slot_num)]
+        # key -> 所在格子的下标
+        self.__index = {}
+        # 已经处理到的格子序号
+        self.__current = int(now / self.tick)
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __contains__(self, key):
+        return key in self.__index
+
+    def add(self, key, deadline):
+        '''添加或更新 key 的截止时间
+
+        参数:
+            key: 任意可哈希的对象, 例如 fd
+            deadline: 截止时间
+        '''
+        # 向上取整, 保证处理该格子时已经到达截止时间
+        tick_no = -int(-deadline // self.tick)
+        if tick_no <= self.__current:
+            tick_no = self.__current + 1
+        slot_index = tick_no % self.slot_num
+
+        old_index = self.__index.get(key)
+        if old_index is not None and old_index != slot_index:
+            del self.__slots[old_index][key]
+        self.__slots[slot_index][key] = deadline
+        self.__index[key] = slot_index
+
+    def remove(self, key):
+        '''删除 key, 不存在时自动忽略
+
+        参数:
+            key: 需要删除的 key
+        '''
+        slot_index = self.__index.pop(key, None)
+        if slot_index is not None:
+            del self.__slots[slot_index][key]
+
+    def next_timeout(self, now):
+        '''距离下一个格子的时长, 用作 poll 的超时. 没有 key 时返回 None
+
+        参数:
+            now: 当前时间
+        '''
+        if not self.__index:
+            return None
+        return max(0.0, (self.__current + 1) * self.tick - now)
+
+    def expire(self, now):
+        '''弹出所有已经到达截止时间的 key
+
+        参数:
+            now: 当前时间
+        '''
+        expired = []
+        target = int(now / self.tick)
+        if target <= self.__current:
+            return expired
+
+        # 跨越超过一圈时每个格子只需要处理一次
+        begin = max(self.__current + 1, target - self.slot_num + 1)
+        for tick_no in range(begin, target + 1):
+            slot = self.__slots[tick_no % self.slot_num]
+            if not slot:
+                continue
+            for key, deadline in list(slot.items()):
+                # 之后圈数的 key 留在格子中
+                if deadline <= now:
+                    del slot[key]
+                    del self.__index[key]
+                    expired.append(key)
+
+        self.__current = target
+        return expired
+
+
+class TimerHandle(object):
+    '''TimerHeap 中的一个定时回调, 由 TimerHeap.add 返回, 可以用 cancel 取消
+    '''
+    __slots__ = ('deadline', 'callback', 'args', 'interval', 'cancelled',
+                 '_heap')
+
+    def __init__(self, heap, deadline, callback, args, interval):
+        '''初始化
+
+        参数:
+            heap: 所属的 TimerHeap
+            deadline: 截止时间
+            callback: 回调函数
+            args: 回调函数的参数
+            interval: 重复执行的间隔 (s), None 表示只执行一次
+        '''
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+        self._heap = heap
+
+    def cancel(self):
+        '''取消定时器. 只做标记, 由 TimerHeap 在弹出时丢弃, 时间复杂度 O(1)
+        '''
+        if self.cancelled:
+            return
+        self.cancelled = True
+        # 释放回调引用的对象
+        self.callback = self.args = None
+        if self._heap is not None:
+            self._heap.cancelled += 1
+            self._heap = None
+
+
+class TimerHeap(object):
+    '''按截止时间排序的定时回调.
+
+    取消只标记 TimerHandle, 堆顶是已取消的定时器时才弹出丢弃;
+    已取消的超过一半时重建堆, 所以大量取消的定时器不会一直占用内存.
+
+    使用方法:
+        heap = TimerHeap()
+        handle = heap.add(time.time() + 5, func, (arg, ))
+        handle.cancel()
+        for handle in heap.expire(time.time()):
+            handle.callback(*handle.args)
+    '''
+
+    def __init__(self):
+        # [(截止时间, 序号, TimerHandle)], 序号保证同一时间按加入顺序执行
+        self.__heap = []
+        self.__seq = itertools.count()
+        # 堆中已经取消的定时器数
+        self.cancelled = 0
+
+    def __len__(self):
+        '''未取消的定时器数
+        '''
+        return len(self.__heap) - self.cancelled
+
+    def add(self, deadline, callback, args=(), interval=None):
+        '''添加定时回调, 返回 TimerHandle
+
+        参数:
+            deadline: 截止时间
+            callback: 回调函数
+            args: 回调函数的参数
+            interval: 重复执行的间隔 (s), None 表示只执行一次
+        '''
+        handle = TimerHandle(self, deadline, callback, args, interval)
+        heapq.heappush(self.__heap, (deadline, next(self.__seq), handle))
+        return handle
+
+    def __push(self, handle):
+        '''重新加入重复执行的定时器
+
+        参数:
+            handle: 已经更新截止时间的 TimerHandle
+        '''
+        handle._heap = self
+        heapq.heappush(self.__heap,
+                       (handle.deadline, next(self.__seq), handle))
+
+    def __compact(self):
+        '''已取消的定时器过多时重建堆
+        '''
+        if self.cancelled < COMPACT_MIN or \
+                self.cancelled * 2 < len(self.__heap):
+            return
+        self.__heap = [item for item in self.__heap if not item[2].cancelled]
+        heapq.heapify(self.__heap)
+        self.cancelled = 0
+
+    def next_timeout(self, now):
+        '''距离最近的截止时间的时长, 用作 poll 的超时. 没有定时器时返回 None
+
+        参数:
+            now: 当前时间
+        '''
+        heap = self.__heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+        if not heap:
+            return None
+        return max(0.0, heap[0][0] - now)
+
+    def expire(self, now):
+        '''弹出所有已经到达截止时间的定时器, 按截止时间排序.
+        重复执行的定时器会按间隔重新加入, 错过的次数不会补上
+
+        参数:
+            now: 当前时间
+        '''
+        self.__compact()
+        expired = []
+        heap = self.__heap
+        while heap and heap[0][0] <= now:
+            handle = heapq.heappop(heap)[2]
+            if handle.cancelled:
+                self.cancelled -= 1
+                continue
+            expired.append(handle)
+            if handle.interval is None:
+                handle._heap = None
+            else:
+                handle.deadline += handle.interval
+                if handle.deadline <= now:
+                    handle.deadline = now + handle.interval
+                self.__push(handle)
+        return expired
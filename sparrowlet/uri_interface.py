@@ -9,12 +9,40 @@ class UriInterface(object):
         get: 用来处理 GET 方式的请求, **返回值作为发送数据**.
         post: 用来处理 POST 方式的请求, **返回值作为发送数据**.
 
+    返回值也可以是生成器, 迭代器或者文件对象, 这时正文使用 chunked 编码分段发送,
+    只有 socket 可写时才会取下一段, 不需要把整个正文放在内存中.
+
     可以直接使用 self.http_data 来获取 http 请求的数据,
     详细请看 http_server.py 的 HttpData 类的定义.
+
+    处理函数可以修改返回的状态和头信息:
+        self.status: 返回的状态码, 默认为 200, 也可以是 "404 Not Found" 形式
+        self.headers: 追加或覆盖默认头信息的字典
+
+    请求正文超过 HttpServer 的 spool_size 时, self.http_data.content 是临时文件.
+    设置类属性 stream_body = True 时, 收到头信息后立即调用处理函数,
+    self.http_data.content 是 BodyReader, 可以用 read(size) 边接收边读取.
+
+    阻塞或者占用 CPU 的处理函数可以设置类属性 offload, 不阻塞其他请求:
+        offload = 'thread': 在线程池中执行, 适合阻塞的 IO 操作
+        offload = 'process': 在进程池中执行, 适合 CPU 密集的计算.
+                             处理类需要在模块级定义, 请求数据和返回值需要能被
+                             pickle, 正文为文件对象的请求不能使用
+    处理函数执行期间调用它的微线程挂起, 结果返回后继续.
+
+    GET 请求的结果可以缓存, 通过类属性开启:
+        cache_ttl: 缓存的有效时长 (s), 0 表示不缓存. 只缓存状态为 200 的响应
+        cache_headers: 除了 URI 和 GET 参数以外, 还会影响结果的请求头名称
     '''
+    cache_ttl = 0
+    cache_headers = ()
+    stream_body = False
+    offload = None
 
     def __init__(self, http_data):
         self.http_data = http_data
+        self.status = 200
+        self.headers = {}
 
     def get(self):
         pass
@@ -0,0 +1,194 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+asyncio 运行时的 HttpServer 测试, 需要 Python 3:
+
+    python3 -m unittest discover tests
+
+服务器运行在主线程的事件循环中 (需要注册信号处理), 请求由另一个线程通过
+socket 发送, 结束后通知事件循环退出.
+'''
+import socket
+import threading
+import time
+import unittest
+
+import sparrowlet
+from sparrowlet import compat
+
+try:
+    from sparrowlet import aio
+except ImportError:  # Python 2 没有 asyncio
+    aio = None
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def exchange(port, data):
+    '''发送 data 并读取到连接关闭为止, 服务器还没有启动时重试
+    '''
+    deadline = time.time() + 5
+    while 1:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+    try:
+        sock.sendall(data)
+        received = b''
+        while 1:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return received
+            received += chunk
+    finally:
+        sock.close()
+
+
+def split_responses(data):
+    '''按 Content-Length 把连续的响应分开, 返回 [(状态码, 头字典, 正文)]
+    '''
+    responses = []
+    while data:
+        head, data = data.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        headers = dict(line.split(': ', 1) for line in lines[1:])
+        length = int(headers.get('Content-Length', 0))
+        responses.append((int(lines[0].split(' ')[1]), headers,
+                          data[:length]))
+        data = data[length:]
+    return responses
+
+
+class Hello(sparrowlet.UriInterface):
+
+    def get(self):
+        return 'hello ' + self.http_data.get_params.get('name', '')
+
+    def head(self):
+        return self.get()
+
+    def post(self):
+        return 'posted {}'.format(len(self.http_data.content))
+
+
+class Threaded(sparrowlet.UriInterface):
+    offload = 'thread'
+
+    def get(self):
+        time.sleep(0.05)
+        return 'thread'
+
+
+class Deferred(sparrowlet.UriInterface):
+    '''返回 Future 的处理函数, 与协程相同, 在事件循环中等待结果
+    '''
+
+    def get(self):
+        return aio.current().run_in_thread(lambda: 'deferred')
+
+
+class Boom(sparrowlet.UriInterface):
+
+    def get(self):
+        raise RuntimeError('boom')
+
+
+class DeferredBoom(sparrowlet.UriInterface):
+
+    def get(self):
+        return aio.current().run_in_thread(lambda: 1 // 0)
+
+
+@unittest.skipIf(aio is None, "asyncio is not available")
+class AioHttpServerTest(unittest.TestCase):
+
+    def serve(self, *requests, **kargs):
+        '''启动服务器, 在另一个线程中依次用新连接发送 requests,
+        全部完成后停止服务器. 返回每个连接拆分后的响应
+        '''
+        port = free_port()
+        svr = aio.HttpServer(port, 10, **kargs)
+        svr.register({'/hello': Hello, '/thread': Threaded,
+                      '/deferred': Deferred, '/boom': Boom,
+                      '/deferred_boom': DeferredBoom})
+        results = []
+        errors = []
+
+        def client():
+            try:
+                for data in requests:
+                    results.append(split_responses(exchange(port, data)))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                while svr.loop is None:
+                    time.sleep(0.01)
+                svr.loop.aio_loop.call_soon_threadsafe(svr.loop.stop, 0)
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        svr.run()
+        thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def test_pipelined_keep_alive_requests(self):
+        responses, = self.serve(
+            b'GET /hello?name=a HTTP/1.1\r\n\r\n'
+            b'POST /hello HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc'
+            b'POST /hello HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'2\r\nab\r\n0\r\n\r\n'
+            b'GET /missing HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertEqual([(x[0], x[2]) for x in responses],
+                         [(200, b'hello a'), (200, b'posted 3'),
+                          (200, b'posted 2'), (404, b'404 Not Found')])
+        self.assertEqual(responses[0][1]['Connection'], 'keep-alive')
+        self.assertEqual(responses[-1][1]['Connection'], 'close')
+
+    def test_offloaded_and_deferred_handlers(self):
+        responses, = self.serve(
+            b'GET /thread HTTP/1.1\r\n\r\n'
+            b'GET /deferred HTTP/1.1\r\nConnection: close\r\n\r\n')
+        # 同一连接上的响应按请求的顺序返回
+        self.assertEqual([x[2] for x in responses], [b'thread', b'deferred'])
+
+    def test_failing_handlers_answer_500(self):
+        responses, = self.serve(
+            b'GET /boom HTTP/1.1\r\n\r\n'
+            b'GET /deferred_boom HTTP/1.1\r\n\r\n'
+            b'GET /hello HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertEqual([x[0] for x in responses], [500, 500, 200])
+        self.assertEqual(responses[0][2], b'500 Internal Server Error')
+
+    def test_head_has_no_body(self):
+        responses, = self.serve(b'HEAD /hello?name=abc HTTP/1.1\r\n'
+                                b'Connection: close\r\n\r\n')
+        status, headers, body = responses[0]
+        self.assertEqual(status, 200)
+        # 与 GET 的长度相同
+        self.assertEqual(headers['Content-Length'], '9')
+        self.assertEqual(body, b'')
+
+    def test_body_too_large_answers_413(self):
+        responses, = self.serve(
+            b'POST /hello HTTP/1.1\r\nContent-Length: 100\r\n\r\n',
+            max_body_size=10)
+        self.assertEqual(responses[0][0], 413)
+        # 正文与状态行的原因短语相同
+        reason = compat.http_client.responses[413]
+        self.assertEqual(responses[0][2], '413 {}'.format(reason).encode())
+
+
+if __name__ == '__main__':
+    unittest.main()
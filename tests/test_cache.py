@@ -0,0 +1,147 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+ResponseCache 的测试, single-flight 部分需要 stackless:
+
+    python -m unittest discover tests
+'''
+import unittest
+
+from sparrowlet import cache
+from sparrowlet.compat import stackless
+
+HEAD = b'HTTP/1.1 200 OK\r\n\r\n'
+
+
+def _stream_response():
+    '''头 + 生成器正文, 与流式响应的分片形式相同, 不能缓存
+    '''
+    return [HEAD, (x for x in (b'p0;', b'p1;', b'p2;'))]
+
+
+@unittest.skipIf(stackless is None, "stackless is not installed")
+class ResponseCacheFetchTest(unittest.TestCase):
+
+    def fetch_concurrently(self, response_cache, producer, count=3):
+        '''在 count 个微线程中同时获取同一个 key, 返回各自拼接后的响应
+        '''
+        results = []
+
+        def request():
+            data = response_cache.fetch('key', 10, producer)
+            body = b''.join(data[:-1])
+            last = data[-1]
+            body += b''.join(last) if hasattr(last, 'send') else last
+            results.append(body)
+
+        for _ in range(count):
+            stackless.tasklet(request)()
+        stackless.run()
+        return results
+
+    def test_cacheable_response_is_shared(self):
+        calls = []
+
+        def producer():
+            calls.append(1)
+            # 让其他微线程进入等待
+            stackless.schedule()
+            return [HEAD, b'body']
+
+        response_cache = cache.ResponseCache()
+        results = self.fetch_concurrently(response_cache, producer)
+        self.assertEqual(results, [HEAD + b'body'] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(response_cache.waits, 2)
+
+    def test_uncacheable_response_is_not_shared(self):
+        calls = []
+
+        def producer():
+            calls.append(1)
+            stackless.schedule()
+            return _stream_response()
+
+        response_cache = cache.ResponseCache()
+        results = self.fetch_concurrently(response_cache, producer)
+        # 每个请求都拿到完整的正文, 而不是共享一个只能迭代一次的生成器
+        self.assertEqual(results, [HEAD + b'p0;p1;p2;'] * 3)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(response_cache), 0)
+
+
+class ResponseCacheSetTest(unittest.TestCase):
+    '''不需要微线程的 get/set, LRU 和 TTL
+    '''
+
+    def test_get_returns_stored_response(self):
+        response_cache = cache.ResponseCache()
+        self.assertIsNone(response_cache.get('k'))
+        response_cache.set('k', [HEAD, b'a', b'b'], 10)
+        self.assertEqual(response_cache.get('k'), [HEAD, b'a', b'b'])
+        self.assertEqual(len(response_cache), 1)
+        self.assertEqual(response_cache.size, len(HEAD) + 2)
+
+    def test_set_replaces_old_entry(self):
+        response_cache = cache.ResponseCache()
+        response_cache.set('k', [HEAD, b'old'], 10)
+        response_cache.set('k', [HEAD, b'new!'], 10)
+        self.assertEqual(response_cache.get('k'), [HEAD, b'new!'])
+        self.assertEqual(response_cache.size, len(HEAD) + 4)
+
+    def test_least_recently_used_is_evicted(self):
+        # 每个响应 len(HEAD) + 4 = 23 字节, 4 个 92 字节, 第 5 个触发淘汰
+        response_cache = cache.ResponseCache(max_bytes=100)
+        for key in 'abcd':
+            response_cache.set(key, [HEAD, b'body'], 10)
+        # 读取 a 之后最久没有使用的是 b
+        response_cache.get('a')
+        response_cache.set('e', [HEAD, b'body'], 10)
+        self.assertIsNone(response_cache.get('b'))
+        for key in 'acde':
+            self.assertIsNotNone(response_cache.get(key))
+        self.assertEqual(response_cache.evictions, 1)
+        self.assertEqual(response_cache.size, 4 * (len(HEAD) + 4))
+
+    def test_expired_entry_is_removed(self):
+        response_cache = cache.ResponseCache()
+        response_cache.set('old', [HEAD, b'body'], 0)
+        response_cache.set('new', [HEAD, b'body'], 10)
+        self.assertIsNone(response_cache.get('old'))
+        self.assertEqual(len(response_cache), 1)
+        self.assertEqual(response_cache.size, len(HEAD) + 4)
+
+    def test_lookup_counts_hits(self):
+        response_cache = cache.ResponseCache()
+        response_cache.set('k', [HEAD, b'body'], 10)
+        response_cache.lookup('k')
+        response_cache.lookup('missing')
+        self.assertEqual(response_cache.hits, 1)
+
+    def test_set_reports_whether_stored(self):
+        response_cache = cache.ResponseCache(max_bytes=200)
+        self.assertTrue(response_cache.set('a', [HEAD, b'x' * 10], 10))
+        self.assertFalse(response_cache.set('b', _stream_response(), 10))
+        self.assertFalse(response_cache.set('c', [HEAD, b'x' * 50], 10))
+
+    def test_error_status_not_cached(self):
+        response_cache = cache.ResponseCache()
+        for head in (b'HTTP/1.1 500 Internal Server Error\r\n\r\n',
+                     b'HTTP/1.1 404 Not Found\r\n\r\n'):
+            self.assertFalse(response_cache.set('k', [head, b'err'], 10))
+        self.assertIsNone(response_cache.get('k'))
+
+    def test_hit_uses_current_date(self):
+        response_cache = cache.ResponseCache()
+        head = (b'HTTP/1.1 200 OK\r\nDate: Thu, 01 Jan 1970 00:00:00 GMT'
+                b'\r\nContent-Length: 2\r\n\r\n')
+        response_cache.set('k', [head, b'ok'], 10)
+        data = response_cache.get('k')
+        self.assertEqual(data[1:], [b'ok'])
+        self.assertTrue(data[0].startswith(b'HTTP/1.1 200 OK\r\nDate: '))
+        self.assertNotIn(b'1970', data[0])
+        self.assertTrue(data[0].endswith(b'\r\nContent-Length: 2\r\n\r\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+HttpClient 和 ConnectionPool 的测试, 需要 stackless:
+
+    python -m unittest discover tests
+
+上游服务由测试中的线程模拟, 客户端运行在真实的 Loop 中.
+'''
+import socket
+import threading
+import time
+import unittest
+
+from sparrowlet.compat import stackless
+
+if stackless is not None:
+    from sparrowlet import client
+    from sparrowlet import loop
+    from sparrowlet import tasks
+
+
+class Upstream(object):
+    '''在线程中运行的上游 HTTP 服务, 支持长连接:
+        /hello      200, Content-Length
+        /chunked    200, chunked 编码
+        /close      200, 之后关闭连接
+        /slow       等待 0.5s 后返回
+    '''
+
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.accepted = 0
+        thread = threading.Thread(target=self.__accept)
+        thread.daemon = True
+        thread.start()
+
+    def __accept(self):
+        while 1:
+            try:
+                sock, _ = self.listener.accept()
+            except socket.error:
+                return
+            self.accepted += 1
+            thread = threading.Thread(target=self.__serve, args=(sock, ))
+            thread.daemon = True
+            thread.start()
+
+    def __serve(self, sock):
+        data = b''
+        try:
+            while 1:
+                while b'\r\n\r\n' not in data:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        return
+                    data += chunk
+                head, data = data.split(b'\r\n\r\n', 1)
+                path = head.split(b' ')[1]
+                if path == b'/slow':
+                    time.sleep(0.5)
+                if path == b'/chunked':
+                    sock.sendall(b'HTTP/1.1 200 OK\r\n'
+                                 b'Transfer-Encoding: chunked\r\n\r\n'
+                                 b'3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n')
+                    continue
+                close = path == b'/close'
+                sock.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n' +
+                             (b'Connection: close\r\n' if close else b'') +
+                             b'\r\nhello')
+                if close:
+                    return
+        finally:
+            sock.close()
+
+    def close(self):
+        self.listener.close()
+
+
+@unittest.skipIf(stackless is None, "stackless is not installed")
+class HttpClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = Upstream()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.listener.setblocking(0)
+        # 与服务器相同, 由 Loop 把任务交给微线程池执行, 见 run_in_loop
+        self.jobs = []
+        self.task_pool = tasks.TaskletPool(
+            {tasks.CMD_ONRECEIVE: lambda index: self.jobs[index]()}, 1)
+        self.loop = loop.Loop(self.listener, 10, self.task_pool)
+
+    def tearDown(self):
+        self.upstream.close()
+        self.listener.close()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.upstream.port, path)
+
+    def run_in_loop(self, *funcs):
+        '''在 Loop 的微线程池中同时调用 funcs, 全部结束后停止 Loop.
+        返回各自的返回值, 只有一个函数时直接返回它的返回值
+        '''
+        results = [None] * len(funcs)
+        left = [len(funcs)]
+
+        def job(index):
+            try:
+                results[index] = funcs[index]()
+            except Exception as e:
+                results[index] = e
+            left[0] -= 1
+            if left[0] == 0:
+                self.loop.stop(0)
+
+        self.jobs = [lambda i=i: job(i) for i in range(len(funcs))]
+        batch = []
+        for index in range(len(funcs)):
+            batch.extend((tasks.CMD_ONRECEIVE, index))
+        self.loop.call_later(0, self.task_pool.dispatch, batch)
+        stackless.tasklet(self.loop.run)()
+        stackless.run()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results[0] if len(funcs) == 1 else results
+
+    def test_keep_alive_reuses_connection(self):
+        http_client = client.HttpClient()
+
+        def requests():
+            bodies = [http_client.get(self.url('/hello')).body,
+                      http_client.get(self.url('/chunked')).body,
+                      http_client.get(self.url('/hello')).body]
+            pool = http_client.pool('127.0.0.1', self.upstream.port)
+            return bodies, pool.size, len(pool.idle)
+
+        bodies, size, idle = self.run_in_loop(requests)
+        self.assertEqual(bodies, [b'hello', b'abcde', b'hello'])
+        self.assertEqual((size, idle), (1, 1))
+        self.assertEqual(self.upstream.accepted, 1)
+
+    def test_connection_close_is_not_reused(self):
+        http_client = client.HttpClient()
+
+        def requests():
+            statuses = [http_client.get(self.url('/close')).status
+                        for _ in range(2)]
+            pool = http_client.pool('127.0.0.1', self.upstream.port)
+            return statuses, pool.size
+
+        statuses, size = self.run_in_loop(requests)
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(size, 0)
+        self.assertEqual(self.upstream.accepted, 2)
+
+    def test_pool_limits_concurrent_connections(self):
+        http_client = client.HttpClient(max_size=2)
+
+        def request():
+            body = http_client.get(self.url('/slow')).body
+            pool = http_client.pool('127.0.0.1', self.upstream.port)
+            return body, pool.size
+
+        results = self.run_in_loop(*[request] * 4)
+        self.assertEqual([body for body, _ in results], [b'hello'] * 4)
+        self.assertEqual(max(size for _, size in results), 2)
+        self.assertEqual(self.upstream.accepted, 2)
+
+    def test_idle_connections_are_evicted(self):
+        http_client = client.HttpClient(idle_timeout=0.2)
+
+        def requests():
+            http_client.get(self.url('/hello'))
+            pool = http_client.pool('127.0.0.1', self.upstream.port)
+            before = pool.size
+            self.loop.sleep(0.5)
+            return before, pool.size, len(pool.idle)
+
+        self.assertEqual(self.run_in_loop(requests), (1, 0, 0))
+
+    def test_read_timeout(self):
+        http_client = client.HttpClient(read_timeout=0.1)
+
+        def request():
+            start = time.time()
+            try:
+                http_client.get(self.url('/slow'))
+            except socket.timeout:
+                return time.time() - start
+            return None
+
+        elapsed = self.run_in_loop(request)
+        self.assertIsNotNone(elapsed)
+        self.assertLess(elapsed, 0.45)
+
+    def test_connect_timeout(self):
+        # backlog 已满的监听 socket 不再响应 SYN, 连接一直无法建立
+        full = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        full.bind(('127.0.0.1', 0))
+        full.listen(0)
+        queued = []
+        for _ in range(4):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            sock.connect_ex(full.getsockname())
+            queued.append(sock)
+        pool_args = (full.getsockname(), 1, 60, 0.2)
+
+        def connect():
+            pool = client.ConnectionPool(*pool_args)
+            try:
+                pool.acquire()
+            except socket.timeout:
+                return pool.size
+            return None
+
+        try:
+            self.assertEqual(self.run_in_loop(connect), 0)
+        finally:
+            for sock in queued:
+                sock.close()
+            full.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+消息分帧解码器的测试:
+
+    python -m unittest discover tests
+'''
+import struct
+import unittest
+
+from sparrowlet import buff
+from sparrowlet import codec
+
+
+def decode_pieces(decoder, *pieces):
+    '''依次把 pieces 放进接收缓冲区并解码, 返回 (所有消息, 缓冲区)
+    '''
+    recv_buff = buff.RecvBuff()
+    frames = []
+    for piece in pieces:
+        recv_buff.append(piece)
+        frames.extend(decoder.decode(recv_buff))
+    return frames, recv_buff
+
+
+def wire(decoder, *frames):
+    '''把 frames 编码后拼接成发送的数据
+    '''
+    return b''.join(b''.join(decoder.encode(frame)) for frame in frames)
+
+
+class LengthPrefixCodecTest(unittest.TestCase):
+
+    def test_fixed_width_roundtrip(self):
+        for width, byteorder in ((1, 'big'), (2, 'little'), (4, 'big'),
+                                 (8, 'little')):
+            decoder = codec.LengthPrefixCodec(width, byteorder)
+            data = wire(decoder, b'a', b'', b'hello')
+            frames, recv_buff = decode_pieces(decoder, data)
+            self.assertEqual(frames, [b'a', b'', b'hello'])
+            self.assertEqual(len(recv_buff), 0)
+
+    def test_byte_order(self):
+        decoder = codec.LengthPrefixCodec(2, 'little')
+        self.assertEqual(decoder.encode(b'x' * 258)[0], b'\x02\x01')
+
+    def test_frames_split_at_every_byte(self):
+        decoder = codec.LengthPrefixCodec()
+        data = wire(decoder, b'first', b'second')
+        frames, recv_buff = decode_pieces(
+            decoder, *[data[i: i + 1] for i in range(len(data))])
+        self.assertEqual(frames, [b'first', b'second'])
+        self.assertEqual(len(recv_buff), 0)
+
+    def test_incomplete_frame_stays_in_buffer(self):
+        decoder = codec.LengthPrefixCodec()
+        frames, recv_buff = decode_pieces(decoder, struct.pack('>I', 5) +
+                                          b'abc')
+        self.assertEqual(frames, [])
+        self.assertEqual(len(recv_buff), 7)
+
+    def test_varint_roundtrip(self):
+        decoder = codec.LengthPrefixCodec(codec.VARINT)
+        payload = b'v' * 300
+        # 300 = 2 << 7 | 0x2c, 低 7 位在前并带有后续标记 0x80
+        self.assertEqual(decoder.encode(payload)[0], b'\xac\x02')
+        data = wire(decoder, payload, b'', b'x')
+        frames, _ = decode_pieces(decoder, data[:1], data[1:150], data[150:])
+        self.assertEqual(frames, [payload, b'', b'x'])
+
+    def test_frame_too_large_before_body_arrives(self):
+        decoder = codec.LengthPrefixCodec(max_frame_size=10)
+        self.assertRaises(codec.FrameTooLarge, decode_pieces, decoder,
+                          struct.pack('>I', 11))
+
+    def test_varint_prefix_too_long(self):
+        decoder = codec.LengthPrefixCodec(codec.VARINT)
+        self.assertRaises(codec.FrameError, decode_pieces, decoder,
+                          b'\xff' * codec.VARINT_MAX_SIZE)
+
+    def test_invalid_width(self):
+        self.assertRaises(ValueError, codec.LengthPrefixCodec, 3)
+
+
+class DelimiterCodecTest(unittest.TestCase):
+
+    def test_delimiter_split_across_pieces(self):
+        decoder = codec.DelimiterCodec(b'\r\n')
+        frames, recv_buff = decode_pieces(decoder, b'one\r', b'\ntwo\r\nth',
+                                          b'ree')
+        self.assertEqual(frames, [b'one', b'two'])
+        self.assertEqual(recv_buff.pop_str(), b'three')
+
+    def test_frame_too_large_without_delimiter(self):
+        decoder = codec.DelimiterCodec(b'\0', max_frame_size=8)
+        self.assertEqual(decode_pieces(decoder, b'12345678\0')[0],
+                         [b'12345678'])
+        self.assertRaises(codec.FrameTooLarge, decode_pieces, decoder,
+                          b'123456789')
+
+    def test_encode_appends_delimiter(self):
+        decoder = codec.DelimiterCodec(b'\0')
+        self.assertEqual(wire(decoder, b'a', b'b'), b'a\0b\0')
+
+    def test_empty_delimiter(self):
+        self.assertRaises(ValueError, codec.DelimiterCodec, b'')
+
+    def test_line_codec_strips_carriage_return(self):
+        decoder = codec.LineCodec()
+        frames, _ = decode_pieces(decoder, b'a\r\nb\n\r\n', b'c\r', b'\n')
+        self.assertEqual(frames, [b'a', b'b', b'', b'c'])
+        self.assertEqual(wire(decoder, b'x'), b'x\r\n')
+
+
+class FixedSizeCodecTest(unittest.TestCase):
+
+    def test_decode_leaves_remainder(self):
+        decoder = codec.FixedSizeCodec(3)
+        frames, recv_buff = decode_pieces(decoder, b'abcde', b'fg')
+        self.assertEqual(frames, [b'abc', b'def'])
+        self.assertEqual(recv_buff.pop_str(), b'g')
+
+    def test_invalid_sizes(self):
+        self.assertRaises(ValueError, codec.FixedSizeCodec, 0)
+        self.assertRaises(codec.FrameTooLarge, codec.FixedSizeCodec, 10,
+                          max_frame_size=5)
+        self.assertRaises(ValueError, codec.FixedSizeCodec(3).encode, b'ab')
+
+
+if __name__ == '__main__':
+    unittest.main()
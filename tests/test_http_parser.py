@@ -0,0 +1,169 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+HttpParser 的测试:
+
+    python -m unittest discover tests
+'''
+import unittest
+
+from sparrowlet import buff
+from sparrowlet import http_parser
+
+
+def parse_all(parser, *pieces):
+    '''依次把 pieces 放进接收缓冲区并解析, 返回解析出的所有请求
+    '''
+    recv_buff = buff.RecvBuff()
+    requests = []
+    for piece in pieces:
+        recv_buff.append(piece)
+        while 1:
+            http_data = parser.parse(recv_buff)
+            if http_data is None:
+                break
+            requests.append(http_data)
+    return requests
+
+
+def body_of(http_data):
+    '''正文可能是字符串或者临时文件
+    '''
+    content = http_data.content
+    return content.read() if hasattr(content, 'read') else content
+
+
+GET = b'GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+POST = (b'POST /form?x=1 HTTP/1.1\r\nContent-Type: text/plain\r\n'
+        b'Content-Length: 5\r\n\r\nhello')
+
+
+class HttpParserTest(unittest.TestCase):
+
+    def test_request_split_at_every_byte(self):
+        parser = http_parser.HttpParser()
+        requests = parse_all(parser, *[POST[i: i + 1]
+                                       for i in range(len(POST))])
+        self.assertEqual(len(requests), 1)
+        http_data = requests[0]
+        self.assertEqual((http_data.method, http_data.uri, http_data.version),
+                         ('POST', '/form', 'HTTP/1.1'))
+        self.assertEqual(http_data.get_params, {'x': '1'})
+        self.assertEqual(http_data.get_header('content-type'), 'text/plain')
+        self.assertEqual(http_data.content, b'hello')
+        self.assertTrue(parser.is_idle())
+
+    def test_pipelined_requests(self):
+        parser = http_parser.HttpParser()
+        # 请求之间多余的空行被忽略
+        requests = parse_all(parser, GET + POST + b'\r\n' + GET[:10],
+                             GET[10:])
+        self.assertEqual([x.method for x in requests],
+                         ['GET', 'POST', 'GET'])
+        self.assertEqual([x.content for x in requests],
+                         [b'', b'hello', b''])
+        self.assertEqual(parser.request_count, 3)
+
+    def test_query_params(self):
+        requests = parse_all(http_parser.HttpParser(),
+                             b'GET /a%20b?sig=YWJj==&name=%E4%B8%AD&flag&x=1'
+                             b'&x=2 HTTP/1.1\r\n\r\n')
+        http_data = requests[0]
+        self.assertEqual(http_data.uri, '/a b')
+        self.assertEqual(http_data.get_params['sig'], 'YWJj==')
+        self.assertEqual(http_data.get_params['x'], '2')
+        self.assertNotIn('flag', http_data.get_params)
+
+    def test_body_too_large_before_body_arrives(self):
+        parser = http_parser.HttpParser(max_body_size=4)
+        self.assertRaises(http_parser.HttpBodyTooLarge, parse_all, parser,
+                          POST[:-5])
+
+    def test_large_body_is_spooled(self):
+        parser = http_parser.HttpParser(spool_size=4)
+        requests = parse_all(parser, POST[:-3], POST[-3:])
+        content = requests[0].content
+        self.assertTrue(hasattr(content, 'read'))
+        self.assertEqual(content.read(), b'hello')
+        content.close()
+
+    def test_total_header_size_is_limited(self):
+        headers = b''.join(b'X-Header-' + str(i).encode() + b': value\r\n'
+                           for i in range(4000))
+        self.assertRaises(http_parser.HttpParseError, parse_all,
+                          http_parser.HttpParser(),
+                          b'GET / HTTP/1.1\r\n' + headers + b'\r\n')
+
+    def test_line_without_end_is_limited(self):
+        data = b'GET /' + b'a' * http_parser.MAX_HEADER_SIZE
+        self.assertRaises(http_parser.HttpParseError, parse_all,
+                          http_parser.HttpParser(), data)
+
+    def test_header_size_is_per_request(self):
+        # 每个请求 ~40KB 的头信息, 合计超过上限也不影响后续请求
+        request = (b'GET / HTTP/1.1\r\nX-Big: ' + b'a' * 40000 +
+                   b'\r\n\r\n')
+        requests = parse_all(http_parser.HttpParser(), request * 3)
+        self.assertEqual(len(requests), 3)
+
+    def test_invalid_requests(self):
+        for data in (b'GET /\r\n\r\n',
+                     b'POST / HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+                     b'POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n'):
+            self.assertRaises(http_parser.HttpParseError, parse_all,
+                              http_parser.HttpParser(), data)
+
+
+CHUNKED = (b'POST /up HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+           b'5;name=value\r\nhello\r\n6\r\n world\r\n0\r\n'
+           b'X-Checksum: 1\r\n\r\n')
+
+
+class ChunkedBodyTest(unittest.TestCase):
+
+    def test_chunked_body_is_decoded(self):
+        requests = parse_all(http_parser.HttpParser(), CHUNKED)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(body_of(requests[0]), b'hello world')
+
+    def test_chunked_body_split_at_every_byte(self):
+        parser = http_parser.HttpParser()
+        pieces = [CHUNKED[i: i + 1] for i in range(len(CHUNKED))]
+        requests = parse_all(parser, *pieces)
+        self.assertEqual([body_of(x) for x in requests], [b'hello world'])
+        self.assertTrue(parser.is_idle())
+
+    def test_request_after_chunked_body(self):
+        requests = parse_all(http_parser.HttpParser(),
+                             CHUNKED + b'GET /next HTTP/1.1\r\n\r\n')
+        self.assertEqual([x.uri for x in requests], ['/up', '/next'])
+
+    def test_chunked_body_too_large(self):
+        parser = http_parser.HttpParser(max_body_size=8)
+        self.assertRaises(http_parser.HttpBodyTooLarge, parse_all, parser,
+                          CHUNKED)
+
+    def test_large_chunked_body_is_spooled(self):
+        parser = http_parser.HttpParser(spool_size=8)
+        requests = parse_all(parser, CHUNKED)
+        self.assertTrue(hasattr(requests[0].content, 'read'))
+        self.assertEqual(body_of(requests[0]), b'hello world')
+        requests[0].content.close()
+
+    def test_invalid_chunks_are_rejected(self):
+        head = b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+        for body in (b'zz\r\n', b'3\r\nabcX\r\n', b'-1\r\n'):
+            self.assertRaises(http_parser.HttpParseError, parse_all,
+                              http_parser.HttpParser(), head + body)
+
+    def test_ambiguous_length_is_rejected(self):
+        for headers in (b'Transfer-Encoding: gzip\r\n',
+                        b'Transfer-Encoding: chunked\r\n'
+                        b'Content-Length: 3\r\n'):
+            data = b'POST / HTTP/1.1\r\n' + headers + b'\r\n'
+            self.assertRaises(http_parser.HttpParseError, parse_all,
+                              http_parser.HttpParser(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+响应序列化和 chunked 编码的测试:
+
+    python -m unittest discover tests
+'''
+import io
+import unittest
+
+from sparrowlet import buff
+from sparrowlet import response
+
+
+def decode_chunked(data):
+    '''解码 chunked 编码的正文, 返回 (各分片, 是否以 0 长度分片结束)
+    '''
+    chunks = []
+    while data:
+        line, data = data.split(b'\r\n', 1)
+        size = int(line, 16)
+        if size == 0:
+            return chunks, data == b'\r\n'
+        chunks.append(data[:size])
+        assert data[size: size + 2] == b'\r\n'
+        data = data[size + 2:]
+    return chunks, False
+
+
+class ChunkEncodeTest(unittest.TestCase):
+
+    def test_generator_chunks(self):
+        source = (x for x in [b'abc', b'', u'中', b'0123456789abcdef!'])
+        chunks, ended = decode_chunked(b''.join(
+            response.chunk_encode(source)))
+        # 空分片会提前结束 chunked 编码, 所以被跳过
+        self.assertEqual(chunks, [b'abc', u'中'.encode('utf-8'),
+                                  b'0123456789abcdef!'])
+        self.assertTrue(ended)
+
+    def test_empty_stream(self):
+        self.assertEqual(b''.join(response.chunk_encode(iter([]))),
+                         b'0\r\n\r\n')
+
+    def test_file_object(self):
+        data = b'x' * (response.STREAM_READ_SIZE + 10)
+        source = io.BytesIO(data)
+        chunks, ended = decode_chunked(b''.join(
+            response.chunk_encode(source)))
+        self.assertEqual([len(x) for x in chunks],
+                         [response.STREAM_READ_SIZE, 10])
+        self.assertTrue(ended)
+        self.assertTrue(source.closed)
+
+    def test_closing_early_closes_source(self):
+        closed = []
+
+        def source():
+            try:
+                yield b'a'
+                yield b'b'
+            finally:
+                closed.append(1)
+
+        encoded = response.chunk_encode(source())
+        next(encoded)
+        encoded.close()
+        self.assertEqual(closed, [1])
+
+    def test_chunk_data_is_not_copied(self):
+        piece = memoryview(b'shared')
+        parts = list(response.chunk_encode(iter([piece])))
+        self.assertIs(parts[1], piece)
+
+
+class ResponseBuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.builder = response.ResponseBuilder(
+            {'Content-Type': 'text/plain', 'Server': 'test'})
+
+    def head_lines(self, head):
+        return head.decode('latin-1').split('\r\n')
+
+    def test_content_length_and_defaults(self):
+        head, body = self.builder.build(u'中', 200, {'X-Id': '1'})
+        lines = self.head_lines(head)
+        self.assertEqual(lines[0], 'HTTP/1.1 200 OK')
+        self.assertIn('Content-Length: 3', lines)
+        self.assertIn('Connection: keep-alive', lines)
+        self.assertIn('Server: test', lines)
+        self.assertIn('X-Id: 1', lines)
+        self.assertTrue(head.endswith(b'\r\n\r\n'))
+        self.assertEqual(body, u'中'.encode('utf-8'))
+
+    def test_handler_headers_override_defaults(self):
+        head, _ = self.builder.build(
+            'x', 404, {'Content-Type': 'text/html', 'Content-Length': '99',
+                       'Connection': 'keep-alive'}, keep_alive=False)
+        lines = self.head_lines(head)
+        self.assertEqual(lines[0], 'HTTP/1.1 404 Not Found')
+        self.assertIn('Content-Type: text/html', lines)
+        self.assertNotIn('Content-Type: text/plain', lines)
+        # 服务器决定的头不能被覆盖
+        self.assertIn('Content-Length: 1', lines)
+        self.assertNotIn('Content-Length: 99', lines)
+        self.assertIn('Connection: close', lines)
+
+    def test_no_content_length_for_304(self):
+        head, body = self.builder.build(None, 304)
+        self.assertNotIn(b'Content-Length', head)
+        self.assertEqual(body, b'')
+
+    def test_stream_uses_chunked_encoding(self):
+        head, body = self.builder.build(iter([b'ab', b'c']))
+        self.assertIn(b'Transfer-Encoding: chunked\r\n', head)
+        self.assertTrue(buff.is_producer(body))
+        self.assertEqual(decode_chunked(b''.join(body)),
+                         ([b'ab', b'c'], True))
+
+    def test_stream_is_joined_without_chunked_support(self):
+        head, body = self.builder.build(iter([b'ab', b'c']), chunked=False)
+        self.assertIn(b'Content-Length: 3\r\n', head)
+        self.assertEqual(body, b'abc')
+
+    def test_string_status(self):
+        head, _ = self.builder.build('', '599 Custom Reason')
+        self.assertTrue(head.startswith(b'HTTP/1.1 599 Custom Reason\r\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+Router 的测试:
+
+    python -m unittest discover tests
+'''
+import unittest
+
+from sparrowlet import router
+
+
+class Handler(object):
+    pass
+
+
+class Other(object):
+    pass
+
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = router.Router()
+
+    def test_static_path(self):
+        self.router.add('/user/list', Handler)
+        self.assertEqual(self.router.match('/user/list'),
+                         ({None: Handler}, {}))
+        self.assertEqual(self.router.match('/user/other'), (None, None))
+        self.assertEqual(self.router.match('user/list'), (None, None))
+
+    def test_typed_params(self):
+        self.router.add('/item/<int:id>', Handler)
+        self.router.add('/item/<float:price>', Other)
+        self.router.add('/item/<name>/detail', Other)
+        self.assertEqual(self.router.match('/item/12'),
+                         ({None: Handler}, {'id': 12}))
+        self.assertEqual(self.router.match('/item/1.5'),
+                         ({None: Other}, {'price': 1.5}))
+        self.assertEqual(self.router.match('/item/abc/detail'),
+                         ({None: Other}, {'name': 'abc'}))
+        self.assertEqual(self.router.match('/item/abc'), (None, None))
+        self.assertEqual(self.router.match('/item//detail'), (None, None))
+
+    def test_static_segment_wins(self):
+        self.router.add('/user/<int:uid>', Handler)
+        self.router.add('/user/0', Other)
+        self.assertEqual(self.router.match('/user/0')[0], {None: Other})
+        self.assertEqual(self.router.match('/user/1')[0], {None: Handler})
+
+    def test_backtracks_when_a_branch_fails(self):
+        self.router.add('/a/b/c', Handler)
+        self.router.add('/a/<x>/d', Other)
+        self.assertEqual(self.router.match('/a/b/d'),
+                         ({None: Other}, {'x': 'b'}))
+
+    def test_wildcard(self):
+        self.router.add('/static/<path:name>', Handler)
+        self.assertEqual(self.router.match('/static/css/a.css'),
+                         ({None: Handler}, {'name': 'css/a.css'}))
+        self.assertEqual(self.router.match('/static'),
+                         ({None: Handler}, {'name': ''}))
+
+    def test_method_backtracking(self):
+        self.router.add('/obj/<int:id>', Handler, methods=['POST'])
+        self.router.add('/obj/<key>', Other, methods=['GET'])
+        self.assertEqual(self.router.match('/obj/7', 'POST'),
+                         ({'POST': Handler}, {'id': 7}))
+        self.assertEqual(self.router.match('/obj/7', 'GET'),
+                         ({'GET': Other}, {'key': '7'}))
+
+    def test_static_path_without_method_falls_back(self):
+        self.router.add('/files/list', Handler, methods=['POST'])
+        self.router.add('/files/<path:name>', Other, methods=['GET'])
+        self.assertEqual(self.router.match('/files/list', 'GET'),
+                         ({'GET': Other}, {'name': 'list'}))
+
+    def test_unsupported_method_returns_path_match(self):
+        # 上层据此返回 405 和 Allow 头
+        self.router.add('/obj/<int:id>', Handler, methods=['GET'])
+        self.assertEqual(self.router.match('/obj/7', 'DELETE'),
+                         ({'GET': Handler}, {'id': 7}))
+
+    def test_methods_of_the_same_path(self):
+        self.router.add('/obj', Handler, methods=['get'])
+        self.router.add('/obj', Other, methods=['POST'])
+        self.assertEqual(self.router.match('/obj', 'POST')[0],
+                         {'GET': Handler, 'POST': Other})
+
+    def test_invalid_patterns(self):
+        for pattern in ('no/slash', '/a/<path:p>/b', '/a/<uuid:x>',
+                        '/a/<int:>'):
+            self.assertRaises(router.RouteError, self.router.add, pattern,
+                              Handler)
+
+    def test_conflicting_param_names(self):
+        self.router.add('/a/<int:x>', Handler)
+        self.assertRaises(router.RouteError, self.router.add,
+                          '/a/<int:y>/b', Handler)
+        self.router.add('/f/<path:p>', Handler)
+        self.assertRaises(router.RouteError, self.router.add,
+                          '/f/<path:q>', Handler)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/user/bin/env python
+# -*- encoding:utf-8 -*-
+'''
+TimerWheel 和 TimerHeap 的测试, 时间由测试指定, 不依赖真实时钟:
+
+    python -m unittest discover tests
+'''
+import unittest
+
+from sparrowlet import timer
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = timer.TimerWheel(100.0, tick=1.0, slot_num=8)
+
+    def test_expires_at_deadline(self):
+        self.wheel.add('a', 102.5)
+        self.assertEqual(self.wheel.expire(102.4), [])
+        self.assertIn('a', self.wheel)
+        self.assertEqual(self.wheel.expire(103.0), ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_add_updates_deadline(self):
+        self.wheel.add('a', 101.5)
+        self.wheel.add('a', 104.5)
+        self.assertEqual(self.wheel.expire(102.0), [])
+        self.assertEqual(self.wheel.expire(105.0), ['a'])
+
+    def test_remove(self):
+        self.wheel.add('a', 101.0)
+        self.wheel.remove('a')
+        self.wheel.remove('missing')
+        self.assertEqual(self.wheel.expire(110.0), [])
+        self.assertIsNone(self.wheel.next_timeout(110.0))
+
+    def test_deadline_beyond_one_round(self):
+        # 8 个格子, 120 与 104 落在同一个格子中
+        self.wheel.add('far', 120.0)
+        self.wheel.add('near', 104.0)
+        self.assertEqual(self.wheel.expire(104.0), ['near'])
+        self.assertEqual(self.wheel.expire(112.0), [])
+        self.assertEqual(self.wheel.expire(120.0), ['far'])
+
+    def test_past_deadline_expires_on_next_tick(self):
+        self.wheel.add('a', 50.0)
+        self.assertEqual(self.wheel.expire(100.5), [])
+        self.assertEqual(self.wheel.expire(101.0), ['a'])
+
+    def test_next_timeout(self):
+        self.assertIsNone(self.wheel.next_timeout(100.0))
+        self.wheel.add('a', 105.0)
+        self.assertEqual(self.wheel.next_timeout(100.25), 0.75)
+
+
+class TimerHeapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.heap = timer.TimerHeap()
+
+    def fire(self, now):
+        '''执行到期的定时器, 返回它们的参数
+        '''
+        fired = []
+        for handle in self.heap.expire(now):
+            fired.append(handle.args[0])
+        return fired
+
+    def test_expires_in_deadline_order(self):
+        for deadline, name in ((3, 'c'), (1, 'a'), (2, 'b'), (1, 'a2')):
+            self.heap.add(deadline, None, (name, ))
+        self.assertEqual(self.fire(0.5), [])
+        self.assertEqual(self.fire(2), ['a', 'a2', 'b'])
+        self.assertEqual(self.fire(3), ['c'])
+        self.assertEqual(len(self.heap), 0)
+
+    def test_cancel(self):
+        handle = self.heap.add(1, None, ('a', ))
+        self.heap.add(2, None, ('b', ))
+        handle.cancel()
+        handle.cancel()
+        self.assertEqual(len(self.heap), 1)
+        # 已取消的定时器不影响 poll 的超时
+        self.assertEqual(self.heap.next_timeout(0), 2)
+        self.assertEqual(self.fire(5), ['b'])
+        self.assertIsNone(self.heap.next_timeout(5))
+
+    def test_interval_skips_missed_runs(self):
+        self.heap.add(1, None, ('tick', ), interval=1)
+        self.assertEqual(self.fire(1), ['tick'])
+        # 错过了 2, 3, 4 也只执行一次, 下一次在 5.5
+        self.assertEqual(self.fire(4.5), ['tick'])
+        self.assertEqual(self.heap.next_timeout(4.5), 1)
+        self.assertEqual(len(self.heap), 1)
+
+    def test_cancelled_timers_are_compacted(self):
+        handles = [self.heap.add(100 + i, None, (i, )) for i in range(150)]
+        for handle in handles[:100]:
+            handle.cancel()
+        self.assertEqual(self.heap.cancelled, 100)
+        self.assertEqual(self.fire(0), [])
+        self.assertEqual(self.heap.cancelled, 0)
+        self.assertEqual(len(self.heap), 50)
+        self.assertEqual(self.fire(300), list(range(100, 150)))
+
+
+if __name__ == '__main__':
+    unittest.main()